@@ -3,34 +3,132 @@
  */
 
 -- Tables
+
+-- Partitioned by month of time_created so queries over a recent window only
+-- read a few partitions and expired months are detached instead of deleted,
+-- see tools/manage_partitions.py. Unique keys of a partitioned table must
+-- include time_created, so:
+-- - a redelivered event is only skipped as a duplicate when its worker
+--   derives the same time_created again; workers take it from the payload,
+--   or from the time the event handler received the webhook, never from
+--   when the message is delivered
+-- - events with the same id are all kept when their time_created differs,
+--   only those with the same id and time_created are refused
 CREATE TABLE events_raw (
-    id VARCHAR(100) NOT NULL PRIMARY KEY,
+    id VARCHAR(100) NOT NULL,
     event_type VARCHAR(50) NOT NULL,
     metadata JSONB,
     time_created TIMESTAMP NOT NULL,
     signature VARCHAR(255),
     msg_id BIGINT,
-    source VARCHAR(50)
+    source VARCHAR(50),
+    PRIMARY KEY (id, time_created)
+) PARTITION BY RANGE (time_created);
+
+-- unique so concurrent workers can insert with ON CONFLICT (signature, time_created) DO NOTHING instead of checking first
+CREATE UNIQUE INDEX idx_er_signature ON events_raw(signature, time_created);
+CREATE INDEX idx_er_time_created ON events_raw(time_created);
+-- the metrics refresher reads the events that arrived since its last run
+CREATE INDEX idx_er_msg_id ON events_raw(msg_id);
+
+-- events of months without a partition, e.g. a backfill of old history, until create_events_raw_partition moves them
+CREATE TABLE events_raw_default PARTITION OF events_raw DEFAULT;
+
+-- Creates the partition of events_raw for the month of the given day unless
+-- it exists, moving the rows of that month out of the default partition.
+-- Returns the name of the new partition, NULL when it already existed.
+CREATE OR REPLACE FUNCTION create_events_raw_partition(day DATE) RETURNS TEXT
+LANGUAGE plpgsql AS $$
+DECLARE
+    first_day DATE := date_trunc('month', day)::DATE;
+    next_month DATE := (date_trunc('month', day) + INTERVAL '1 month')::DATE;
+    partition_name TEXT := 'events_raw_' || to_char(day, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- keeps workers from adding rows of this month to the default partition while they are moved
+    LOCK TABLE events_raw_default IN EXCLUSIVE MODE;
+    EXECUTE format('CREATE TABLE %I (LIKE events_raw INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM events_raw_default WHERE time_created >= %L AND time_created < %L RETURNING *) '
+        'INSERT INTO %I SELECT * FROM moved',
+        first_day, next_month, partition_name
+    );
+    EXECUTE format(
+        'ALTER TABLE events_raw ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, first_day, next_month
+    );
+    RETURN partition_name;
+END;
+$$;
+
+-- the last year and the next three months, tools/manage_partitions.py keeps creating them ahead
+SELECT create_events_raw_partition(month::DATE)
+FROM generate_series(
+    date_trunc('month', CURRENT_DATE) - INTERVAL '12 months',
+    date_trunc('month', CURRENT_DATE) + INTERVAL '3 months',
+    INTERVAL '1 month'
+) AS month;
+
+-- complete payloads of events stored with projected metadata (FK_METADATA_ARCHIVE, see shared/projection.py)
+CREATE TABLE events_raw_archive (
+    signature VARCHAR(255) NOT NULL PRIMARY KEY,
+    source VARCHAR(50),
+    event_type VARCHAR(50) NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    payload BYTEA NOT NULL  -- gzipped JSON
+);
+
+-- the payload is compressed by the workers already, don't let TOAST try again
+ALTER TABLE events_raw_archive ALTER COLUMN payload SET STORAGE EXTERNAL;
+
+-- content-addressed blobs of complete payloads (FK_PAYLOAD_STORE=table, see shared/blobstore.py),
+-- events_raw.metadata->>'$payload' is the digest of the root blob of an event
+CREATE TABLE payload_blobs (
+    digest CHAR(64) NOT NULL PRIMARY KEY,
+    data BYTEA NOT NULL  -- gzipped canonical JSON
 );
 
-CREATE INDEX idx_er_signature ON events_raw(signature);
+ALTER TABLE payload_blobs ALTER COLUMN data SET STORAGE EXTERNAL;
 
 CREATE TABLE events_enriched (
     events_raw_signature VARCHAR(255) NOT NULL PRIMARY KEY,
     enriched_metadata JSONB
 );
 
--- Views that will be used by the front end for querying
+
+-- Metrics
+--
+-- The dashboard reads daily_metrics, rolled up from changes, deployments
+-- and incidents. Changes are the commits the github and gitlab workers
+-- write with each push. Deployments, incidents and daily_metrics are tables
+-- the metrics refresher (workers/metrics-refresher) keeps up to date from
+-- the events that arrived since its last run instead of deriving them from
+-- all of events_raw on every panel refresh: from the deploy and incident
+-- facts the workers extract from each event at ingest. msg_id tells the
+-- refresher which facts are new.
+
+-- commits of push events, written in the transaction that inserts the push
+-- (see shared.commit_rows); time_created is truncated to the second
+CREATE TABLE commits (
+    source VARCHAR(50) NOT NULL,
+    change_id TEXT NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    repo TEXT,
+    PRIMARY KEY (change_id, source, time_created)
+);
+
+CREATE INDEX idx_commits_time_created ON commits(time_created);
+
 CREATE OR REPLACE VIEW changes AS
 SELECT
     source,
-    event_type,
-    commit->>'id' AS change_id,
-    date_trunc('second', (commit->>'timestamp')::timestamp) AS time_created
-FROM events_raw e,
-LATERAL jsonb_array_elements(e.metadata::jsonb->'commits') AS commit
-WHERE event_type = 'push'
-GROUP BY 1, 2, 3, 4;
+    'push'::VARCHAR(50) AS event_type,
+    change_id,
+    time_created
+FROM commits;
 -- end view changes
 
 CREATE OR REPLACE VIEW events AS
@@ -47,139 +145,174 @@ FROM events_raw raw
 JOIN events_enriched enr ON raw.signature = enr.events_raw_signature;
 -- end view events
 
-CREATE OR REPLACE VIEW deployments AS
-with deploys_cloudbuild_github_gitlab as (
-    select
-        source,
-        id as deploy_id,
-        time_created,
-        case
-            when source = 'cloud_build' then metadata#>>'{substitutions, commit_sha}'
-            when source like 'github%' then metadata#>>'{deployment, sha}'
-            when source like 'gitlab%' then coalesce(
-                metadata#>>'{commit, id}',
-                substring(metadata->>'commit_url' from '.*commit\/(.*)')
-            )
-            when source = 'argocd' then metadata#>>'{commit_sha}'
-        end as main_commit,
-        case
-            when source like 'github%' then array(
-                select value->>'id'
-                from jsonb_array_elements(metadata::jsonb->'commits') as value
-            )
-            else array[]::text[]
-        end as additional_commits
-    from events_raw
-    where (
-        (source = 'cloud_build' and metadata#>>'{status}' = 'success')
-        or (source like 'github%' and event_type = 'deployment_status' and metadata#>>'{deployment_status,state}' = 'success')
-        or (source like 'gitlab%' and event_type = 'pipeline' and metadata#>>'{object_attributes, status}' = 'success')
-        or (source like 'gitlab%' and event_type = 'deployment' and metadata#>>'{status}' = 'success')
-        or (source = 'argocd' and metadata#>>'{status}' = 'success')
+-- Tables the dashboard reads, written by the metrics refresher only
+
+CREATE TABLE deployments (
+    source VARCHAR(50) NOT NULL,
+    deploy_id VARCHAR(100) NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    main_commit TEXT NOT NULL,
+    -- of the main commit, else of one of the changes, '' when no push recorded one
+    repo TEXT NOT NULL DEFAULT '',
+    changes TEXT[]
+);
+
+CREATE INDEX idx_deployments_deploy_id ON deployments(source, deploy_id);
+CREATE INDEX idx_deployments_time_created ON deployments(time_created);
+-- finds the deployment of the root cause of an incident
+CREATE INDEX idx_deployments_changes ON deployments USING GIN (changes);
+
+CREATE TABLE incidents (
+    source VARCHAR(50) NOT NULL,
+    incident_id TEXT NOT NULL,
+    time_created TIMESTAMP,
+    time_resolved TIMESTAMP,
+    -- of the deployment of the root cause, '' without one
+    repo TEXT NOT NULL DEFAULT '',
+    changes TEXT[],
+    PRIMARY KEY (source, incident_id)
+);
+
+CREATE INDEX idx_incidents_time_created ON incidents(time_created);
+-- finds the incidents a deployment caused
+CREATE INDEX idx_incidents_changes ON incidents USING GIN (changes);
+
+-- successful deploys, one row per event and deployed commit (see
+-- shared.deploy_rows), written by the workers in the transaction that
+-- inserts the event
+CREATE TABLE deploy_events (
+    signature VARCHAR(255) NOT NULL,
+    source VARCHAR(50) NOT NULL,
+    deploy_id VARCHAR(100) NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    main_commit TEXT NOT NULL,
+    additional_commits TEXT[] NOT NULL,
+    msg_id BIGINT,
+    PRIMARY KEY (signature, main_commit)
+);
+
+CREATE INDEX idx_de_deploy_id ON deploy_events(source, deploy_id);
+CREATE INDEX idx_de_msg_id ON deploy_events(msg_id);
+
+-- the ids of the commits in the event with the given id, normally a push
+-- whose head commit is that id
+CREATE OR REPLACE FUNCTION commit_changes(commit_id TEXT) RETURNS TEXT[]
+LANGUAGE sql STABLE AS $$
+    SELECT ARRAY(
+        SELECT DISTINCT change->>'id'
+        FROM events_raw e,
+        LATERAL jsonb_array_elements(
+            CASE WHEN jsonb_typeof(e.metadata->'commits') = 'array' THEN e.metadata->'commits' END
+        ) AS change
+        WHERE e.id = commit_id AND change->>'id' IS NOT NULL
     )
-),
-deploys_tekton as (
-    select
-        source,
-        id as deploy_id,
-        time_created,
-        param->>'value' as main_commit,
-        array[]::text[] as additional_commits
-    from events_raw,
-    lateral jsonb_array_elements(metadata::jsonb->'data'->'pipelinerun'->'spec'->'params') as param
-    where event_type = 'dev.tekton.event.pipelinerun.successful.v1'
-    and metadata::text like '%gitrevision%'
-    and param->>'name' = 'gitrevision'
-),
-deploys_circleci as (
-    select
-        source,
-        id as deploy_id,
-        time_created,
-        metadata#>>'{pipeline, vcs, revision}' as main_commit,
-        array[]::text[] as additional_commits
-    from events_raw
-    where source = 'circleci' and event_type = 'workflow-completed' and metadata#>>'{workflow, name}' like '%deploy%' and metadata#>>'{workflow, status}' = 'success'
-),
-deploys as (
-    select * from deploys_cloudbuild_github_gitlab
-    union all
-    select * from deploys_tekton
-    union all
-    select * from deploys_circleci
-),
-changes_raw as (
-    select
-        id,
-        metadata as change_metadata
-    from events_raw
-),
-deployment_changes AS (
-    SELECT
-        source,
-        deploy_id,
-        deploys.time_created,
-        change_metadata,
-        ARRAY(
-            SELECT jsonb_array_elements_text(change_metadata#>'{commits, id}')
-        ) AS array_commits,
-        main_commit
-    FROM deploys
-    JOIN changes_raw ON (
-        changes_raw.id = deploys.main_commit
-        OR changes_raw.id = ANY(deploys.additional_commits)
+$$;
+
+-- a deploy commit linked to the event with its id, a deploy is a deployment
+-- once one of its commits is linked and ships the changes of its links
+CREATE TABLE deployment_changes (
+    source VARCHAR(50) NOT NULL,
+    deploy_id VARCHAR(100) NOT NULL,
+    commit_id TEXT NOT NULL,
+    changes TEXT[] NOT NULL,
+    PRIMARY KEY (source, deploy_id, commit_id)
+);
+
+-- deploy commits whose event has not arrived yet, the metrics refresher
+-- moves them to deployment_changes when it does and drops them after
+-- FK_REFRESH_PENDING_LINK_DAYS
+CREATE TABLE pending_deployment_links (
+    commit_id TEXT NOT NULL,
+    source VARCHAR(50) NOT NULL,
+    deploy_id VARCHAR(100) NOT NULL,
+    queued_at TIMESTAMP NOT NULL DEFAULT timezone('utc', now()),
+    PRIMARY KEY (commit_id, source, deploy_id)
+);
+
+-- issue and incident events, one row per event (see shared.incident_rows),
+-- written by the workers in the transaction that inserts the event;
+-- incidents are aggregated from them when a later event affects them
+CREATE TABLE incident_events (
+    signature VARCHAR(255) NOT NULL PRIMARY KEY,
+    source VARCHAR(50) NOT NULL,
+    incident_id TEXT NOT NULL,
+    time_created TIMESTAMP,
+    time_resolved TIMESTAMP,
+    root_cause TEXT,
+    bug BOOLEAN,
+    msg_id BIGINT
+);
+
+CREATE INDEX idx_ie_incident_id ON incident_events(source, incident_id);
+CREATE INDEX idx_ie_root_cause ON incident_events(root_cause);
+CREATE INDEX idx_ie_msg_id ON incident_events(msg_id);
+
+-- what the dashboard plots, by UTC day, source and repository (that of the
+-- deployments and incidents, see above): the deployments of the day and how
+-- many of them caused an incident, the lead times of the changes they
+-- shipped and the restore times of the incidents opened that day. The times
+-- are kept whole, sorted, so percentiles over any days, sources and
+-- repositories are exact, and as quantile sketches that merge into percentiles of long
+-- ranges within 1% (see shared/sketch.py). Written by the metrics
+-- refresher for the days a run affected.
+CREATE TABLE daily_metrics (
+    day DATE NOT NULL,
+    source VARCHAR(50) NOT NULL,
+    repo TEXT NOT NULL,
+    deployments INTEGER NOT NULL,
+    failed_deployments INTEGER NOT NULL,
+    lead_time_minutes DOUBLE PRECISION[] NOT NULL,
+    restore_time_hours DOUBLE PRECISION[] NOT NULL,
+    lead_time_sketch JSONB,
+    restore_time_sketch JSONB,
+    PRIMARY KEY (day, source, repo)
+);
+
+-- the sketch of all the values of the given sketches, like sketch.merge:
+-- sketch_quantile(sketch_merge(ARRAY_AGG(lead_time_sketch)), 0.9)
+CREATE OR REPLACE FUNCTION sketch_merge(sketches JSONB[]) RETURNS JSONB
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT jsonb_build_object(
+        'alpha', (SELECT MAX((s->>'alpha')::DOUBLE PRECISION) FROM unnest(sketches) AS s),
+        'zeros', (SELECT COALESCE(SUM((s->>'zeros')::BIGINT), 0) FROM unnest(sketches) AS s),
+        'bins', (
+            SELECT COALESCE(jsonb_object_agg(bin, total), '{}'::JSONB)
+            FROM (
+                SELECT b.key AS bin, SUM(b.value::BIGINT) AS total
+                FROM unnest(sketches) AS s, jsonb_each_text(s->'bins') AS b
+                GROUP BY b.key
+            ) merged
+        )
     )
-)
-SELECT
-    source,
-    deploy_id,
-    time_created,
-    main_commit,
-    ARRAY_AGG(DISTINCT array_commits) filter(where array_commits <> '{}') AS changes
-FROM deployment_changes
-GROUP BY 1,2,3,4;
--- end deployments view
-
-CREATE OR REPLACE VIEW incidents AS
-SELECT
-    source,
-    incident_id,
-    MIN(LEAST(issue.time_created, COALESCE(root.time_created, issue.time_created))) AS time_created,
-    MAX(time_resolved) AS time_resolved,
-    ARRAY_AGG(DISTINCT issue.root_cause) FILTER (WHERE issue.root_cause IS NOT NULL) AS changes
-FROM
-(
-    SELECT
-        source,
-        CASE
-            WHEN source LIKE 'github%' THEN metadata#>>'{issue,number}'
-            WHEN source LIKE 'gitlab%' AND event_type = 'note' THEN metadata#>>'{object_attributes,noteable_id}'
-            WHEN source LIKE 'gitlab%' AND event_type = 'issue' THEN metadata#>>'{object_attributes,id}'
-            WHEN source LIKE 'pagerduty%' THEN metadata#>>'{event,data,id}'
-        END AS incident_id,
-        CASE
-            WHEN source LIKE 'github%' THEN (metadata#>>'{issue,created_at}')::timestamp
-            WHEN source LIKE 'gitlab%' THEN (metadata#>>'{object_attributes,created_at}')::timestamp
-            WHEN source LIKE 'pagerduty%' THEN (metadata#>>'{event,occurred_at}')::timestamp
-        END AS time_created,
-        CASE
-            WHEN source LIKE 'github%' THEN (metadata#>>'{issue,closed_at}')::timestamp
-            WHEN source LIKE 'gitlab%' THEN (metadata#>>'{object_attributes,closed_at}')::timestamp
-            WHEN source LIKE 'pagerduty%' THEN (metadata#>>'{event,occurred_at}')::timestamp
-        END AS time_resolved,
-        SUBSTRING(metadata::text FROM 'root cause: ([[:alnum:]]*)') AS root_cause,
-        CASE
-            WHEN source LIKE 'github%' THEN metadata#>>'{issue,labels}' LIKE '%name%' AND metadata#>>'{issue,labels}' LIKE '%"name":_"Incident"%'
-            WHEN source LIKE 'gitlab%' THEN metadata#>'{object_attributes,labels}' @> '[{"title":"Incident"}]'
-            WHEN source LIKE 'pagerduty%' THEN TRUE
-        END AS bug
-    FROM events_raw
-    WHERE event_type LIKE 'issue%' OR event_type LIKE 'incident%' OR (event_type = 'note' AND metadata#>>'{object_attributes,noteable_type}' = 'Issue')
-) issue
-LEFT JOIN (
-    SELECT time_created, unnest(changes) AS root_cause_from_deploy
-    FROM deployments
-) root ON root.root_cause_from_deploy = issue.root_cause
-GROUP BY 1, 2
-HAVING BOOL_OR(bug) IS TRUE;
--- end incidents view
+$$;
+
+-- the estimate of the q-quantile of the values of a sketch, like sketch.quantile
+CREATE OR REPLACE FUNCTION sketch_quantile(sketch JSONB, q DOUBLE PRECISION) RETURNS DOUBLE PRECISION
+LANGUAGE sql IMMUTABLE AS $$
+    WITH bins AS (
+        SELECT NULL::INTEGER AS bin, (sketch->>'zeros')::BIGINT AS count
+        UNION ALL
+        SELECT key::INTEGER, value::BIGINT FROM jsonb_each_text(sketch->'bins')
+    ),
+    ranked AS (
+        SELECT bin, SUM(count) OVER (ORDER BY bin NULLS FIRST) AS seen, SUM(count) OVER () AS total
+        FROM bins
+        WHERE count > 0
+    ),
+    gamma AS (
+        SELECT (1 + (sketch->>'alpha')::DOUBLE PRECISION) / (1 - (sketch->>'alpha')::DOUBLE PRECISION) AS g
+    )
+    SELECT CASE WHEN bin IS NULL THEN 0 ELSE 2 * power(g, bin) / (g + 1) END
+    FROM ranked, gamma
+    WHERE seen > floor(LEAST(GREATEST(q, 0), 1) * (total - 1))
+    ORDER BY bin NULLS FIRST
+    LIMIT 1
+$$;
+
+-- highest events_raw.msg_id a refresher run has seen, and when the tables were last rebuilt
+CREATE TABLE refresh_watermarks (
+    name VARCHAR(50) NOT NULL PRIMARY KEY,
+    msg_id BIGINT,
+    refreshed_at TIMESTAMP NOT NULL,
+    rebuilt_at TIMESTAMP
+);
@@ -0,0 +1,142 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Maintains the monthly partitions of events_raw (see init-db.sql).
+
+Run it daily, from cron or a Kubernetes CronJob, with the same FK_DB_*
+settings as the workers:
+
+    FK_DB_HOST=localhost FK_DB_USER=fourkeys FK_DB_PW=... \\
+        python3 tools/manage_partitions.py --months-ahead 3 --retention-months 24 --archive-dir /backups
+
+It creates the partitions of the coming months before events arrive for
+them, and gives the months that only exist in the default partition (a
+backfill of old history, or a month the command was not run for) their own
+partition. With --retention-months, partitions whose events are all older
+than that are detached from events_raw, which only changes the catalog, and
+then written to a gzipped CSV file in --archive-dir and dropped, dropped
+with --drop, or otherwise left behind as ordinary tables. --dry-run prints
+what would be done.
+"""
+
+import argparse
+import gzip
+import os
+import re
+import sys
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "shared"))
+
+import psycopg2  # noqa: E402
+from psycopg2 import sql  # noqa: E402
+
+import dbpool  # noqa: E402
+
+PARTITION_NAME = re.compile(r"^events_raw_(\d{4})_(\d{2})$")
+
+PARTITIONS_QUERY = """
+SELECT child.relname
+FROM pg_inherits
+JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE pg_inherits.inhparent = 'events_raw'::regclass
+"""
+
+DEFAULT_MONTHS_QUERY = "SELECT DISTINCT date_trunc('month', time_created)::DATE FROM events_raw_default"
+
+
+def add_months(day, months):
+    """
+    Returns the first day of the month the given number of months after the month of day
+    """
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_month(name):
+    """
+    Returns the first day of the month a partition holds, None for tables not named by this command
+    """
+    match = PARTITION_NAME.match(name)
+    if not match:
+        return None
+    return date(int(match.group(1)), int(match.group(2)), 1)
+
+
+def expired(partitions, today, retention_months):
+    """
+    Returns the partitions whose events are all older than retention_months, oldest first
+    """
+    cutoff = add_months(today, -retention_months)
+    months = sorted((month, name) for name, month in ((name, partition_month(name)) for name in partitions) if month)
+    # a partition holds its month until the first day of the next one
+    return [name for month, name in months if add_months(month, 1) <= cutoff]
+
+
+def create_partitions(cursor, months, dry_run):
+    for month in months:
+        if dry_run:
+            print(f"would create the partition for {month:%Y-%m} unless it exists")
+            continue
+        cursor.execute("SELECT create_events_raw_partition(%s)", (month,))
+        created = cursor.fetchone()[0]
+        if created:
+            print(f"created {created}")
+
+
+def retire_partition(cursor, name, archive_dir, drop, dry_run):
+    table = sql.Identifier(name)
+    if dry_run:
+        action = f"archive to {archive_dir}" if archive_dir else "drop" if drop else "keep"
+        print(f"would detach {name} and {action} it")
+        return
+
+    cursor.execute(sql.SQL("ALTER TABLE events_raw DETACH PARTITION {}").format(table))
+    print(f"detached {name}")
+    if archive_dir:
+        path = os.path.join(archive_dir, f"{name}.csv.gz")
+        with gzip.open(path, "wb") as f:
+            cursor.copy_expert(sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER)").format(table), f)
+        print(f"archived {name} to {path}")
+    if archive_dir or drop:
+        cursor.execute(sql.SQL("DROP TABLE {}").format(table))
+        print(f"dropped {name}")
+
+
+def maintain(connection, today, months_ahead, retention_months=None, archive_dir=None, drop=False, dry_run=False):
+    with connection.cursor() as cursor:
+        cursor.execute(DEFAULT_MONTHS_QUERY)
+        backfilled = [row[0] for row in cursor.fetchall()]
+        upcoming = [add_months(today, months) for months in range(months_ahead + 1)]
+        create_partitions(cursor, sorted(set(backfilled + upcoming)), dry_run)
+
+        if retention_months is None:
+            return
+        cursor.execute(PARTITIONS_QUERY)
+        for name in expired([row[0] for row in cursor.fetchall()], today, retention_months):
+            retire_partition(cursor, name, archive_dir, drop, dry_run)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--months-ahead", type=int, default=3, help="future months to create partitions for")
+    parser.add_argument("--retention-months", type=int, help="detach partitions older than this (default keep all)")
+    parser.add_argument("--archive-dir", help="write detached partitions here as gzipped CSV, then drop them")
+    parser.add_argument("--drop", action="store_true", help="drop detached partitions without archiving them")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would be done")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        database=dbpool.DATABASE,
+        host=os.environ.get("FK_DB_HOST"),
+        port=os.environ.get("FK_DB_PORT", 5432),
+        user=os.environ.get("FK_DB_USER"),
+        password=os.environ.get("FK_DB_PW"),
+    )
+    # every partition is created, detached and dropped in a transaction of its own
+    connection.autocommit = True
+    try:
+        maintain(connection, date.today(), args.months_ahead, args.retention_months, args.archive_dir,
+                 args.drop, args.dry_run)
+    finally:
+        connection.close()
@@ -0,0 +1,53 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Replaces the changes table of migrate-metrics-tables.sql, run that first,
+-- with the commits table the github and gitlab workers write with each push
+-- and the changes view over it. Workers of earlier releases do not write
+-- commits, so:
+--
+--     1. stop the github and gitlab workers, events wait in RabbitMQ meanwhile
+--     2. psql -h <host> -U fourkeys -d fourkeys -f migrate-commits-table.sql
+--     3. deploy the new workers
+--
+-- The commits of the pushes stored so far are extracted from events_raw once.
+
+BEGIN;
+
+DROP TABLE IF EXISTS changes;
+DROP VIEW IF EXISTS changes_derived;
+
+CREATE TABLE commits (
+    source VARCHAR(50) NOT NULL,
+    change_id TEXT NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    repo TEXT,
+    PRIMARY KEY (change_id, source, time_created)
+);
+
+INSERT INTO commits (source, change_id, time_created, repo)
+SELECT
+    source,
+    commit->>'id',
+    date_trunc('second', (commit->>'timestamp')::timestamp),
+    COALESCE(metadata#>>'{repository,full_name}', metadata#>>'{project,path_with_namespace}')
+FROM events_raw e,
+LATERAL jsonb_array_elements(e.metadata->'commits') AS commit
+WHERE event_type = 'push'
+AND source IS NOT NULL AND commit->>'id' IS NOT NULL AND commit->>'timestamp' IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+CREATE INDEX idx_commits_time_created ON commits(time_created);
+
+CREATE OR REPLACE VIEW changes AS
+SELECT
+    source,
+    'push'::VARCHAR(50) AS event_type,
+    change_id,
+    time_created
+FROM commits;
+
+COMMIT;
+
+ANALYZE commits;
@@ -0,0 +1,38 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Adds the daily_metrics rollup the dashboard reads and the repositories of
+-- deployments and incidents it is rolled up by, see init-db.sql. Run
+-- migrate-incident-events.sql first, then:
+--
+--     1. stop the metrics refresher
+--     2. psql -h <host> -U fourkeys -d fourkeys -f migrate-daily-metrics.sql
+--     3. deploy the new refresher, its first run rolls up every day
+--     4. deploy the new dashboard
+--
+-- The workers are not affected and keep running.
+
+BEGIN;
+
+ALTER TABLE deployments ADD COLUMN repo TEXT NOT NULL DEFAULT '';
+ALTER TABLE incidents ADD COLUMN repo TEXT NOT NULL DEFAULT '';
+
+CREATE TABLE daily_metrics (
+    day DATE NOT NULL,
+    source VARCHAR(50) NOT NULL,
+    repo TEXT NOT NULL,
+    deployments INTEGER NOT NULL,
+    failed_deployments INTEGER NOT NULL,
+    lead_time_minutes DOUBLE PRECISION[] NOT NULL,
+    restore_time_hours DOUBLE PRECISION[] NOT NULL,
+    PRIMARY KEY (day, source, repo)
+);
+
+CREATE INDEX idx_incidents_time_created ON incidents(time_created);
+CREATE INDEX idx_incidents_changes ON incidents USING GIN (changes);
+
+-- without a watermark the next refresher run is a rebuild
+DELETE FROM refresh_watermarks;
+
+COMMIT;
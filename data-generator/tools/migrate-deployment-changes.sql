@@ -0,0 +1,78 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Moves deploy extraction from the metrics refresher to the workers, which
+-- write deploy_events and link deploys to their changes at ingest, see
+-- init-db.sql. Run migrate-metrics-tables.sql and migrate-commits-table.sql
+-- first. Workers of earlier releases do not write deploys, so:
+--
+--     1. stop the workers and the metrics refresher, events wait in RabbitMQ meanwhile
+--     2. psql -h <host> -U fourkeys -d fourkeys -f migrate-deployment-changes.sql
+--     3. deploy the new workers and refresher
+--
+-- The deploys stored so far are linked once here, the first run of the new
+-- refresher rebuilds deployments and incidents from the links.
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION commit_changes(commit_id TEXT) RETURNS TEXT[]
+LANGUAGE sql STABLE AS $$
+    SELECT ARRAY(
+        SELECT DISTINCT change->>'id'
+        FROM events_raw e,
+        LATERAL jsonb_array_elements(
+            CASE WHEN jsonb_typeof(e.metadata->'commits') = 'array' THEN e.metadata->'commits' END
+        ) AS change
+        WHERE e.id = commit_id AND change->>'id' IS NOT NULL
+    )
+$$;
+
+CREATE TABLE deployment_changes (
+    source VARCHAR(50) NOT NULL,
+    deploy_id VARCHAR(100) NOT NULL,
+    commit_id TEXT NOT NULL,
+    changes TEXT[] NOT NULL,
+    PRIMARY KEY (source, deploy_id, commit_id)
+);
+
+CREATE TABLE pending_deployment_links (
+    commit_id TEXT NOT NULL,
+    source VARCHAR(50) NOT NULL,
+    deploy_id VARCHAR(100) NOT NULL,
+    queued_at TIMESTAMP NOT NULL DEFAULT timezone('utc', now()),
+    PRIMARY KEY (commit_id, source, deploy_id)
+);
+
+-- deploys stored since the last refresher run
+INSERT INTO deploy_events (signature, source, deploy_id, time_created, main_commit, additional_commits, msg_id)
+SELECT signature, source, deploy_id, time_created, main_commit, additional_commits, msg_id
+FROM deploy_events_derived
+WHERE signature IS NOT NULL AND source IS NOT NULL AND main_commit IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+DROP VIEW deploy_events_derived;
+DROP INDEX IF EXISTS idx_de_main_commit;
+DROP INDEX IF EXISTS idx_de_additional_commits;
+
+CREATE TEMPORARY TABLE links ON COMMIT DROP AS
+SELECT DISTINCT d.source, d.deploy_id, c.commit_id
+FROM deploy_events d,
+LATERAL unnest(array_prepend(d.main_commit, d.additional_commits)) AS c (commit_id);
+
+INSERT INTO deployment_changes (source, deploy_id, commit_id, changes)
+SELECT source, deploy_id, commit_id, commit_changes(commit_id)
+FROM links
+WHERE EXISTS (SELECT 1 FROM events_raw e WHERE e.id = links.commit_id);
+
+INSERT INTO pending_deployment_links (commit_id, source, deploy_id)
+SELECT commit_id, source, deploy_id
+FROM links
+WHERE NOT EXISTS (SELECT 1 FROM events_raw e WHERE e.id = links.commit_id);
+
+-- without a watermark the next refresher run is a rebuild
+DELETE FROM refresh_watermarks;
+
+COMMIT;
+
+ANALYZE deployment_changes;
@@ -0,0 +1,23 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Creates the archive of complete payloads on a database created before the
+-- workers could project metadata. Run it with psql before enabling
+-- FK_METADATA_ARCHIVE on the workers:
+--
+--     psql -h <host> -U fourkeys -d fourkeys -f migrate-events-raw-archive.sql
+--
+-- Archived payloads are gzipped JSON which Postgres cannot decompress, read
+-- them with any gzip library, e.g. gzip.decompress(payload) in Python.
+
+CREATE TABLE IF NOT EXISTS events_raw_archive (
+    signature VARCHAR(255) NOT NULL PRIMARY KEY,
+    source VARCHAR(50),
+    event_type VARCHAR(50) NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    payload BYTEA NOT NULL  -- gzipped JSON
+);
+
+-- the payload is compressed by the workers already, don't let TOAST try again
+ALTER TABLE events_raw_archive ALTER COLUMN payload SET STORAGE EXTERNAL;
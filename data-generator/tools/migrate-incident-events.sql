@@ -0,0 +1,29 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Moves incident extraction from the metrics refresher to the workers, which
+-- write incident_events at ingest, see init-db.sql. Run
+-- migrate-deployment-changes.sql first. Workers of earlier releases do not
+-- write incident events, so:
+--
+--     1. stop the workers and the metrics refresher, events wait in RabbitMQ meanwhile
+--     2. psql -h <host> -U fourkeys -d fourkeys -f migrate-incident-events.sql
+--     3. deploy the new workers and refresher
+--
+-- incident_events already holds the events the refresher has seen, the
+-- others are extracted here with one last scan of events_raw.
+
+BEGIN;
+
+INSERT INTO incident_events (signature, source, incident_id, time_created, time_resolved, root_cause, bug, msg_id)
+SELECT signature, source, incident_id, time_created, time_resolved, root_cause, bug, msg_id
+FROM incident_events_derived
+WHERE signature IS NOT NULL AND source IS NOT NULL AND incident_id IS NOT NULL
+ON CONFLICT DO NOTHING;
+
+DROP VIEW incident_events_derived;
+
+CREATE INDEX idx_deployments_changes ON deployments USING GIN (changes);
+
+COMMIT;
@@ -0,0 +1,60 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Adds the quantile sketches of daily_metrics, see init-db.sql. Run
+-- migrate-daily-metrics.sql first, then:
+--
+--     1. stop the metrics refresher
+--     2. psql -h <host> -U fourkeys -d fourkeys -f migrate-metric-sketches.sql
+--     3. deploy the new refresher, its first run sketches every day
+--     4. deploy the new dashboard
+--
+-- The workers are not affected and keep running.
+
+BEGIN;
+
+ALTER TABLE daily_metrics ADD COLUMN lead_time_sketch JSONB, ADD COLUMN restore_time_sketch JSONB;
+
+CREATE OR REPLACE FUNCTION sketch_merge(sketches JSONB[]) RETURNS JSONB
+LANGUAGE sql IMMUTABLE AS $$
+    SELECT jsonb_build_object(
+        'alpha', (SELECT MAX((s->>'alpha')::DOUBLE PRECISION) FROM unnest(sketches) AS s),
+        'zeros', (SELECT COALESCE(SUM((s->>'zeros')::BIGINT), 0) FROM unnest(sketches) AS s),
+        'bins', (
+            SELECT COALESCE(jsonb_object_agg(bin, total), '{}'::JSONB)
+            FROM (
+                SELECT b.key AS bin, SUM(b.value::BIGINT) AS total
+                FROM unnest(sketches) AS s, jsonb_each_text(s->'bins') AS b
+                GROUP BY b.key
+            ) merged
+        )
+    )
+$$;
+
+CREATE OR REPLACE FUNCTION sketch_quantile(sketch JSONB, q DOUBLE PRECISION) RETURNS DOUBLE PRECISION
+LANGUAGE sql IMMUTABLE AS $$
+    WITH bins AS (
+        SELECT NULL::INTEGER AS bin, (sketch->>'zeros')::BIGINT AS count
+        UNION ALL
+        SELECT key::INTEGER, value::BIGINT FROM jsonb_each_text(sketch->'bins')
+    ),
+    ranked AS (
+        SELECT bin, SUM(count) OVER (ORDER BY bin NULLS FIRST) AS seen, SUM(count) OVER () AS total
+        FROM bins
+        WHERE count > 0
+    ),
+    gamma AS (
+        SELECT (1 + (sketch->>'alpha')::DOUBLE PRECISION) / (1 - (sketch->>'alpha')::DOUBLE PRECISION) AS g
+    )
+    SELECT CASE WHEN bin IS NULL THEN 0 ELSE 2 * power(g, bin) / (g + 1) END
+    FROM ranked, gamma
+    WHERE seen > floor(LEAST(GREATEST(q, 0), 1) * (total - 1))
+    ORDER BY bin NULLS FIRST
+    LIMIT 1
+$$;
+
+-- without a watermark the next refresher run is a rebuild
+DELETE FROM refresh_watermarks;
+
+COMMIT;
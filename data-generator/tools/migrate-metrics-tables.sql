@@ -0,0 +1,206 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Replaces the changes, deployments and incidents views of an existing
+-- database with the tables kept up to date by the metrics refresher, see
+-- init-db.sql. The tables are empty until the refresher runs: its first run
+-- finds no watermark and rebuilds them from all of events_raw, so deploy
+-- workers/metrics-refresher right after running
+--
+--     psql -h <host> -U fourkeys -d fourkeys -f migrate-metrics-tables.sql
+--
+-- The workers are not affected and can keep running.
+
+BEGIN;
+
+DROP VIEW IF EXISTS incidents;
+DROP VIEW IF EXISTS deployments;
+DROP VIEW IF EXISTS changes;
+
+CREATE INDEX idx_er_msg_id ON events_raw(msg_id);
+
+CREATE OR REPLACE VIEW changes_derived AS
+SELECT
+    source,
+    event_type,
+    commit->>'id' AS change_id,
+    date_trunc('second', (commit->>'timestamp')::timestamp) AS time_created,
+    e.msg_id
+FROM events_raw e,
+LATERAL jsonb_array_elements(e.metadata::jsonb->'commits') AS commit
+WHERE event_type = 'push';
+-- end view changes_derived
+
+-- successful deploys, one row per event (tekton: per gitrevision param)
+CREATE OR REPLACE VIEW deploy_events_derived AS
+with deploys_cloudbuild_github_gitlab as (
+    select
+        signature,
+        source,
+        id as deploy_id,
+        time_created,
+        case
+            when source = 'cloud_build' then metadata#>>'{substitutions, commit_sha}'
+            when source like 'github%' then metadata#>>'{deployment, sha}'
+            when source like 'gitlab%' then coalesce(
+                metadata#>>'{commit, id}',
+                substring(metadata->>'commit_url' from '.*commit\/(.*)')
+            )
+            when source = 'argocd' then metadata#>>'{commit_sha}'
+        end as main_commit,
+        case
+            when source like 'github%' then array(
+                select value->>'id'
+                from jsonb_array_elements(metadata::jsonb->'commits') as value
+            )
+            else array[]::text[]
+        end as additional_commits,
+        msg_id
+    from events_raw
+    where (
+        (source = 'cloud_build' and metadata#>>'{status}' = 'success')
+        or (source like 'github%' and event_type = 'deployment_status' and metadata#>>'{deployment_status,state}' = 'success')
+        or (source like 'gitlab%' and event_type = 'pipeline' and metadata#>>'{object_attributes, status}' = 'success')
+        or (source like 'gitlab%' and event_type = 'deployment' and metadata#>>'{status}' = 'success')
+        or (source = 'argocd' and metadata#>>'{status}' = 'success')
+    )
+),
+deploys_tekton as (
+    select
+        signature,
+        source,
+        id as deploy_id,
+        time_created,
+        param->>'value' as main_commit,
+        array[]::text[] as additional_commits,
+        msg_id
+    from events_raw,
+    lateral jsonb_array_elements(metadata::jsonb->'data'->'pipelinerun'->'spec'->'params') as param
+    where event_type = 'dev.tekton.event.pipelinerun.successful.v1'
+    and metadata::text like '%gitrevision%'
+    and param->>'name' = 'gitrevision'
+),
+deploys_circleci as (
+    select
+        signature,
+        source,
+        id as deploy_id,
+        time_created,
+        metadata#>>'{pipeline, vcs, revision}' as main_commit,
+        array[]::text[] as additional_commits,
+        msg_id
+    from events_raw
+    where source = 'circleci' and event_type = 'workflow-completed' and metadata#>>'{workflow, name}' like '%deploy%' and metadata#>>'{workflow, status}' = 'success'
+)
+select * from deploys_cloudbuild_github_gitlab
+union all
+select * from deploys_tekton
+union all
+select * from deploys_circleci;
+-- end view deploy_events_derived
+
+-- issue and incident events, one row per event
+CREATE OR REPLACE VIEW incident_events_derived AS
+SELECT
+    signature,
+    source,
+    CASE
+        WHEN source LIKE 'github%' THEN metadata#>>'{issue,number}'
+        WHEN source LIKE 'gitlab%' AND event_type = 'note' THEN metadata#>>'{object_attributes,noteable_id}'
+        WHEN source LIKE 'gitlab%' AND event_type = 'issue' THEN metadata#>>'{object_attributes,id}'
+        WHEN source LIKE 'pagerduty%' THEN metadata#>>'{event,data,id}'
+    END AS incident_id,
+    CASE
+        WHEN source LIKE 'github%' THEN (metadata#>>'{issue,created_at}')::timestamp
+        WHEN source LIKE 'gitlab%' THEN (metadata#>>'{object_attributes,created_at}')::timestamp
+        WHEN source LIKE 'pagerduty%' THEN (metadata#>>'{event,occurred_at}')::timestamp
+    END AS time_created,
+    CASE
+        WHEN source LIKE 'github%' THEN (metadata#>>'{issue,closed_at}')::timestamp
+        WHEN source LIKE 'gitlab%' THEN (metadata#>>'{object_attributes,closed_at}')::timestamp
+        WHEN source LIKE 'pagerduty%' THEN (metadata#>>'{event,occurred_at}')::timestamp
+    END AS time_resolved,
+    SUBSTRING(metadata::text FROM 'root cause: ([[:alnum:]]*)') AS root_cause,
+    CASE
+        WHEN source LIKE 'github%' THEN metadata#>>'{issue,labels}' LIKE '%name%' AND metadata#>>'{issue,labels}' LIKE '%"name":_"Incident"%'
+        WHEN source LIKE 'gitlab%' THEN metadata#>'{object_attributes,labels}' @> '[{"title":"Incident"}]'
+        WHEN source LIKE 'pagerduty%' THEN TRUE
+    END AS bug,
+    msg_id
+FROM events_raw
+WHERE event_type LIKE 'issue%' OR event_type LIKE 'incident%' OR (event_type = 'note' AND metadata#>>'{object_attributes,noteable_type}' = 'Issue');
+-- end view incident_events_derived
+
+-- Tables the dashboard reads, written by the metrics refresher only
+
+CREATE TABLE changes (
+    source VARCHAR(50) NOT NULL,
+    event_type VARCHAR(50) NOT NULL,
+    change_id TEXT NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    PRIMARY KEY (source, event_type, change_id, time_created)
+);
+
+CREATE TABLE deployments (
+    source VARCHAR(50) NOT NULL,
+    deploy_id VARCHAR(100) NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    main_commit TEXT NOT NULL,
+    changes TEXT[]
+);
+
+CREATE INDEX idx_deployments_deploy_id ON deployments(source, deploy_id);
+CREATE INDEX idx_deployments_time_created ON deployments(time_created);
+
+CREATE TABLE incidents (
+    source VARCHAR(50) NOT NULL,
+    incident_id TEXT NOT NULL,
+    time_created TIMESTAMP,
+    time_resolved TIMESTAMP,
+    changes TEXT[],
+    PRIMARY KEY (source, incident_id)
+);
+
+-- the deploy and incident events seen so far, deployments and incidents are
+-- aggregated from them when a later event affects them
+CREATE TABLE deploy_events (
+    signature VARCHAR(255) NOT NULL,
+    source VARCHAR(50) NOT NULL,
+    deploy_id VARCHAR(100) NOT NULL,
+    time_created TIMESTAMP NOT NULL,
+    main_commit TEXT NOT NULL,
+    additional_commits TEXT[] NOT NULL,
+    msg_id BIGINT,
+    PRIMARY KEY (signature, main_commit)
+);
+
+CREATE INDEX idx_de_deploy_id ON deploy_events(source, deploy_id);
+CREATE INDEX idx_de_main_commit ON deploy_events(main_commit);
+CREATE INDEX idx_de_additional_commits ON deploy_events USING GIN (additional_commits);
+CREATE INDEX idx_de_msg_id ON deploy_events(msg_id);
+
+CREATE TABLE incident_events (
+    signature VARCHAR(255) NOT NULL PRIMARY KEY,
+    source VARCHAR(50) NOT NULL,
+    incident_id TEXT NOT NULL,
+    time_created TIMESTAMP,
+    time_resolved TIMESTAMP,
+    root_cause TEXT,
+    bug BOOLEAN,
+    msg_id BIGINT
+);
+
+CREATE INDEX idx_ie_incident_id ON incident_events(source, incident_id);
+CREATE INDEX idx_ie_root_cause ON incident_events(root_cause);
+CREATE INDEX idx_ie_msg_id ON incident_events(msg_id);
+
+-- highest events_raw.msg_id a refresher run has seen, and when the tables were last rebuilt
+CREATE TABLE refresh_watermarks (
+    name VARCHAR(50) NOT NULL PRIMARY KEY,
+    msg_id BIGINT,
+    refreshed_at TIMESTAMP NOT NULL,
+    rebuilt_at TIMESTAMP
+);
+
+COMMIT;
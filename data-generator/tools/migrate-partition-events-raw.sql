@@ -0,0 +1,103 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Converts events_raw of a database created before it was partitioned into
+-- the monthly partitioned table of init-db.sql. The workers of this release
+-- insert with ON CONFLICT (signature, time_created), which needs the new
+-- unique index, so:
+--
+--     1. stop the workers, events wait in RabbitMQ meanwhile
+--     2. psql -h <host> -U fourkeys -d fourkeys -f migrate-partition-events-raw.sql
+--     3. deploy the new workers
+--     4. once the dashboard looks right: DROP TABLE events_raw_unpartitioned;
+--
+-- Every row is copied once, allow for the time and disk that takes.
+--
+-- The primary key becomes (id, time_created): from now on events that share
+-- an id but not a time_created are all stored, where the second of them was
+-- refused before.
+
+BEGIN;
+
+ALTER TABLE events_raw RENAME TO events_raw_unpartitioned;
+ALTER TABLE events_raw_unpartitioned RENAME CONSTRAINT events_raw_pkey TO events_raw_unpartitioned_pkey;
+ALTER INDEX idx_er_signature RENAME TO idx_er_signature_unpartitioned;
+
+CREATE TABLE events_raw (
+    id VARCHAR(100) NOT NULL,
+    event_type VARCHAR(50) NOT NULL,
+    metadata JSONB,
+    time_created TIMESTAMP NOT NULL,
+    signature VARCHAR(255),
+    msg_id BIGINT,
+    source VARCHAR(50),
+    PRIMARY KEY (id, time_created)
+) PARTITION BY RANGE (time_created);
+
+CREATE UNIQUE INDEX idx_er_signature ON events_raw(signature, time_created);
+CREATE INDEX idx_er_time_created ON events_raw(time_created);
+
+CREATE TABLE events_raw_default PARTITION OF events_raw DEFAULT;
+
+CREATE OR REPLACE FUNCTION create_events_raw_partition(day DATE) RETURNS TEXT
+LANGUAGE plpgsql AS $$
+DECLARE
+    first_day DATE := date_trunc('month', day)::DATE;
+    next_month DATE := (date_trunc('month', day) + INTERVAL '1 month')::DATE;
+    partition_name TEXT := 'events_raw_' || to_char(day, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- keeps workers from adding rows of this month to the default partition while they are moved
+    LOCK TABLE events_raw_default IN EXCLUSIVE MODE;
+    EXECUTE format('CREATE TABLE %I (LIKE events_raw INCLUDING DEFAULTS INCLUDING CONSTRAINTS)', partition_name);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM events_raw_default WHERE time_created >= %L AND time_created < %L RETURNING *) '
+        'INSERT INTO %I SELECT * FROM moved',
+        first_day, next_month, partition_name
+    );
+    EXECUTE format(
+        'ALTER TABLE events_raw ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, first_day, next_month
+    );
+    RETURN partition_name;
+END;
+$$;
+
+-- partitions for the whole history and the next three months, created empty so the copy is routed straight to them
+SELECT create_events_raw_partition(month::DATE)
+FROM generate_series(
+    date_trunc('month', COALESCE((SELECT MIN(time_created) FROM events_raw_unpartitioned), CURRENT_DATE)),
+    date_trunc('month', CURRENT_DATE) + INTERVAL '3 months',
+    INTERVAL '1 month'
+) AS month;
+
+INSERT INTO events_raw SELECT id, event_type, metadata, time_created, signature, msg_id, source
+FROM events_raw_unpartitioned;
+
+-- views are bound to the table they were created on, point them at the partitioned one
+DO $$
+DECLARE
+    dependent RECORD;
+BEGIN
+    FOR dependent IN
+        SELECT DISTINCT view_schema, view_name
+        FROM information_schema.view_table_usage
+        WHERE table_name = 'events_raw_unpartitioned'
+    LOOP
+        EXECUTE format(
+            'CREATE OR REPLACE VIEW %I.%I AS %s',
+            dependent.view_schema, dependent.view_name,
+            rtrim(replace(pg_get_viewdef(format('%I.%I', dependent.view_schema, dependent.view_name)::regclass),
+                          'events_raw_unpartitioned', 'events_raw'), E';\n ')
+        );
+    END LOOP;
+END;
+$$;
+
+COMMIT;
+
+ANALYZE events_raw;
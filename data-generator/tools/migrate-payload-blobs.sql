@@ -0,0 +1,20 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Creates the table of the content-addressed payload store on a database
+-- created before it existed. Run it with psql before setting
+-- FK_PAYLOAD_STORE=table on the workers:
+--
+--     psql -h <host> -U fourkeys -d fourkeys -f migrate-payload-blobs.sql
+--
+-- Blobs are gzipped JSON which Postgres cannot decompress, put a payload
+-- back together with blobstore.load(metadata->>'$payload', cursor=cursor).
+
+CREATE TABLE IF NOT EXISTS payload_blobs (
+    digest CHAR(64) NOT NULL PRIMARY KEY,
+    data BYTEA NOT NULL  -- gzipped canonical JSON
+);
+
+-- the data is compressed by the workers already, don't let TOAST try again
+ALTER TABLE payload_blobs ALTER COLUMN data SET STORAGE EXTERNAL;
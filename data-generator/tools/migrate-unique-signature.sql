@@ -0,0 +1,24 @@
+/*
+ * Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+ */
+
+-- Makes events_raw.signature unique on a database created before the workers
+-- switched to INSERT ... ON CONFLICT (signature) DO NOTHING. Run it with psql
+-- before deploying the new workers:
+--
+--     psql -h <host> -U fourkeys -d fourkeys -f migrate-unique-signature.sql
+--
+-- The index is built CONCURRENTLY so ingestion keeps running, which is why this
+-- script must not be wrapped in a transaction. Should a duplicate slip in while
+-- the index is being built, the build fails and leaves an invalid index behind:
+-- DROP INDEX idx_er_signature_unique and run the script again.
+
+-- keep the first copy of every event that was stored more than once
+DELETE FROM events_raw a
+USING events_raw b
+WHERE a.signature = b.signature
+  AND a.ctid > b.ctid;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_er_signature_unique ON events_raw(signature);
+DROP INDEX IF EXISTS idx_er_signature;
+ALTER INDEX idx_er_signature_unique RENAME TO idx_er_signature;
@@ -0,0 +1,114 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Reports how many bytes projecting event metadata saves, per source and event
+type, by projecting the metadata already stored in events_raw with the specs
+in shared/projection.py. Run it before enabling FK_METADATA_PROJECTION to see
+what it would save, with the same FK_DB_* settings as the workers:
+
+    FK_DB_HOST=localhost FK_DB_USER=fourkeys FK_DB_PW=... python3 tools/projection_report.py
+
+"stored" is the size of the metadata as it is stored now, "projected" what it
+would be with projection, "archived" the gzipped complete payloads that
+FK_METADATA_ARCHIVE would keep in events_raw_archive, and "blobs" what the
+payload store (FK_PAYLOAD_STORE) would hold: content already stored for
+earlier rows is counted once, for the event type that stored it first. Rows
+stored since projection was enabled show no further saving.
+"""
+
+import argparse
+import collections
+import gzip
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "shared"))
+
+import psycopg2  # noqa: E402
+
+import blobstore  # noqa: E402
+import dbpool  # noqa: E402
+import projection  # noqa: E402
+
+
+class Totals(object):
+    def __init__(self):
+        self.rows = 0
+        self.stored = 0
+        self.projected = 0
+        self.archived = 0
+        self.blobs = 0
+
+    def add(self, source, event_type, metadata, archive, digests):
+        stored = metadata.encode("utf-8")
+        self.rows += 1
+        self.stored += len(stored)
+        if projection.spec_for(source, event_type) is None:
+            self.projected += len(stored)
+            return
+        payload = json.loads(metadata)
+        self.projected += len(json.dumps(projection.project(source, event_type, payload)))
+        if archive:
+            self.archived += len(gzip.compress(stored, mtime=0))
+            _, blobs = blobstore.split(payload)
+            for digest, data in blobs.items():
+                if digest not in digests:
+                    digests.add(digest)
+                    self.blobs += len(data)
+
+
+def scan(connection, limit, archive):
+    totals = collections.defaultdict(Totals)
+    digests = set()
+    query = "SELECT source, event_type, metadata::text FROM events_raw WHERE metadata IS NOT NULL"
+    if limit:
+        query += f" LIMIT {int(limit)}"
+    # a named cursor streams the rows instead of loading the table in memory
+    with connection.cursor(name="projection_report") as cursor:
+        cursor.itersize = 1000
+        cursor.execute(query)
+        for source, event_type, metadata in cursor:
+            totals[(source, event_type)].add(source, event_type, metadata, archive, digests)
+    return totals
+
+
+def mib(size):
+    return f"{size / 2 ** 20:>10.2f} MiB"
+
+
+def print_report(totals):
+    print(f"{'source':<14} {'event type':<28} {'rows':>8} {'stored':>14} {'projected':>14} "
+          f"{'saved':>7} {'archived':>14} {'blobs':>14}")
+    overall = Totals()
+    for (source, event_type), total in sorted(totals.items(), key=lambda item: -item[1].stored):
+        saved = 1 - total.projected / total.stored if total.stored else 0
+        print(f"{source:<14} {event_type:<28} {total.rows:>8} {mib(total.stored)} {mib(total.projected)} "
+              f"{saved:>6.1%} {mib(total.archived)} {mib(total.blobs)}")
+        overall.rows += total.rows
+        overall.stored += total.stored
+        overall.projected += total.projected
+        overall.archived += total.archived
+        overall.blobs += total.blobs
+    saved = 1 - overall.projected / overall.stored if overall.stored else 0
+    print(f"{'total':<43} {overall.rows:>8} {mib(overall.stored)} {mib(overall.projected)} "
+          f"{saved:>6.1%} {mib(overall.archived)} {mib(overall.blobs)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, help="only look at this many rows")
+    parser.add_argument("--no-archive", action="store_true", help="skip estimating the archive and blob sizes (faster)")
+    args = parser.parse_args()
+
+    connection = psycopg2.connect(
+        database=dbpool.DATABASE,
+        host=os.environ.get("FK_DB_HOST"),
+        port=os.environ.get("FK_DB_PORT", 5432),
+        user=os.environ.get("FK_DB_USER"),
+        password=os.environ.get("FK_DB_PW"),
+    )
+    try:
+        print_report(scan(connection, args.limit, not args.no_archive))
+    finally:
+        connection.close()
@@ -38,23 +38,20 @@ if [[ ${git_system} != "1" && ${git_system} != "2" ]]; then
 fi
 
 purge_data="n"
-read -p "Do you want to delete existing data from the project? (y/n): " purge_data
+read -p "Do you want to delete existing data from the database? (y/n): " purge_data
 
 if [[ ${purge_data} == "y" ]]; then
 
     yesno="n"
-    read -p "Are you sure? This will delete ALL data that has been collected in project ${FOURKEYS_PROJECT} (y/n): " yesno
+    read -p "Are you sure? This will delete ALL data that has been collected in the ${FK_DB_HOST:-localhost} database (y/n): " yesno
     if [[ ${yesno} != "y" ]]; then
         echo "Aborting."
         exit 0
     fi
 
-    # drop and recreate the events_raw table and events_enriched table
-    # (why not delete the data? Because delete may fail due to https://stackoverflow.com/questions/43085896)
-    bq query --use_legacy_sql=false "DROP TABLE IF EXISTS ${FOURKEYS_PROJECT}.four_keys.events_raw"
-    bq query --use_legacy_sql=false "DROP TABLE IF EXISTS ${FOURKEYS_PROJECT}.four_keys.events_enriched"
-    bq mk --table -f ${FOURKEYS_PROJECT}:four_keys.events_raw ${DIR}/../../setup/events_raw_schema.json
-    bq mk --table -f ${FOURKEYS_PROJECT}:four_keys.events_enriched ${DIR}/../../setup/events_enriched_schema.json
+    # empty the events and everything derived from them, the next refresh starts over
+    PGPASSWORD="${FK_DB_PW}" psql -h "${FK_DB_HOST:-localhost}" -p "${FK_DB_PORT:-5432}" -U "${FK_DB_USER:-fourkeys}" -d fourkeys -c \
+        "TRUNCATE events_raw, events_enriched, events_raw_archive, payload_blobs, commits, deployments, incidents, deploy_events, deployment_changes, pending_deployment_links, incident_events, daily_metrics, refresh_watermarks"
 fi
 
 # insert new data
@@ -65,8 +62,6 @@ elif [[ ${git_system} == "2" ]]; then
 fi
 python3 ${DIR}/../generate_data.py --vc_system="$vcs_name"
 
-# run scheduled queries
-for table in changes deployments incidents; do
-    scheduled_query=$(bq ls --transfer_config --transfer_location=US | grep "four_keys_$table" -m 1 | awk '{print $1;}')
-    bq mk --transfer_run --run_time "$(date --iso-8601=seconds)" $scheduled_query
-done
\ No newline at end of file
+# refresh the metrics tables now rather than waiting for the metrics-refresher service,
+# events still on their way through the workers are picked up by its next run
+PYTHONPATH="${DIR}/../../shared" python3 ${DIR}/../../workers/metrics-refresher/main.py --once
@@ -0,0 +1,82 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Replays recorded webhook deliveries through the event handler's /batch endpoint.
+
+Input files are NDJSON, one {"headers": {...}, "body": "<raw body>"} object per
+line, exactly as the deliveries were received (GitHub and GitLab both let you
+export recent deliveries; older history can be captured from a proxy or logs).
+Deliveries are sent in chunks so months of history are imported with a few
+hundred requests instead of one request per event.
+
+    WEBHOOK=http://localhost:8000 python3 tools/replay_webhooks.py deliveries.ndjson
+"""
+
+import argparse
+import json
+import os
+import sys
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+
+def read_chunks(paths, chunk_size):
+    """
+    Yields lists of at most chunk_size non-empty lines from the given files
+    """
+    chunk = []
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                chunk.append(line.rstrip(b"\n"))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+    if chunk:
+        yield chunk
+
+
+def post_chunk(batch_url, chunk):
+    request = Request(batch_url, b"\n".join(chunk), headers={"Content-Type": "application/x-ndjson"})
+    try:
+        with urlopen(request) as response:
+            return response.getcode(), json.loads(response.read())
+    except HTTPError as e:
+        return e.code, json.loads(e.read() or b"{}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="+", help="NDJSON files of recorded deliveries")
+    parser.add_argument(
+        "--chunk_size",
+        "-c",
+        type=int,
+        default=5000,
+        help="deliveries sent per request; default=5000",
+    )
+    args = parser.parse_args()
+
+    webhook_url = os.environ.get("WEBHOOK")
+    if not webhook_url:
+        print("Error: please ensure the following environment variables are set: WEBHOOK")
+        sys.exit(1)
+    batch_url = webhook_url.rstrip("/") + "/batch"
+
+    sent = published = 0
+    for chunk in read_chunks(args.files, args.chunk_size):
+        status, result = post_chunk(batch_url, chunk)
+        for rejected in result.get("rejected", []):
+            print(f"delivery {sent + rejected['line']} rejected: {rejected['error']}")
+
+        published += result.get("published", 0)
+        if status != 200:
+            # part of the failed chunk may have been published, the workers drop the duplicates on resume
+            print(f"Error: event handler returned {status} after publishing {published} deliveries, "
+                  f"resume from delivery {sent + 1}")
+            sys.exit(1)
+        sent += len(chunk)
+
+    print(f"{published} of {sent} deliveries published")
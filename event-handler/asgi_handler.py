@@ -0,0 +1,254 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Asynchronous (ASGI) entry point for the event handler.
+
+Performs the same source authorization and signature verification as the
+Flask app in event_handler.py and publishes messages in the same format, but
+serves every request on a single event loop with an asyncio AMQP client so
+one process can hold thousands of concurrent webhook connections. Run with:
+
+    uvicorn asgi_handler:app --host 0.0.0.0 --port $PORT
+"""
+
+import asyncio
+import atexit
+import os
+import sys
+from urllib.parse import parse_qsl
+
+import aio_pika
+
+from messages import compress_body, create_message_properties, machine_id
+from publisher import BrokerPublisher, EXCHANGE
+import jsonlog
+import sources
+import spool
+
+log = jsonlog.get_logger('event-handler')
+
+BROKER_ADDRESS = os.environ.get("FK_BROKER_ADDRESS")
+BROKER_TIMEOUT = float(os.environ.get("FK_BROKER_TIMEOUT", 10))
+# events are spooled here while the broker is unavailable, spooling is disabled when unset
+SPOOL_PATH = os.environ.get("FK_SPOOL_PATH")
+SPOOL_SIZE = int(os.environ.get("FK_SPOOL_SIZE_BYTES", 256 * 1024 * 1024))
+# bodies of at least this many bytes are published gzip compressed, 0 disables compression
+COMPRESS_MIN_SIZE = int(os.environ.get("FK_COMPRESS_MIN_BYTES", 0))
+COMPRESS_LEVEL = int(os.environ.get("FK_COMPRESS_LEVEL", 1))
+
+
+class AsyncBrokerPublisher:
+    """
+    Publishes messages over a single robust (auto-reconnecting) connection.
+
+    The channel runs in publisher confirm mode; concurrent publishes from many
+    requests are pipelined on it and confirmed as the broker acks them.
+    """
+
+    def __init__(self, broker_address, exchange_name=EXCHANGE):
+        self.broker_address = broker_address
+        self.exchange_name = exchange_name
+        self.connection = None
+        self.exchange = None
+        self._lock = asyncio.Lock()
+
+    async def connect(self):
+        async with self._lock:
+            if self.exchange is not None:
+                return
+            self.connection = await aio_pika.connect_robust(host=self.broker_address, timeout=BROKER_TIMEOUT)
+            channel = await self.connection.channel(publisher_confirms=True)
+            self.exchange = await channel.declare_exchange(self.exchange_name, aio_pika.ExchangeType.DIRECT)
+
+    async def publish(self, routing_key, body, properties=None):
+        if self.exchange is None:
+            await self.connect()
+        await self.exchange.publish(
+            aio_pika.Message(body=body, **(properties or {})), routing_key=routing_key, timeout=BROKER_TIMEOUT
+        )
+
+    async def close(self):
+        if self.connection is not None:
+            await self.connection.close()
+        self.connection = None
+        self.exchange = None
+
+
+publisher = AsyncBrokerPublisher(BROKER_ADDRESS)
+
+event_spool = None
+if SPOOL_PATH:
+    # spooled events are replayed from a background thread with a blocking publisher
+    event_spool = spool.start_spool(SPOOL_PATH, SPOOL_SIZE, BrokerPublisher(BROKER_ADDRESS, timeout=BROKER_TIMEOUT))
+    atexit.register(event_spool.close)
+log.info(f'Starting async event_handler node with machine_id {machine_id}')
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def app(scope, receive, send):
+    """
+    ASGI application; handles the lifespan protocol and webhook requests on "/"
+    """
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+
+    if scope["type"] != "http":
+        return
+
+    try:
+        if scope["path"] != "/":
+            raise HTTPError(404, "Not Found")
+        if scope["method"] not in ("GET", "POST"):
+            raise HTTPError(405, "Method Not Allowed")
+        await index(scope, receive)
+        await respond(send, 204)
+    except HTTPError as e:
+        await respond(send, e.status, e.message)
+    except ClientDisconnected:
+        pass
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                await publisher.connect()
+            except Exception as e:
+                # the first publish retries, a broker outage must not stop the server from starting
+                log.warning('unable to connect to the broker at startup', errors=e)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await publisher.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def index(scope, receive):
+    """
+    Receives event data from a webhook, checks if the source is authorized,
+    checks if the signature is verified, and then sends the data to the broker.
+    """
+    headers = request_headers(scope)
+
+    # Check if the source is authorized
+    source = sources.get_source(headers)
+
+    if source not in sources.AUTHORIZED_SOURCES:
+        raise HTTPError(403, f"Source not authorized: {source}")
+
+    auth_source = sources.AUTHORIZED_SOURCES[source]
+    args = dict(parse_qsl(scope.get("query_string", b"").decode("latin-1")))
+    signature_sources = {**headers, **args}
+    signature = signature_sources.get(auth_source.signature, None)
+
+    if not signature:
+        raise HTTPError(403, "Signature not found in request headers")
+
+    content_length = headers.get("Content-Length")
+    if content_length and content_length.isdigit() and int(content_length) > auth_source.max_body_size:
+        raise HTTPError(413, f"Request body exceeds {auth_source.max_body_size} bytes")
+
+    # Verify the signature while the body is streamed in
+    signed_body = sources.SignedBody(auth_source)
+    try:
+        await read_body(receive, signed_body)
+    except sources.PayloadTooLarge as e:
+        raise HTTPError(413, str(e))
+
+    if not signed_body.verify(signature):
+        raise HTTPError(403, "Signature does not match expected signature")
+
+    body = signed_body.body()
+
+    # Remove the Auth header so we do not publish it
+    if "Authorization" in headers:
+        del headers["Authorization"]
+
+    published = await publish_to_broker(source, body, headers)
+
+    # Flush the stdout to avoid log buffering.
+    sys.stdout.flush()
+    if not published:
+        # let the sender retry the delivery later rather than losing it
+        raise HTTPError(503, "Unable to publish the event")
+
+
+async def publish_to_broker(source, msg, headers):
+    """
+    Publishes the message to the message broker, or to the spool while the
+    broker is unavailable. Returns False if the message could not be kept.
+    """
+    msg, properties = compress_body(msg, create_message_properties(headers, msg), COMPRESS_MIN_SIZE, COMPRESS_LEVEL)
+
+    # while older messages wait in the spool new ones queue up behind them to keep their order
+    if event_spool is not None and event_spool.pending():
+        return await spool_message(source, msg, properties)
+
+    try:
+        await publisher.publish(routing_key=source, body=msg, properties=properties)
+        log.debug('published message', message_id=properties['message_id'], source=source, size=len(msg))
+        return True
+
+    except Exception as e:
+        log.warning('unable to publish message', message_id=properties['message_id'], errors=e)
+
+    if event_spool is not None:
+        return await spool_message(source, msg, properties)
+    return False
+
+
+async def spool_message(source, msg, properties):
+    try:
+        # the spool writes to disk, which must not stall the other requests on the loop
+        await asyncio.to_thread(event_spool.append, source, msg, properties)
+        log.info('spooled message', message_id=properties['message_id'], source=source, size=len(msg))
+        return True
+    except spool.SpoolFull as e:
+        log.error('unable to spool message', message_id=properties['message_id'], errors=e)
+        return False
+
+
+def request_headers(scope):
+    """
+    Returns the request headers with names capitalized the same way the Flask
+    handler (werkzeug) presents them, so workers see identical header names
+    """
+    return {
+        name.decode("latin-1").title(): value.decode("latin-1")
+        for name, value in scope["headers"]
+    }
+
+
+async def read_body(receive, signed_body):
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        signed_body.update(message.get("body", b""))
+        more_body = message.get("more_body", False)
+
+
+async def respond(send, status, text=""):
+    body = text.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", b"text/plain; charset=utf-8"),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
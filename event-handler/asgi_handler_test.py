@@ -0,0 +1,147 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import asyncio
+import hmac
+import json
+import threading
+from hashlib import sha1, sha256
+
+import mock
+
+import asgi_handler
+import sources
+
+
+def call(method="POST", path="/", headers=None, body=b"", query_string=b""):
+    """
+    Drives the ASGI app with a single request and returns (status, body)
+    """
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": query_string,
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+    }
+    messages = [
+        {"type": "http.request", "body": body[:2], "more_body": True},
+        {"type": "http.request", "body": body[2:], "more_body": False},
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi_handler.app(scope, receive, send))
+    return sent[0]["status"], sent[1]["body"]
+
+
+def test_unauthorized_source():
+    status, body = call(body=b"Hello")
+    assert status == 403
+    assert b"Source not authorized" in body
+
+
+def test_missing_signature():
+    status, body = call(headers={"User-Agent": "GitHub-Hookshot"})
+    assert status == 403
+    assert b"Signature not found" in body
+
+
+def test_unsupported_method():
+    status, _ = call(method="PUT")
+    assert status == 405
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_unverified_signature():
+    status, _ = call(headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": "foobar"})
+    assert status == 403
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_verified_signature_is_published():
+    body = json.dumps({"hello": "world"}).encode()
+    signature = "sha1=" + hmac.new(b"foo", body, sha1).hexdigest()
+    publish = mock.AsyncMock()
+
+    with mock.patch.object(asgi_handler.publisher, "publish", publish):
+        status, _ = call(
+            headers={
+                "User-Agent": "GitHub-Hookshot",
+                "X-Hub-Signature": signature,
+                "X-GitHub-Event": "push",
+                "Authorization": "Bearer secret",
+            },
+            body=body,
+        )
+
+    assert status == 204
+    publish.assert_awaited_once()
+    kwargs = publish.await_args.kwargs
+    assert kwargs["routing_key"] == "github"
+    assert kwargs["body"] == body
+    properties = kwargs["properties"]
+    assert properties["type"] == "fk.webhook.v2"
+    assert int(properties["message_id"]) > 0
+    assert "X-Fk-Publish-Time" in properties["headers"]
+    del properties["headers"]["X-Fk-Publish-Time"]
+    assert properties["headers"].pop("X-Fk-Fingerprint") == sha256(body).hexdigest()
+    assert properties["headers"] == {
+        "User-Agent": "GitHub-Hookshot",
+        "X-Hub-Signature": signature,
+        "X-Github-Event": "push",
+    }
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_TOKEN": "t0ken"}))
+def test_signature_from_query_string():
+    publish = mock.AsyncMock()
+
+    with mock.patch.object(asgi_handler.publisher, "publish", publish):
+        status, _ = call(
+            headers={"Ce-Type": "dev.tekton.event"},
+            body=b"{}",
+            query_string=b"tekton-secret=t0ken",
+        )
+
+    assert status == 204
+    assert publish.await_args.kwargs["routing_key"] == "tekton"
+
+
+@mock.patch.dict(
+    "sources.AUTHORIZED_SOURCES",
+    sources.build_registry({"FK_GITHUB_SECRET": "foo", "FK_MAX_BODY_BYTES": "4"}),
+)
+def test_oversized_streamed_body_rejected():
+    body = b"Hello"
+    signature = "sha1=" + hmac.new(b"foo", body, sha1).hexdigest()
+    publish = mock.AsyncMock()
+
+    with mock.patch.object(asgi_handler.publisher, "publish", publish):
+        status, response = call(headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature}, body=body)
+
+    assert status == 413
+    assert b"exceeds 4 bytes" in response
+    publish.assert_not_awaited()
+
+
+def test_spooled_off_the_event_loop():
+    event_spool = mock.Mock()
+    event_spool.pending.return_value = False
+    spooled_on = []
+    event_spool.append.side_effect = lambda *args: spooled_on.append(threading.current_thread())
+    publish = mock.AsyncMock(side_effect=ConnectionError("broker down"))
+
+    async def publish_to_broker():
+        return threading.current_thread(), await asgi_handler.publish_to_broker("github", b"{}", {})
+
+    with mock.patch.object(asgi_handler, "event_spool", event_spool), \
+            mock.patch.object(asgi_handler.publisher, "publish", publish):
+        handler_thread, published = asyncio.run(publish_to_broker())
+
+    assert published
+    assert spooled_on and spooled_on[0] is not handler_thread
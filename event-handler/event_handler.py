@@ -12,26 +12,62 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import atexit
 import json
 import os
 import sys
-import random
-from datetime import datetime
 
-from flask import abort, Flask, request
-from snowflake import SnowflakeGenerator
+from flask import abort, Flask, jsonify, request
 import pika
 
+from messages import compress_body, create_message_properties, machine_id
+from publish_queue import PublishQueue
+from publisher import BrokerPublisher
+import jsonlog
 import sources
+import spool
 
-# it's ok for multiple nodes to use the same machine_id but a bit of randomness should help avoid collisions
-machine_id = random.randint(0, 1023)
-generator = SnowflakeGenerator(machine_id)
+log = jsonlog.get_logger('event-handler')
 
 BROKER_ADDRESS = os.environ.get("FK_BROKER_ADDRESS")
+# size of the chunks the request body is read and verified in
+READ_CHUNK_SIZE = 64 * 1024
+# number of deliveries published per broker transaction by the /batch endpoint
+BATCH_PUBLISH_SIZE = int(os.environ.get("FK_BATCH_PUBLISH_SIZE", 500))
+
+BROKER_TIMEOUT = float(os.environ.get("FK_BROKER_TIMEOUT", 10))
+# events are spooled here while the broker is unavailable, spooling is disabled when unset
+SPOOL_PATH = os.environ.get("FK_SPOOL_PATH")
+SPOOL_SIZE = int(os.environ.get("FK_SPOOL_SIZE_BYTES", 256 * 1024 * 1024))
+# bodies of at least this many bytes are published gzip compressed, 0 disables compression
+COMPRESS_MIN_SIZE = int(os.environ.get("FK_COMPRESS_MIN_BYTES", 0))
+COMPRESS_LEVEL = int(os.environ.get("FK_COMPRESS_LEVEL", 1))
+# when set, requests only enqueue events and dedicated threads publish them
+PUBLISH_QUEUE_SIZE = int(os.environ.get("FK_PUBLISH_QUEUE_SIZE", 0))
+PUBLISH_THREADS = int(os.environ.get("FK_PUBLISH_THREADS", 2))
+# block, reject (503) or spill (to the spool) when the publish queue is full
+PUBLISH_QUEUE_FULL = os.environ.get("FK_PUBLISH_QUEUE_FULL", "block")
+
+# connections are opened lazily, one per handler thread, and reused across requests
+publisher = BrokerPublisher(BROKER_ADDRESS, timeout=BROKER_TIMEOUT)
+atexit.register(publisher.close)
+
+event_spool = None
+if SPOOL_PATH:
+    event_spool = spool.start_spool(SPOOL_PATH, SPOOL_SIZE, BrokerPublisher(BROKER_ADDRESS, timeout=BROKER_TIMEOUT))
+    atexit.register(event_spool.close)
+
+publish_queue = None
+if PUBLISH_QUEUE_SIZE > 0:
+    publish_queue = PublishQueue(publisher, PUBLISH_QUEUE_SIZE, threads=PUBLISH_THREADS,
+                                 full_policy=PUBLISH_QUEUE_FULL, event_spool=event_spool,
+                                 block_timeout=BROKER_TIMEOUT)
+    publish_queue.start()
+    # registered after the spool so it is stopped, and flushed, before the spool closes
+    atexit.register(publish_queue.stop)
 
 app = Flask(__name__)
-print(f'Starting event_handler node with machine_id {machine_id}')
+log.info(f'Starting event_handler node with machine_id {machine_id}')
 
 
 @app.route("/", methods=["GET", "POST"])
@@ -54,56 +90,154 @@ def index():
     if not signature:
         abort(403, "Signature not found in request headers")
 
-    body = request.data
+    if request.content_length and request.content_length > auth_source.max_body_size:
+        abort(413, f"Request body exceeds {auth_source.max_body_size} bytes")
 
-    # Verify the signature
-    verify_signature = auth_source.verification
-    if not verify_signature(signature, body):
+    # Verify the signature while the body is streamed in
+    signed_body = sources.SignedBody(auth_source)
+    try:
+        for chunk in iter(lambda: request.stream.read(READ_CHUNK_SIZE), b""):
+            signed_body.update(chunk)
+    except sources.PayloadTooLarge as e:
+        abort(413, str(e))
+
+    if not signed_body.verify(signature):
         abort(403, "Signature does not match expected signature")
 
+    body = signed_body.body()
+
     # Remove the Auth header so we do not publish it
     headers = dict(request.headers)
     if "Authorization" in headers:
         del headers["Authorization"]
 
-    publish_to_broker(source, body, headers)
+    published = publish_to_broker(source, body, headers)
 
     # Flush the stdout to avoid log buffering.
     sys.stdout.flush()
+    if not published:
+        # let the sender retry the delivery later rather than losing it
+        abort(503, "Unable to publish the event")
     return "", 204
 
 
-def publish_to_broker(source, msg, headers):
+@app.route("/batch", methods=["POST"])
+def batch():
+    """
+    Receives historical deliveries for replay or backfill as NDJSON, one
+    {"headers": {...}, "body": "<raw webhook body>"} object per line. Every
+    delivery is authorized and verified exactly like a live webhook, valid
+    ones are published in batches confirmed by the broker in one round trip.
+    """
+    received = 0
+    published = 0
+    rejected = []
+    pending = []
+
+    for line_number, line in enumerate(request.stream, start=1):
+        if not line.strip():
+            continue
+        received += 1
+        try:
+            source, body, headers = verify_delivery(json.loads(line))
+        except Exception as e:
+            rejected.append({"line": line_number, "error": str(e)})
+            continue
+
+        body, properties = compress_body(body, create_message_properties(headers, body), COMPRESS_MIN_SIZE, COMPRESS_LEVEL)
+        pending.append((source, body, pika.BasicProperties(**properties)))
+        if len(pending) >= BATCH_PUBLISH_SIZE:
+            if not publish_batch(pending):
+                return jsonify(received=received, published=published, rejected=rejected), 503
+            published += len(pending)
+            pending = []
+
+    if pending:
+        if not publish_batch(pending):
+            return jsonify(received=received, published=published, rejected=rejected), 503
+        published += len(pending)
+
+    sys.stdout.flush()
+    return jsonify(received=received, published=published, rejected=rejected), 200
+
+
+def verify_delivery(delivery):
     """
-    Publishes the message to the message broker
+    Checks a single replayed delivery the same way index() checks a webhook,
+    returning (source, body, headers) or raising ValueError
+    """
+    headers = {name.title(): str(value) for name, value in delivery["headers"].items()}
+    body = delivery["body"].encode("utf-8")
+
+    source = sources.get_source(headers)
+    if source not in sources.AUTHORIZED_SOURCES:
+        raise ValueError(f"Source not authorized: {source}")
+
+    auth_source = sources.AUTHORIZED_SOURCES[source]
+    signature = headers.get(auth_source.signature, None)
+    if not signature:
+        raise ValueError("Signature not found in request headers")
+
+    if len(body) > auth_source.max_body_size:
+        raise ValueError(f"Request body exceeds {auth_source.max_body_size} bytes")
+
+    if not auth_source.verification(signature, body):
+        raise ValueError("Signature does not match expected signature")
+
+    headers.pop("Authorization", None)
+    return source, body, headers
+
+
+def publish_batch(messages):
+    """
+    Publishes (source, body, properties) tuples in one broker transaction,
+    returns False if the batch could not be published
     """
     try:
-        connection = pika.BlockingConnection(pika.ConnectionParameters(BROKER_ADDRESS))
-        channel = connection.channel()
-        exchange = 'fk_events'
-        channel.exchange_declare(exchange=exchange, exchange_type='direct')
-        message = json.loads(msg)
-        message['attributes'] = {}
-        message['attributes']['headers'] = headers
-        message['publishTime'] = str(datetime.utcnow())
+        publisher.publish_batch(messages)
+        log.debug('published batch', size=len(messages))
+        return True
+    except Exception as e:
+        log.warning('unable to publish batch', errors=e)
+        return False
 
-        assign_id(message)
-        print(f'publishing message with id={message["message_id"]} to {exchange}.{source}')
 
-        channel.basic_publish(
-            exchange=exchange, routing_key=source, body=json.dumps(message).encode('utf-8')
-        )
+def publish_to_broker(source, msg, headers):
+    """
+    Publishes the message to the message broker (or hands it to the publish
+    queue), or to the spool while the broker is unavailable. Returns False if
+    the message could not be kept.
+    """
+    msg, properties = compress_body(msg, create_message_properties(headers, msg), COMPRESS_MIN_SIZE, COMPRESS_LEVEL)
 
-        print(f"Published message: {json.dumps(message)}")
+    if publish_queue is not None:
+        return publish_queue.put(source, msg, properties)
+
+    # while older messages wait in the spool new ones queue up behind them to keep their order
+    if event_spool is not None and event_spool.pending():
+        return spool_message(source, msg, properties)
+
+    try:
+        publisher.publish(routing_key=source, body=msg, properties=pika.BasicProperties(**properties))
+        log.debug('published message', message_id=properties['message_id'], source=source, size=len(msg))
+        return True
 
     except Exception as e:
-        # Log any exceptions to stackdriver
-        entry = dict(severity="WARNING", message=e)
-        print(entry)
+        log.warning('unable to publish message', message_id=properties['message_id'], errors=e)
+
+    if event_spool is not None:
+        return spool_message(source, msg, properties)
+    return False
 
 
-def assign_id(msg):
-    msg['message_id'] = next(generator)
+def spool_message(source, msg, properties):
+    try:
+        event_spool.append(source, msg, properties)
+        log.info('spooled message', message_id=properties['message_id'], source=source, size=len(msg))
+        return True
+    except spool.SpoolFull as e:
+        log.error('unable to spool message', message_id=properties['message_id'], errors=e)
+        return False
 
 
 if __name__ == "__main__":
@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import gzip
 import hmac
-from hashlib import sha1
+import json
+from hashlib import sha1, sha256
 
 import event_handler
+import sources
+import spool
 
 import mock
 import pytest
@@ -40,7 +44,7 @@ def test_missing_signature(client):
     assert r.status_code == 403
 
 
-@mock.patch("sources.get_secret", mock.MagicMock(return_value=b"foo"))
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
 def test_unverified_signature(client):
     r = client.post(
             "/",
@@ -53,9 +57,9 @@ def test_unverified_signature(client):
     assert r.status_code == 403
 
 
-@mock.patch("sources.get_secret", mock.MagicMock(return_value=b"foo"))
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
 @mock.patch(
-    "event_handler.publish_to_pubsub", mock.MagicMock(return_value=True)
+    "event_handler.publish_to_broker", mock.MagicMock(return_value=True)
 )
 def test_verified_signature(client):
     signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
@@ -67,10 +71,9 @@ def test_verified_signature(client):
     assert r.status_code == 204
 
 
-@mock.patch("sources.get_secret", mock.MagicMock(return_value=b"foo"))
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
 def test_data_sent_to_pubsub(client):
     signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
-    event_handler.publish_to_broker = mock.MagicMock(return_value=True)
     headers = {
         "User-Agent": "GitHub-Hookshot",
         "Host": "localhost",
@@ -78,9 +81,151 @@ def test_data_sent_to_pubsub(client):
         "X-Hub-Signature": signature,
     }
 
-    r = client.post("/", data="Hello", headers=headers)
+    with mock.patch.object(event_handler, "publish_to_broker", return_value=True) as publish_to_broker:
+        r = client.post("/", data="Hello", headers=headers)
 
-    event_handler.publish_to_broker.assert_called_with(
+    publish_to_broker.assert_called_with(
         "github", b"Hello", headers
     )
     assert r.status_code == 204
+
+
+def _delivery(body, secret=b"foo"):
+    signature = "sha1=" + hmac.new(secret, body.encode(), sha1).hexdigest()
+    return json.dumps({
+        "headers": {"user-agent": "GitHub-Hookshot/replay", "x-hub-signature": signature, "X-GitHub-Event": "push"},
+        "body": body,
+    })
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_batch_publishes_verified_deliveries(client):
+    lines = [
+        _delivery('{"n": 1}'),
+        "",
+        _delivery('{"n": 2}', secret=b"wrong"),
+        '{"headers": {"User-Agent": "curl"}, "body": "{}"}',
+        "not json",
+        _delivery('{"n": 3}'),
+    ]
+    with mock.patch.object(event_handler.publisher, "publish_batch") as publish_batch:
+        r = client.post("/batch", data="\n".join(lines))
+
+    assert r.status_code == 200
+    assert r.get_json()["received"] == 5
+    assert r.get_json()["published"] == 2
+    assert [e["line"] for e in r.get_json()["rejected"]] == [3, 4, 5]
+
+    messages = publish_batch.call_args.args[0]
+    assert [(source, body) for source, body, _ in messages] == [("github", b'{"n": 1}'), ("github", b'{"n": 3}')]
+    assert messages[0][2].headers["X-Github-Event"] == "push"
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_batch_publishes_in_chunks(client):
+    lines = [_delivery('{"n": %d}' % i) for i in range(5)]
+    with mock.patch.object(event_handler, "BATCH_PUBLISH_SIZE", 2), \
+            mock.patch.object(event_handler.publisher, "publish_batch") as publish_batch:
+        r = client.post("/batch", data="\n".join(lines))
+
+    assert r.status_code == 200
+    assert [len(call.args[0]) for call in publish_batch.call_args_list] == [2, 2, 1]
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_batch_reports_progress_when_broker_fails(client):
+    lines = [_delivery('{"n": %d}' % i) for i in range(3)]
+    with mock.patch.object(event_handler, "BATCH_PUBLISH_SIZE", 2), \
+            mock.patch.object(event_handler.publisher, "publish_batch", side_effect=[None, Exception("down")]):
+        r = client.post("/batch", data="\n".join(lines))
+
+    assert r.status_code == 503
+    assert r.get_json()["published"] == 2
+
+
+@mock.patch.dict(
+    "sources.AUTHORIZED_SOURCES",
+    sources.build_registry({"FK_GITHUB_SECRET": "foo", "FK_GITHUB_MAX_BODY_BYTES": "4"}),
+)
+def test_oversized_body_rejected(client):
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+    with mock.patch.object(event_handler, "publish_to_broker") as publish:
+        r = client.post(
+            "/",
+            data="Hello",
+            headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature},
+        )
+
+    assert r.status_code == 413
+    publish.assert_not_called()
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_broker_unavailable_without_spool(client):
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+    with mock.patch.object(event_handler.publisher, "publish", side_effect=Exception("down")), \
+            mock.patch.object(event_handler, "event_spool", None):
+        r = client.post("/", data="Hello", headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature})
+
+    assert r.status_code == 503
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_broker_unavailable_spools_event(client, tmp_path):
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+    event_spool = spool.Spool(str(tmp_path / "events.spool"), 4096)
+    with mock.patch.object(event_handler.publisher, "publish", side_effect=Exception("down")) as publish, \
+            mock.patch.object(event_handler, "event_spool", event_spool):
+        headers = {"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature}
+        first = client.post("/", data="Hello", headers=headers)
+        second = client.post("/", data="Hello", headers=headers)
+
+    assert first.status_code == second.status_code == 204
+    # once events are spooled, later ones queue behind them instead of trying the broker
+    assert publish.call_count == 1
+    messages, _ = event_spool.peek(10)
+    assert [(source, body) for source, body, _ in messages] == [("github", b"Hello"), ("github", b"Hello")]
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_event_handed_to_publish_queue(client):
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+    queue = mock.MagicMock()
+    queue.put.return_value = False
+    with mock.patch.object(event_handler.publisher, "publish") as publish, \
+            mock.patch.object(event_handler, "publish_queue", queue):
+        r = client.post("/", data="Hello", headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature})
+
+    # a full queue is answered with 503, and the request thread never waits on the broker
+    assert r.status_code == 503
+    publish.assert_not_called()
+    assert queue.put.call_args.args[:2] == ("github", b"Hello")
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_large_body_published_compressed(client):
+    body = json.dumps({"commits": [{"message": "fix"}] * 100}).encode()
+    signature = "sha1=" + hmac.new(b"foo", body, sha1).hexdigest()
+    with mock.patch.object(event_handler.publisher, "publish") as publish, \
+            mock.patch.object(event_handler, "COMPRESS_MIN_SIZE", 1024):
+        r = client.post("/", data=body, headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature})
+
+    assert r.status_code == 204
+    kwargs = publish.call_args.kwargs
+    assert kwargs["properties"].content_encoding == "gzip"
+    assert gzip.decompress(kwargs["body"]) == body
+
+
+@mock.patch.dict("sources.AUTHORIZED_SOURCES", sources.build_registry({"FK_GITHUB_SECRET": "foo"}))
+def test_fingerprint_of_uncompressed_body_published(client):
+    body = json.dumps({"commits": [{"message": "fix"}] * 100}).encode()
+    signature = "sha1=" + hmac.new(b"foo", body, sha1).hexdigest()
+    fingerprints = []
+    for _ in range(2):
+        with mock.patch.object(event_handler.publisher, "publish") as publish, \
+                mock.patch.object(event_handler, "COMPRESS_MIN_SIZE", 1024):
+            client.post("/", data=body, headers={"User-Agent": "GitHub-Hookshot", "X-Hub-Signature": signature})
+        fingerprints.append(publish.call_args.kwargs["properties"].headers["X-Fk-Fingerprint"])
+
+    # a retried delivery gets the same fingerprint although its message id and publish time differ
+    assert fingerprints[0] == fingerprints[1] == sha256(body).hexdigest()
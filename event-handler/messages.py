@@ -0,0 +1,63 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import gzip
+import hashlib
+import random
+import time
+from datetime import datetime
+
+from snowflake import SnowflakeGenerator
+
+# it's ok for multiple nodes to use the same machine_id but a bit of randomness should help avoid collisions
+machine_id = random.randint(0, 1023)
+generator = SnowflakeGenerator(machine_id)
+
+# The webhook body is published untouched as the message body, everything
+# the handler knows about the delivery travels in the message properties.
+# Keep in sync with shared/rabbit.py which decodes this envelope.
+ENVELOPE_TYPE = 'fk.webhook.v2'
+PUBLISH_TIME_HEADER = 'X-Fk-Publish-Time'
+FINGERPRINT_HEADER = 'X-Fk-Fingerprint'
+GZIP_ENCODING = 'gzip'
+
+
+def fingerprint(body):
+    """
+    Returns the fingerprint of a webhook body, identical for every delivery
+    and retry of the same webhook. The workers use it as the event signature
+    instead of hashing the decoded message again (see shared.create_unique_id).
+    """
+    return hashlib.sha256(body).hexdigest()
+
+
+def create_message_properties(headers, body):
+    """
+    Returns the AMQP properties (as keyword arguments usable by both pika and
+    aio-pika) for a verified webhook delivered with the given headers and body
+    """
+    message_headers = dict(headers)
+    message_headers[PUBLISH_TIME_HEADER] = str(datetime.utcnow())
+    message_headers[FINGERPRINT_HEADER] = fingerprint(body)
+
+    return {
+        'type': ENVELOPE_TYPE,
+        'content_type': headers.get('Content-Type', 'application/json'),
+        'message_id': str(next(generator)),
+        'timestamp': int(time.time()),
+        'headers': message_headers,
+    }
+
+
+def compress_body(body, properties, min_size, level=1):
+    """
+    Gzips message bodies of at least min_size bytes (0 disables compression)
+    and marks them with the content_encoding property, returns the body and
+    properties to publish
+    """
+    if not min_size or len(body) < min_size:
+        return body, properties
+
+    compressed = gzip.compress(body, compresslevel=level, mtime=0)
+    if len(compressed) >= len(body):
+        return body, properties
+    return compressed, dict(properties, content_encoding=GZIP_ENCODING)
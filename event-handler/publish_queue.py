@@ -0,0 +1,148 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import queue
+import threading
+import time
+
+import pika
+
+import jsonlog
+import spool
+
+log = jsonlog.get_logger('event-handler')
+
+# what put() does when the queue is full
+BLOCK = 'block'
+REJECT = 'reject'
+SPILL = 'spill'
+FULL_POLICIES = (BLOCK, REJECT, SPILL)
+
+_STOP = object()
+
+
+class PublishQueue(object):
+    """
+    Bounded in-process queue between the request threads and the broker.
+
+    Request threads only enqueue; dedicated publisher threads drain the queue
+    and publish whatever has accumulated in one broker transaction. Messages
+    that cannot be published are moved to the spool when there is one,
+    otherwise the batch is retried until the broker accepts it.
+    """
+
+    def __init__(self, publisher, size, threads=2, full_policy=BLOCK, event_spool=None,
+                 batch_size=100, block_timeout=10, max_delay=30):
+        if full_policy not in FULL_POLICIES:
+            raise ValueError(f'unknown queue full policy "{full_policy}", expected one of {FULL_POLICIES}')
+        if full_policy == SPILL and event_spool is None:
+            raise ValueError('the spill policy needs a spool, set FK_SPOOL_PATH')
+
+        self.publisher = publisher
+        self.queue = queue.Queue(maxsize=size)
+        self.full_policy = full_policy
+        self.spool = event_spool
+        self.batch_size = batch_size
+        self.block_timeout = block_timeout
+        self.max_delay = max_delay
+        self.stopped = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._drain, name=f'publisher-{i}', daemon=True) for i in range(threads)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, routing_key, body, properties):
+        """
+        Enqueues a message, returns False if it could not be accepted
+        """
+        item = (routing_key, body, properties)
+        try:
+            if self.full_policy == BLOCK:
+                self.queue.put(item, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(item)
+            return True
+        except queue.Full:
+            if self.full_policy != SPILL:
+                return False
+
+        try:
+            self.spool.append(*item)
+            return True
+        except spool.SpoolFull as e:
+            log.error('unable to spool message', errors=e)
+            return False
+
+    def stop(self, timeout=10):
+        """
+        Publishes what is still queued and stops the publisher threads, gives
+        up on whatever is left after timeout seconds
+        """
+        # failed batches are spooled or dropped instead of retried from here on
+        self.stopped.set()
+        deadline = time.monotonic() + timeout
+        try:
+            for _ in self.threads:
+                self.queue.put(_STOP, timeout=max(deadline - time.monotonic(), 0))
+        except queue.Full:
+            log.error('publisher threads did not take the queue in time')
+        for thread in self.threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        with self.queue.mutex:
+            left = sum(item is not _STOP for item in self.queue.queue)
+        if left:
+            log.error('dropping messages still queued at shutdown', size=left)
+
+    def _drain(self):
+        while True:
+            batch = []
+            item = self.queue.get()
+            while item is not _STOP:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._publish(batch)
+            if item is _STOP:
+                return
+
+    def _publish(self, batch):
+        delay = 1
+        while True:
+            # while older messages wait in the spool new ones queue up behind them to keep their order
+            if self.spool is not None and self.spool.pending() and self._spool(batch):
+                return
+            try:
+                self.publisher.publish_batch(
+                    (routing_key, body, pika.BasicProperties(**properties))
+                    for routing_key, body, properties in batch
+                )
+                log.debug('published batch', size=len(batch))
+                return
+            except Exception as e:
+                log.warning('unable to publish batch', size=len(batch), errors=e)
+
+            if self.spool is not None and self._spool(batch):
+                return
+            if self.stopped.wait(delay):
+                log.error('dropping batch, the publisher is stopping', size=len(batch))
+                return
+            delay = min(delay * 2, self.max_delay)
+
+    def _spool(self, batch):
+        index = 0
+        try:
+            for index, item in enumerate(batch):
+                self.spool.append(*item)
+        except spool.SpoolFull as e:
+            log.error('unable to spool batch', size=len(batch) - index, errors=e)
+            del batch[:index]
+            return False
+        return True
@@ -0,0 +1,83 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+from unittest import mock
+
+import pytest
+
+import publish_queue
+import spool
+
+
+def properties(message_id):
+    return {"type": "fk.webhook.v2", "message_id": str(message_id), "headers": {}}
+
+
+def recording_publisher():
+    publisher = mock.MagicMock()
+    publisher.batches = []
+    publisher.publish_batch.side_effect = lambda messages: publisher.batches.append(
+        [(routing_key, body) for routing_key, body, _ in messages]
+    )
+    return publisher
+
+
+def test_queued_messages_published_in_batches():
+    publisher = recording_publisher()
+    queue = publish_queue.PublishQueue(publisher, 10, threads=1, batch_size=2)
+    for i in range(3):
+        assert queue.put("github", b"body %d" % i, properties(i))
+
+    queue.start()
+    queue.stop()
+
+    assert publisher.batches == [[("github", b"body 0"), ("github", b"body 1")], [("github", b"body 2")]]
+
+
+def test_full_queue_rejected():
+    queue = publish_queue.PublishQueue(mock.MagicMock(), 1, full_policy=publish_queue.REJECT)
+
+    assert queue.put("github", b"one", properties(1))
+    assert not queue.put("github", b"two", properties(2))
+
+
+def test_full_queue_spills_to_spool(tmp_path):
+    event_spool = spool.Spool(str(tmp_path / "events.spool"), 4096)
+    queue = publish_queue.PublishQueue(mock.MagicMock(), 1, full_policy=publish_queue.SPILL, event_spool=event_spool)
+
+    assert queue.put("github", b"one", properties(1))
+    assert queue.put("github", b"two", properties(2))
+    assert event_spool.peek(10)[0] == [("github", b"two", properties(2))]
+
+
+def test_spill_needs_spool():
+    with pytest.raises(ValueError):
+        publish_queue.PublishQueue(mock.MagicMock(), 1, full_policy=publish_queue.SPILL)
+
+
+def test_failed_batch_spooled(tmp_path):
+    event_spool = spool.Spool(str(tmp_path / "events.spool"), 4096)
+    publisher = mock.MagicMock()
+    publisher.publish_batch.side_effect = Exception("broker down")
+    queue = publish_queue.PublishQueue(publisher, 10, threads=1, event_spool=event_spool)
+    queue.put("gitlab", b"one", properties(1))
+
+    queue.start()
+    queue.stop()
+
+    assert event_spool.peek(10)[0] == [("gitlab", b"one", properties(1))]
+
+
+def test_stop_gives_up_on_down_broker_with_full_queue():
+    publisher = mock.MagicMock()
+    publisher.publish_batch.side_effect = Exception("broker down")
+    queue = publish_queue.PublishQueue(publisher, 2, threads=1, batch_size=1)
+    queue.start()
+    for i in range(3):
+        queue.put("github", b"body %d" % i, properties(i))
+
+    with mock.patch.object(publish_queue, "log") as log:
+        queue.stop(timeout=0.5)
+
+    assert not queue.threads[0].is_alive()
+    dropped = [call.kwargs["size"] for call in log.error.call_args_list if call.args[0].startswith("dropping")]
+    assert sum(dropped) == 3
@@ -0,0 +1,144 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import threading
+import time
+
+import pika
+import pika.exceptions
+
+import jsonlog
+
+log = jsonlog.get_logger('event-handler')
+
+EXCHANGE = 'fk_events'
+
+# errors after which the cached connection is thrown away and the publish retried
+RECOVERABLE_ERRORS = (
+    pika.exceptions.AMQPConnectionError,
+    pika.exceptions.AMQPChannelError,
+    pika.exceptions.StreamLostError,
+    pika.exceptions.ConnectionWrongStateError,
+    pika.exceptions.ChannelWrongStateError,
+)
+
+
+class BrokerPublisher:
+    """
+    Publishes messages to the broker over long-lived connections.
+
+    pika connections are not thread safe, so every thread (e.g. each gunicorn
+    worker thread) lazily opens its own connection and keeps it for the life
+    of the thread. Each connection carries two channels: a confirm-mode channel
+    for single messages and a transactional channel used by publish_batch, so
+    a whole batch is acknowledged by the broker in one round trip.
+    """
+
+    def __init__(self, broker_address, exchange_name=EXCHANGE, max_retries=3, retry_delay=0.5, timeout=300):
+        self.broker_address = broker_address
+        self.exchange_name = exchange_name
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # seconds to wait on an unreachable or blocked (e.g. out of memory) broker
+        self.timeout = timeout
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = set()
+
+    def publish(self, routing_key, body, properties=None):
+        """
+        Publishes a single message and waits for the broker to confirm it
+        """
+        def send(channel):
+            channel.basic_publish(
+                exchange=self.exchange_name, routing_key=routing_key, body=body, properties=properties
+            )
+
+        self._run('confirm', send)
+
+    def publish_batch(self, messages):
+        """
+        Publishes a list of (routing_key, body, properties) tuples in a single
+        transaction, either all of them reach the broker or none do
+        """
+        messages = list(messages)
+        if not messages:
+            return
+
+        def send(channel):
+            for routing_key, body, properties in messages:
+                channel.basic_publish(
+                    exchange=self.exchange_name, routing_key=routing_key, body=body, properties=properties
+                )
+            channel.tx_commit()
+
+        self._run('tx', send)
+
+    def close(self):
+        """
+        Closes every connection opened by any thread
+        """
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for connection in connections:
+            try:
+                if connection.is_open:
+                    connection.close()
+            except Exception as e:
+                log.warning('error closing broker connection', errors=e)
+
+    def _run(self, mode, send):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                send(self._channel(mode))
+                return
+            except RECOVERABLE_ERRORS as e:
+                log.warning(f'publish failed, attempt {attempt} of {self.max_retries}', errors=e)
+                self._reset()
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.retry_delay)
+
+    def _channel(self, mode):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or not connection.is_open:
+            connection = self._connect()
+            self._local.connection = connection
+            self._local.channels = {}
+
+        channel = self._local.channels.get(mode)
+        if channel is None or not channel.is_open:
+            channel = connection.channel()
+            channel.exchange_declare(exchange=self.exchange_name, exchange_type='direct')
+            if mode == 'confirm':
+                channel.confirm_delivery()
+            else:
+                channel.tx_select()
+            self._local.channels[mode] = channel
+        return channel
+
+    def _connect(self):
+        parameters = pika.ConnectionParameters(
+            host=self.broker_address,
+            heartbeat=600,
+            socket_timeout=self.timeout,
+            blocked_connection_timeout=self.timeout
+        )
+        connection = pika.BlockingConnection(parameters)
+        with self._lock:
+            self._connections.add(connection)
+        return connection
+
+    def _reset(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        self._local.channels = {}
+        if connection is None:
+            return
+        with self._lock:
+            self._connections.discard(connection)
+        try:
+            if connection.is_open:
+                connection.close()
+        except Exception:
+            pass
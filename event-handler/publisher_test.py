@@ -0,0 +1,87 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import threading
+from unittest import mock
+
+import pika.exceptions
+import pytest
+
+from publisher import BrokerPublisher
+
+
+@pytest.fixture
+def mock_pika():
+    with mock.patch("publisher.pika") as mocked:
+        mocked.BlockingConnection.side_effect = lambda *args, **kwargs: mock.MagicMock(is_open=True)
+        yield mocked
+
+
+def test_connection_reused_across_publishes(mock_pika):
+    publisher = BrokerPublisher("localhost", retry_delay=0)
+
+    publisher.publish("github", b"one")
+    publisher.publish("github", b"two")
+
+    assert mock_pika.BlockingConnection.call_count == 1
+    channel = publisher._local.channels["confirm"]
+    channel.confirm_delivery.assert_called_once()
+    channel.exchange_declare.assert_called_once_with(exchange="fk_events", exchange_type="direct")
+    assert channel.basic_publish.call_count == 2
+
+
+def test_one_connection_per_thread(mock_pika):
+    publisher = BrokerPublisher("localhost", retry_delay=0)
+
+    threads = [threading.Thread(target=publisher.publish, args=("gitlab", b"hi")) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert mock_pika.BlockingConnection.call_count == 3
+    assert len(publisher._connections) == 3
+
+
+def test_reconnects_after_connection_lost(mock_pika):
+    publisher = BrokerPublisher("localhost", retry_delay=0)
+    publisher.publish("github", b"one")
+    stale_channel = publisher._local.channels["confirm"]
+    stale_channel.basic_publish.side_effect = pika.exceptions.StreamLostError
+
+    publisher.publish("github", b"two")
+
+    assert mock_pika.BlockingConnection.call_count == 2
+    assert publisher._local.channels["confirm"] is not stale_channel
+    publisher._local.channels["confirm"].basic_publish.assert_called_once()
+
+
+def test_gives_up_after_max_retries(mock_pika):
+    mock_pika.BlockingConnection.side_effect = pika.exceptions.AMQPConnectionError
+    publisher = BrokerPublisher("localhost", max_retries=2, retry_delay=0)
+
+    with pytest.raises(pika.exceptions.AMQPConnectionError):
+        publisher.publish("github", b"one")
+
+    assert mock_pika.BlockingConnection.call_count == 2
+
+
+def test_publish_batch_commits_once(mock_pika):
+    publisher = BrokerPublisher("localhost", retry_delay=0)
+
+    publisher.publish_batch([("github", b"one", None), ("gitlab", b"two", None)])
+
+    channel = publisher._local.channels["tx"]
+    channel.tx_select.assert_called_once()
+    assert channel.basic_publish.call_count == 2
+    channel.tx_commit.assert_called_once()
+
+
+def test_close_closes_all_connections(mock_pika):
+    publisher = BrokerPublisher("localhost", retry_delay=0)
+    publisher.publish("github", b"one")
+    connection = publisher._local.connection
+
+    publisher.close()
+
+    connection.close.assert_called_once()
+    assert not publisher._connections
@@ -13,108 +13,177 @@
 # limitations under the License.
 
 import hmac
-from hashlib import sha1, sha256
 import os
 
+import jsonlog
+
+log = jsonlog.get_logger('event-handler')
+
+# GitHub caps webhook payloads at 25 MB, nothing legitimate is larger
+DEFAULT_MAX_BODY_SIZE = 25 * 1024 * 1024
+
 
 class EventSource(object):
     """
     A source of event data being delivered to the webhook
     """
 
-    def __init__(self, signature_header, verification_func):
+    def __init__(self, signature_header, verification_func, max_body_size=DEFAULT_MAX_BODY_SIZE):
         self.signature = signature_header
         self.verification = verification_func
+        self.max_body_size = max_body_size
 
 
-def github_verification(signature, body):
-    """
-    Verifies that the signature received from the github event is accurate
-    """
+class PayloadTooLarge(Exception):
+    pass
 
-    expected_signature = "sha1="
-    try:
-        # Get secret from Cloud Secret Manager
-        secret = get_secret("GITHUB_SECRET")
-        # Compute the hashed signature
-        hashed = hmac.new(secret.encode(), body, 'sha1')
-        expected_signature += hashed.hexdigest()
 
-    except Exception as e:
-        print(e)
+class SignedBody(object):
+    """
+    Collects a request body chunk by chunk as it is read from the client,
+    feeding every chunk to the source's verifier and refusing to hold more
+    than the source's maximum body size.
+    """
 
-    return hmac.compare_digest(signature, expected_signature)
+    def __init__(self, auth_source):
+        self.max_body_size = auth_source.max_body_size
+        self.state = auth_source.verification.new()
+        self.chunks = []
+        self.size = 0
 
+    def update(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_body_size:
+            self.chunks = []
+            raise PayloadTooLarge(f"Request body exceeds {self.max_body_size} bytes")
+        self.state.update(chunk)
+        self.chunks.append(chunk)
 
-def circleci_verification(signature, body):
-    """
-    Verifies that the signature received from the circleci event is accurate
-    """
+    def verify(self, signature):
+        return self.state.verify(signature)
 
-    expected_signature = "v1="
-    try:
-        # Get secret from Cloud Secret Manager
-        secret = get_secret("CIRCLECI_SECRET")
-        # Compute the hashed signature
-        hashed = hmac.new(secret, body, 'sha256')
-        expected_signature += hashed.hexdigest()
+    def body(self):
+        return b"".join(self.chunks)
 
-    except Exception as e:
-        print(e)
 
-    return hmac.compare_digest(signature, expected_signature)
+class HmacVerifier(object):
+    """
+    Verifies "<prefix><hex digest>" HMAC signatures of a request body.
 
+    The HMAC key schedule for every active secret is computed once, when the
+    verifier is built; each request works on copies of those pre-keyed
+    objects. Several secrets can be active at once so a secret can be rotated
+    without rejecting deliveries signed with the previous one.
+    """
 
-def pagerduty_verification(signatures, body):
+    def __init__(self, secrets, digestmod, prefix, multiple_signatures=False):
+        self.prefix = prefix
+        self.multiple_signatures = multiple_signatures
+        self.keyed = [hmac.new(_to_bytes(secret), digestmod=digestmod) for secret in secrets]
+
+    def new(self):
+        """
+        Returns a fresh verification state to be fed the request body
+        """
+        return HmacState(self, [keyed.copy() for keyed in self.keyed])
+
+    def __call__(self, signature, body):
+        hashes = []
+        for keyed in self.keyed:
+            hashed = keyed.copy()
+            hashed.update(body)
+            hashes.append(hashed)
+        return self.matches(signature, hashes)
+
+    def matches(self, signature, hashes):
+        if not signature:
+            return False
+
+        if self.multiple_signatures:
+            candidates = [candidate.strip() for candidate in signature.split(",")]
+        else:
+            candidates = (signature,)
+
+        # compare against every secret so timing does not reveal which one matched
+        matched = False
+        for hashed in hashes:
+            expected_signature = self.prefix + hashed.hexdigest()
+            for candidate in candidates:
+                matched |= hmac.compare_digest(candidate, expected_signature)
+        return matched
+
+
+class HmacState(object):
+    def __init__(self, verifier, hashes):
+        self.verifier = verifier
+        self.hashes = hashes
+
+    def update(self, chunk):
+        for hashed in self.hashes:
+            hashed.update(chunk)
+
+    def verify(self, signature):
+        return self.verifier.matches(signature, self.hashes)
+
+
+class TokenVerifier(object):
     """
-    Verifies that the signature received from the pagerduty event is accurate
+    Verifies that the token sent with the request matches one of the active tokens
     """
 
-    if not signatures:
-        raise Exception("Pagerduty signature is empty")
+    def __init__(self, tokens):
+        self.tokens = [_to_bytes(token) for token in tokens]
+
+    def new(self):
+        return TokenState(self)
 
-    signature_list = signatures.split(",")
+    def __call__(self, token, body):
+        return self.new().verify(token)
 
-    if len(signature_list) == 0:
-        raise Exception("Pagerduty signature list is empty")
 
-    expected_signature = "v1="
-    try:
-        secret = get_secret("PAGER_DUTY_SECRET")
+class TokenState(object):
+    def __init__(self, verifier):
+        self.verifier = verifier
 
-        # Compute the hashed signature
-        hashed = hmac.new(secret, body, 'sha256')
-        expected_signature += hashed.hexdigest()
+    def update(self, chunk):
+        pass
 
-    except Exception as e:
-        print(e)
+    def verify(self, token):
+        if not token:
+            return False
 
-    if expected_signature in signature_list:
-        return True
-    else:
-        return False
+        matched = False
+        for expected in self.verifier.tokens:
+            matched |= hmac.compare_digest(_to_bytes(token), expected)
+        return matched
 
 
-def simple_token_verification(token, body):
+def get_secrets(secret_name, environ=os.environ):
     """
-    Verifies that the token received from the event is accurate
+    Returns every active value of a secret: FK_<NAME> and, while a secret is
+    being rotated, FK_<NAME>_2, FK_<NAME>_3, ...
     """
-    if not token:
-        raise Exception("Token is empty")
-    secret = os.environ.get('FK_TOKEN')
+    computed_name = f'FK_{secret_name}'
+    secrets = []
+    secret = environ.get(computed_name)
+    index = 2
+    while secret is not None:
+        secrets.append(secret)
+        secret = environ.get(f'{computed_name}_{index}')
+        index += 1
 
-    return secret == token
+    if not secrets:
+        log.warning(f'Unable to find secret for {computed_name}, requests from this source will be rejected')
+    return secrets
 
 
-def get_secret(secret_name):
+def get_max_body_size(source, environ=os.environ):
     """
-    Returns secret payload from Cloud Secret Manager
+    Returns the largest request body accepted from a source, configured with
+    FK_<SOURCE>_MAX_BODY_BYTES or, for every source, FK_MAX_BODY_BYTES
     """
-    computed_name = f'FK_{secret_name}'
-    secret = os.environ.get(computed_name)
-    if secret is None:
-        raise Exception(f'Unable to find secret for {computed_name}')
-    return secret
+    default = int(environ.get('FK_MAX_BODY_BYTES', DEFAULT_MAX_BODY_SIZE))
+    return int(environ.get(f'FK_{source.upper()}_MAX_BODY_BYTES', default))
 
 
 def get_source(headers):
@@ -139,20 +208,39 @@ def get_source(headers):
     return headers.get("User-Agent")
 
 
-AUTHORIZED_SOURCES = {
-    "github": EventSource(
-        "X-Hub-Signature", github_verification
-        ),
-    "gitlab": EventSource(
-        "X-Gitlab-Token", simple_token_verification
-        ),
-    "tekton": EventSource(
-        "tekton-secret", simple_token_verification
-        ),
-    "circleci": EventSource(
-        "Circleci-Signature", circleci_verification
-        ),
-    "pagerduty": EventSource(
-        "X-Pagerduty-Signature", pagerduty_verification
-        ),
-}
+def build_registry(environ=os.environ):
+    """
+    Builds the verifier for every authorized source from the secrets in the
+    environment. Done once at startup, not per request.
+    """
+    tokens = get_secrets("TOKEN", environ)
+    return {
+        "github": EventSource(
+            "X-Hub-Signature", HmacVerifier(get_secrets("GITHUB_SECRET", environ), "sha1", "sha1="),
+            get_max_body_size("github", environ)
+            ),
+        "gitlab": EventSource(
+            "X-Gitlab-Token", TokenVerifier(tokens),
+            get_max_body_size("gitlab", environ)
+            ),
+        "tekton": EventSource(
+            "tekton-secret", TokenVerifier(tokens),
+            get_max_body_size("tekton", environ)
+            ),
+        "circleci": EventSource(
+            "Circleci-Signature", HmacVerifier(get_secrets("CIRCLECI_SECRET", environ), "sha256", "v1="),
+            get_max_body_size("circleci", environ)
+            ),
+        "pagerduty": EventSource(
+            "X-Pagerduty-Signature",
+            HmacVerifier(get_secrets("PAGER_DUTY_SECRET", environ), "sha256", "v1=", multiple_signatures=True),
+            get_max_body_size("pagerduty", environ)
+            ),
+    }
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode()
+
+
+AUTHORIZED_SOURCES = build_registry()
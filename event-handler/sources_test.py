@@ -0,0 +1,80 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import hmac
+from hashlib import sha1, sha256
+
+import pytest
+
+import sources
+
+
+def test_github_signature_verified():
+    registry = sources.build_registry({"FK_GITHUB_SECRET": "foo"})
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+
+    assert registry["github"].verification(signature, b"Hello")
+    assert not registry["github"].verification(signature, b"Goodbye")
+
+
+def test_rotated_secrets_are_all_accepted():
+    registry = sources.build_registry({"FK_GITHUB_SECRET": "new", "FK_GITHUB_SECRET_2": "old"})
+
+    for secret in (b"new", b"old"):
+        signature = "sha1=" + hmac.new(secret, b"Hello", sha1).hexdigest()
+        assert registry["github"].verification(signature, b"Hello")
+
+    signature = "sha1=" + hmac.new(b"other", b"Hello", sha1).hexdigest()
+    assert not registry["github"].verification(signature, b"Hello")
+
+
+def test_missing_secret_rejects_everything():
+    registry = sources.build_registry({})
+
+    assert not registry["github"].verification("sha1=", b"Hello")
+    assert not registry["gitlab"].verification("", b"Hello")
+
+
+def test_circleci_signature_verified():
+    registry = sources.build_registry({"FK_CIRCLECI_SECRET": "foo"})
+    signature = "v1=" + hmac.new(b"foo", b"Hello", sha256).hexdigest()
+
+    assert registry["circleci"].verification(signature, b"Hello")
+
+
+def test_pagerduty_signature_list_verified():
+    registry = sources.build_registry({"FK_PAGER_DUTY_SECRET": "foo"})
+    signature = "v1=" + hmac.new(b"foo", b"Hello", sha256).hexdigest()
+
+    assert registry["pagerduty"].verification(f"v1=deadbeef,{signature}", b"Hello")
+    assert not registry["pagerduty"].verification("v1=deadbeef", b"Hello")
+
+
+def test_verification_state_fed_in_chunks():
+    registry = sources.build_registry({"FK_GITHUB_SECRET": "foo"})
+    signature = "sha1=" + hmac.new(b"foo", b"Hello", sha1).hexdigest()
+
+    state = registry["github"].verification.new()
+    state.update(b"He")
+    state.update(b"llo")
+
+    assert state.verify(signature)
+
+
+def test_token_verified():
+    registry = sources.build_registry({"FK_TOKEN": "t0ken"})
+
+    assert registry["gitlab"].verification("t0ken", b"")
+    assert registry["tekton"].verification("t0ken", b"")
+    assert not registry["gitlab"].verification("nope", b"")
+
+
+def test_signed_body_enforces_max_size():
+    registry = sources.build_registry({"FK_GITHUB_SECRET": "foo", "FK_MAX_BODY_BYTES": "8", "FK_GITLAB_MAX_BODY_BYTES": "2"})
+    assert registry["gitlab"].max_body_size == 2
+
+    signed_body = sources.SignedBody(registry["github"])
+    signed_body.update(b"Hello")
+
+    with pytest.raises(sources.PayloadTooLarge):
+        signed_body.update(b"World")
+    assert signed_body.body() == b""
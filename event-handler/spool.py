@@ -0,0 +1,232 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import fcntl
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+import pika
+
+import jsonlog
+
+log = jsonlog.get_logger('event-handler')
+
+MAGIC = b'FKSPOOL1'
+# magic, read offset, write offset
+HEADER = struct.Struct('<8sQQ')
+HEADER_SIZE = 64
+# payload length, crc32 of the payload
+RECORD = struct.Struct('<II')
+KEY_LENGTH = struct.Struct('<H')
+PROPERTIES_LENGTH = struct.Struct('<I')
+
+
+class SpoolFull(Exception):
+    pass
+
+
+class Spool(object):
+    """
+    Append-only, memory-mapped file of messages that could not be published.
+
+    Records are appended at the write offset and consumed in order from the
+    read offset; both offsets live in the file header so a restarted handler
+    picks up where it left off. When everything has been drained the offsets
+    rewind to the start of the file, and when the end of the file is reached
+    the unread records are moved to the front to make room.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.lock = threading.Lock()
+        self.not_empty = threading.Event()
+
+        self.file = open(path, 'a+b')
+        try:
+            # only one handler process may use a spool file at a time
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            raise
+
+        size = max(size, os.fstat(self.file.fileno()).st_size, HEADER_SIZE + RECORD.size)
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.size = size
+
+        magic, self.read_offset, self.write_offset = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or not HEADER_SIZE <= self.read_offset <= self.write_offset <= size:
+            self.read_offset = self.write_offset = HEADER_SIZE
+            self._write_header()
+        if self.pending():
+            self.not_empty.set()
+
+    def pending(self):
+        return self.read_offset != self.write_offset
+
+    def append(self, routing_key, body, properties):
+        """
+        Appends a message, raising SpoolFull when there is no room left
+        """
+        payload = encode(routing_key, body, properties)
+        record_size = RECORD.size + len(payload)
+
+        with self.lock:
+            if self.write_offset + record_size > self.size:
+                self._compact()
+            if self.write_offset + record_size > self.size:
+                raise SpoolFull(f'spool {self.path} has no room for a {record_size} byte message')
+
+            RECORD.pack_into(self.map, self.write_offset, len(payload), zlib.crc32(payload))
+            self.map[self.write_offset + RECORD.size:self.write_offset + record_size] = payload
+            self.write_offset += record_size
+            self._write_header()
+        self.not_empty.set()
+
+    def peek(self, limit):
+        """
+        Returns up to limit of the oldest messages as (routing_key, body,
+        properties) tuples along with the number of bytes to commit once they
+        are published. A count rather than an offset, appends may compact the
+        spool and move the unread records before the commit.
+        """
+        messages = []
+        with self.lock:
+            offset = self.read_offset
+            while offset < self.write_offset and len(messages) < limit:
+                length, crc = RECORD.unpack_from(self.map, offset)
+                payload = self.map[offset + RECORD.size:offset + RECORD.size + length]
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    log.error(f'spool {self.path} is corrupt at offset {offset}, discarding the remaining messages')
+                    offset = self.write_offset
+                    break
+                messages.append(decode(payload))
+                offset += RECORD.size + length
+            consumed = offset - self.read_offset
+        return messages, consumed
+
+    def commit(self, consumed):
+        """
+        Marks the messages in the first consumed bytes, as returned by peek,
+        as published
+        """
+        with self.lock:
+            self.read_offset += consumed
+            if self.read_offset == self.write_offset:
+                self.read_offset = self.write_offset = HEADER_SIZE
+                self.not_empty.clear()
+            self._write_header()
+
+    def flush(self):
+        self.map.flush()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
+
+    def _compact(self):
+        unread = self.write_offset - self.read_offset
+        if self.read_offset > HEADER_SIZE:
+            self.map.move(HEADER_SIZE, self.read_offset, unread)
+            self.read_offset = HEADER_SIZE
+            self.write_offset = HEADER_SIZE + unread
+            self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self.map, 0, MAGIC, self.read_offset, self.write_offset)
+
+
+class SpoolDrainer(threading.Thread):
+    """
+    Background thread replaying spooled messages, oldest first, once the
+    broker accepts them again
+    """
+
+    def __init__(self, spool, publisher, batch_size=100, max_delay=30):
+        super().__init__(name='spool-drainer', daemon=True)
+        self.spool = spool
+        self.publisher = publisher
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.stopped = threading.Event()
+
+    def run(self):
+        delay = 1
+        while not self.stopped.is_set():
+            if not self.spool.not_empty.wait(timeout=1):
+                continue
+
+            messages, consumed = self.spool.peek(self.batch_size)
+            if not messages:
+                self.spool.commit(consumed)
+                continue
+
+            try:
+                self.publisher.publish_batch(
+                    (routing_key, body, pika.BasicProperties(**properties))
+                    for routing_key, body, properties in messages
+                )
+            except Exception as e:
+                log.warning(f'unable to replay spooled messages, retrying in {delay}s', errors=e)
+                self.stopped.wait(delay)
+                delay = min(delay * 2, self.max_delay)
+                continue
+
+            delay = 1
+            self.spool.commit(consumed)
+            self.spool.flush()
+            log.info(f'replayed {len(messages)} spooled messages')
+
+    def stop(self):
+        self.stopped.set()
+
+
+def start_spool(path, size, publisher):
+    """
+    Opens the spool and starts the thread draining it through publisher
+    """
+    event_spool = open_spool(path, size)
+    SpoolDrainer(event_spool, publisher).start()
+    return event_spool
+
+
+def open_spool(path, size, attempts=8):
+    """
+    Opens the first spool file at path, path.1, path.2, ... not already in use
+    by another handler process in this replica
+    """
+    for index in range(attempts):
+        candidate = path if index == 0 else f'{path}.{index}'
+        try:
+            return Spool(candidate, size)
+        except BlockingIOError:
+            continue
+    raise Exception(f'every spool file at {path} is in use')
+
+
+def encode(routing_key, body, properties):
+    key = routing_key.encode('utf-8')
+    encoded_properties = json.dumps(properties).encode('utf-8')
+    return b''.join((
+        KEY_LENGTH.pack(len(key)), key,
+        PROPERTIES_LENGTH.pack(len(encoded_properties)), encoded_properties,
+        bytes(body),
+    ))
+
+
+def decode(payload):
+    (key_length,) = KEY_LENGTH.unpack_from(payload, 0)
+    offset = KEY_LENGTH.size
+    routing_key = payload[offset:offset + key_length].decode('utf-8')
+    offset += key_length
+
+    (properties_length,) = PROPERTIES_LENGTH.unpack_from(payload, offset)
+    offset += PROPERTIES_LENGTH.size
+    properties = json.loads(payload[offset:offset + properties_length])
+    offset += properties_length
+
+    return routing_key, payload[offset:], properties
@@ -0,0 +1,109 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import threading
+from unittest import mock
+
+import pytest
+
+import spool
+
+
+def properties(message_id):
+    return {"type": "fk.webhook.v2", "message_id": str(message_id), "headers": {"X-Gitlab-Event": "Push Hook"}}
+
+
+def test_messages_replayed_in_order(tmp_path):
+    event_spool = spool.Spool(str(tmp_path / "events.spool"), 4096)
+    for i in range(3):
+        event_spool.append("gitlab", b"body %d" % i, properties(i))
+
+    messages, consumed = event_spool.peek(2)
+    assert messages == [("gitlab", b"body 0", properties(0)), ("gitlab", b"body 1", properties(1))]
+
+    event_spool.commit(consumed)
+    messages, consumed = event_spool.peek(10)
+    assert messages == [("gitlab", b"body 2", properties(2))]
+
+    event_spool.commit(consumed)
+    assert not event_spool.pending()
+    assert event_spool.write_offset == spool.HEADER_SIZE
+
+
+def test_spool_survives_restart(tmp_path):
+    path = str(tmp_path / "events.spool")
+    event_spool = spool.Spool(path, 4096)
+    event_spool.append("github", b"one", properties(1))
+    event_spool.append("github", b"two", properties(2))
+    event_spool.commit(event_spool.peek(1)[1])
+    event_spool.close()
+
+    reopened = spool.Spool(path, 4096)
+
+    assert reopened.pending()
+    assert reopened.peek(10)[0] == [("github", b"two", properties(2))]
+
+
+def test_spool_file_locked_per_process(tmp_path):
+    path = str(tmp_path / "events.spool")
+    first = spool.open_spool(path, 4096)
+    second = spool.open_spool(path, 4096)
+
+    assert first.path == path
+    assert second.path == path + ".1"
+
+
+def test_full_spool_compacts_then_refuses(tmp_path):
+    event_spool = spool.Spool(str(tmp_path / "events.spool"), 512)
+    body = b"x" * 100
+    event_spool.append("github", body, properties(1))
+    event_spool.append("github", body, properties(2))
+    event_spool.commit(event_spool.peek(1)[1])
+
+    # the consumed first record makes room once the unread one is moved to the front
+    event_spool.append("github", body, properties(3))
+    assert [p["message_id"] for _, _, p in event_spool.peek(10)[0]] == ["2", "3"]
+
+    with pytest.raises(spool.SpoolFull):
+        event_spool.append("github", body * 3, properties(4))
+
+
+def test_compaction_between_peek_and_commit_loses_nothing(tmp_path):
+    event_spool = spool.Spool(str(tmp_path / "events.spool"), 1024)
+    body = b"x" * 100
+    for i in range(4):
+        event_spool.append("github", body, properties(i))
+    event_spool.commit(event_spool.peek(2)[1])
+
+    messages, consumed = event_spool.peek(1)
+    # an append of the handler fills the spool while the drainer publishes, moving the unread records
+    appender = threading.Thread(target=event_spool.append, args=("github", body * 3, properties(4)))
+    appender.start()
+    appender.join()
+    assert event_spool.read_offset == spool.HEADER_SIZE
+    event_spool.commit(consumed)
+
+    assert [p["message_id"] for _, _, p in messages] == ["2"]
+    assert [p["message_id"] for _, _, p in event_spool.peek(10)[0]] == ["3", "4"]
+
+
+def test_drainer_retries_until_broker_accepts(tmp_path):
+    event_spool = spool.Spool(str(tmp_path / "events.spool"), 4096)
+    event_spool.append("github", b"one", properties(1))
+    publisher = mock.Mock()
+
+    def publish_batch(messages):
+        messages = list(messages)
+        if publisher.publish_batch.call_count == 1:
+            raise Exception("broker down")
+        drainer.stop()
+        published.extend(messages)
+
+    published = []
+    publisher.publish_batch.side_effect = publish_batch
+    drainer = spool.SpoolDrainer(event_spool, publisher)
+    with mock.patch.object(drainer.stopped, "wait"):
+        drainer.run()
+
+    assert [(key, body) for key, body, _ in published] == [("github", b"one")]
+    assert published[0][2].message_id == "1"
+    assert not event_spool.pending()
@@ -0,0 +1,65 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Measures what computing event signatures costs on push payloads of
+increasing size.
+
+It compares the signature the workers used to compute (SHA-1 of the whole
+decoded message, envelope included), the canonical payload hash workers fall
+back to for messages without a fingerprint, and the fingerprint the handler
+now computes once over the webhook body, with a few hash functions:
+
+    python tools/bench_fingerprint.py
+"""
+
+import hashlib
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "shared"))
+
+from bench_compression import make_push_payload  # noqa: E402
+from messages import fingerprint  # noqa: E402
+from shared import create_unique_id  # noqa: E402
+
+
+def legacy_unique_id(msg):
+    return hashlib.sha1(bytes(json.dumps(msg), "utf-8")).hexdigest()
+
+
+def envelope(body, message_id):
+    msg = json.loads(body)
+    msg["attributes"] = {"headers": {"X-Github-Event": "push"}}
+    msg["publishTime"] = "2023-10-08 13:46:01.606895"
+    msg["message_id"] = message_id
+    return msg
+
+
+def measure(function, argument, number):
+    return min(timeit.repeat(lambda: function(argument), number=number, repeat=3)) / number * 1e6
+
+
+if __name__ == "__main__":
+    print(f"{'payload':>10} {'legacy sha1':>12} {'canonical':>12} {'edge sha256':>12} "
+          f"{'edge sha1':>10} {'edge blake2b':>13} {'stable':>7}")
+    for num_commits in (1, 20, 100, 500, 2000):
+        body = make_push_payload(num_commits)
+        msg = envelope(body, 1)
+        redelivered = envelope(body, 2)
+        number = max(1, 4000 // num_commits)
+
+        legacy = measure(legacy_unique_id, msg, number)
+        canonical = measure(create_unique_id, msg, number)
+        edge = measure(fingerprint, body, number)
+        edge_sha1 = measure(lambda b: hashlib.sha1(b).hexdigest(), body, number)
+        edge_blake2b = measure(lambda b: hashlib.blake2b(b, digest_size=32).hexdigest(), body, number)
+        stable = (legacy_unique_id(msg) == legacy_unique_id(redelivered),
+                  create_unique_id(msg) == create_unique_id(redelivered))
+
+        print(f"{len(body) // 1024:>7} KiB {legacy:>9.0f} us {canonical:>9.0f} us {edge:>9.0f} us "
+              f"{edge_sha1:>7.0f} us {edge_blake2b:>10.0f} us "
+              f"{'yes' if stable[1] else 'no':>4}/{'yes' if stable[0] else 'no'}")
+    print("\nstable: signature unchanged on redelivery, new/legacy")
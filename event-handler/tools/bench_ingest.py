@@ -0,0 +1,121 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Load generator comparing webhook ingestion throughput of event handler modes.
+
+Sends signed GitHub push deliveries from many concurrent keep-alive
+connections and reports requests/second and latency percentiles for every
+--url given, e.g. the threaded Flask mode and the ASGI mode side by side:
+
+    FK_GITHUB_SECRET=changeme FK_BROKER_ADDRESS=localhost \\
+        gunicorn --bind :8080 --workers 1 --threads 8 event_handler:app
+    FK_GITHUB_SECRET=changeme FK_BROKER_ADDRESS=localhost \\
+        uvicorn asgi_handler:app --port 8081
+
+    python tools/bench_ingest.py --secret changeme \\
+        --url http://localhost:8080/ --url http://localhost:8081/
+"""
+
+import argparse
+import asyncio
+import hmac
+import json
+import secrets
+import statistics
+import time
+from hashlib import sha1
+from urllib.parse import urlsplit
+
+
+def make_push_payload(num_commits):
+    commits = [
+        {
+            "id": secrets.token_hex(20),
+            "message": "bench commit",
+            "timestamp": "2023-10-08T08:46:01+00:00",
+            "added": [f"src/file_{i}.py" for i in range(5)],
+        }
+        for _ in range(num_commits)
+    ]
+    return json.dumps({"head_commit": commits[-1], "commits": commits, "repository": {"name": "bench"}}).encode()
+
+
+def make_request(url, body, secret):
+    parts = urlsplit(url)
+    signature = "sha1=" + hmac.new(secret.encode(), body, sha1).hexdigest()
+    head = (
+        f"POST {parts.path or '/'} HTTP/1.1\r\n"
+        f"Host: {parts.netloc}\r\n"
+        "User-Agent: GitHub-Hookshot/bench\r\n"
+        "X-Github-Event: push\r\n"
+        f"X-Hub-Signature: {signature}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "\r\n"
+    )
+    return head.encode() + body
+
+
+async def read_response(reader):
+    status_line = await reader.readline()
+    status = int(status_line.split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    if length:
+        await reader.readexactly(length)
+    return status
+
+
+async def client(url, request, count, latencies, statuses):
+    parts = urlsplit(url)
+    reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+    try:
+        for _ in range(count):
+            start = time.perf_counter()
+            writer.write(request)
+            await writer.drain()
+            statuses.append(await read_response(reader))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def run(url, request, total, concurrency):
+    latencies, statuses = [], []
+    per_client = [total // concurrency + (1 if i < total % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    await asyncio.gather(*(client(url, request, n, latencies, statuses) for n in per_client if n))
+    elapsed = time.perf_counter() - start
+    return elapsed, latencies, statuses
+
+
+def report(url, elapsed, latencies, statuses):
+    latencies = sorted(latencies)
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    ok = sum(1 for s in statuses if s == 204)
+    print(f"{url}")
+    print(f"  requests: {len(statuses)} ({ok} accepted) in {elapsed:.2f}s -> {len(statuses) / elapsed:.0f} req/s")
+    print(f"  latency p50={quantiles[49] * 1000:.1f}ms p99={quantiles[98] * 1000:.1f}ms max={latencies[-1] * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", action="append", required=True, help="event handler url, may be repeated")
+    parser.add_argument("--secret", required=True, help="FK_GITHUB_SECRET configured on the handler")
+    parser.add_argument("--requests", "-n", type=int, default=5000, help="requests per url; default=5000")
+    parser.add_argument("--concurrency", "-c", type=int, default=200, help="concurrent connections; default=200")
+    parser.add_argument("--commits", type=int, default=20, help="commits per push payload; default=20")
+    args = parser.parse_args()
+
+    payload = make_push_payload(args.commits)
+    for target in args.url:
+        elapsed, latencies, statuses = asyncio.run(
+            run(target, make_request(target, payload, args.secret), args.requests, args.concurrency)
+        )
+        report(target, elapsed, latencies, statuses)
@@ -0,0 +1,54 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Micro-benchmark of per-request signature verification cost.
+
+Compares the previous approach (look the secret up in the environment and
+build a new HMAC for every request) with the prepared verifier registry from
+sources.py (pre-keyed HMAC objects copied per request), for a small and a
+large GitHub payload.
+
+    python tools/bench_verification.py
+"""
+
+import hmac
+import os
+import sys
+import timeit
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import sources  # noqa: E402
+
+SECRET = "bench-secret-" + "x" * 20
+
+
+def legacy_github_verification(signature, body):
+    expected_signature = "sha1="
+    secret = os.environ.get("FK_GITHUB_SECRET")
+    hashed = hmac.new(secret.encode(), body, 'sha1')
+    expected_signature += hashed.hexdigest()
+    return hmac.compare_digest(signature, expected_signature)
+
+
+def bench(name, func, signature, body, number):
+    assert func(signature, body)
+    seconds = min(timeit.repeat(lambda: func(signature, body), number=number, repeat=5))
+    per_call = seconds / number * 1e6
+    print(f"  {name:<10} {per_call:8.2f} us/request")
+    return per_call
+
+
+if __name__ == "__main__":
+    os.environ["FK_GITHUB_SECRET"] = SECRET
+    registry = sources.build_registry({"FK_GITHUB_SECRET": SECRET})
+
+    for label, size, number in (("1 KiB", 1024, 100000), ("1 MiB", 1024 * 1024, 200)):
+        body = os.urandom(size)
+        signature = "sha1=" + hmac.new(SECRET.encode(), body, sha1).hexdigest()
+
+        print(f"{label} body")
+        legacy = bench("legacy", legacy_github_verification, signature, body, number)
+        prepared = bench("prepared", registry["github"].verification, signature, body, number)
+        print(f"  speedup    {legacy / prepared:8.2f}x")
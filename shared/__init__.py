@@ -1,2 +1,14 @@
-from .shared import create_unique_id, insert_row_into_events_raw, insert_row_into_events_enriched, shutdown
+from .jsonlog import get_logger
 from .rabbit import RabbitMQConnector
+from .shared import BatchWriter, create_unique_id, insert_row_into_events_enriched, insert_row_into_events_raw, shutdown, WriteResult
+
+__all__ = [
+    'BatchWriter',
+    'create_unique_id',
+    'get_logger',
+    'insert_row_into_events_enriched',
+    'insert_row_into_events_raw',
+    'RabbitMQConnector',
+    'shutdown',
+    'WriteResult',
+]
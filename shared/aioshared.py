@@ -0,0 +1,294 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Asyncio counterpart of the write functions in shared.py, built on asyncpg.
+
+Install with the "async" extra (pip install shared[async]). The API mirrors
+shared.py with coroutines:
+
+    await aioshared.insert_row_into_events_raw(event)
+    await aioshared.insert_rows_into_events_raw(events)
+    await aioshared.insert_row_into_events_enriched(event)
+    await aioshared.shutdown()
+
+The pool is created on first use from the same FK_DB_* settings as dbpool.py
+and belongs to the event loop that created it. Statements are prepared once
+per connection by asyncpg, so many coroutines can keep inserts in flight over
+a handful of connections, and a batch is sent as a single statement.
+"""
+
+import asyncio
+import json
+import os
+
+import asyncpg
+
+import blobstore
+import dbpool
+import jsonlog
+from shared import WriteResult
+
+log = jsonlog.get_logger('aioshared')
+
+# seconds to wait for a pooled connection and for each statement
+TIMEOUT = float(os.environ.get('FK_DB_POOL_TIMEOUT', 10))
+
+# the columns are sent as text and cast by the database, exactly as psycopg2 interpolates them
+EVENTS_RAW_INSERT = """
+INSERT INTO events_raw (id, event_type, metadata, time_created, signature, msg_id, source)
+SELECT id, event_type, metadata::jsonb, time_created::timestamp, signature, msg_id, source
+FROM unnest($1::text[], $2::text[], $3::text[], $4::text[], $5::text[], $6::bigint[], $7::text[])
+    AS rows (id, event_type, metadata, time_created, signature, msg_id, source)
+ON CONFLICT (signature, time_created) DO NOTHING
+RETURNING signature
+"""
+
+EVENTS_RAW_ARCHIVE_INSERT = """
+INSERT INTO events_raw_archive (signature, source, event_type, time_created, payload)
+VALUES ($1, $2, $3, $4::text::timestamp, $5)
+ON CONFLICT (signature) DO NOTHING
+"""
+
+BLOBS_INSERT = """
+INSERT INTO payload_blobs (digest, data)
+VALUES ($1, $2)
+ON CONFLICT (digest) DO NOTHING
+"""
+
+COMMITS_INSERT = """
+INSERT INTO commits (source, change_id, time_created, repo)
+SELECT * FROM unnest($1::text[], $2::text[], $3::timestamp[], $4::text[])
+ON CONFLICT DO NOTHING
+"""
+
+DEPLOY_EVENTS_INSERT = """
+INSERT INTO deploy_events (signature, source, deploy_id, time_created, main_commit, additional_commits, msg_id)
+VALUES ($1, $2, $3, $4::text::timestamp, $5, $6::text[], $7::bigint)
+ON CONFLICT DO NOTHING
+"""
+
+# see shared.DEPLOYMENT_LINKS_INSERT
+DEPLOYMENT_LINKS_INSERT = """
+WITH links (source, deploy_id, commit_id) AS (
+    SELECT * FROM unnest($1::text[], $2::text[], $3::text[])
+),
+linked AS (
+    INSERT INTO deployment_changes (source, deploy_id, commit_id, changes)
+    SELECT source, deploy_id, commit_id, commit_changes(commit_id)
+    FROM links
+    WHERE EXISTS (SELECT 1 FROM events_raw e WHERE e.id = links.commit_id)
+    ON CONFLICT DO NOTHING
+)
+INSERT INTO pending_deployment_links (commit_id, source, deploy_id)
+SELECT commit_id, source, deploy_id
+FROM links
+WHERE NOT EXISTS (SELECT 1 FROM events_raw e WHERE e.id = links.commit_id)
+ON CONFLICT DO NOTHING
+"""
+
+INCIDENT_EVENTS_INSERT = """
+INSERT INTO incident_events (signature, source, incident_id, time_created, time_resolved, root_cause, bug, msg_id)
+SELECT * FROM unnest($1::text[], $2::text[], $3::text[], $4::timestamp[], $5::timestamp[], $6::text[], $7::boolean[],
+                     $8::bigint[])
+ON CONFLICT DO NOTHING
+"""
+
+EVENTS_ENRICHED_INSERT = """
+INSERT INTO events_enriched (events_raw_signature, enriched_metadata)
+VALUES ($1, $2::jsonb)
+ON CONFLICT (events_raw_signature) DO NOTHING
+RETURNING events_raw_signature
+"""
+
+_pool = None
+_creating = None
+
+
+async def create_pool(environ=os.environ):
+    return await asyncpg.create_pool(
+        database=dbpool.DATABASE,
+        host=environ.get('FK_DB_HOST'),
+        port=int(environ.get('FK_DB_PORT', 5432)),
+        user=environ.get('FK_DB_USER'),
+        password=environ.get('FK_DB_PW'),
+        min_size=1,
+        max_size=int(environ.get('FK_DB_POOL_MAX', 10)),
+        timeout=float(environ.get('FK_DB_CONNECT_TIMEOUT', 5)),
+    )
+
+
+async def get_pool():
+    """
+    Returns the pool, creating it on first use; concurrent first calls share
+    one pool
+    """
+    global _pool, _creating
+    if _pool is None:
+        if _creating is None:
+            _creating = asyncio.ensure_future(create_pool())
+        try:
+            _pool = await asyncio.shield(_creating)
+        except Exception:
+            _creating = None
+            raise
+    return _pool
+
+
+async def shutdown():
+    global _pool, _creating
+    pool, _pool, _creating = _pool, None, None
+    if pool is not None:
+        await pool.close()
+
+
+# keys of events whose rows are written with them, in the transaction inserting them
+TRANSACTIONAL_KEYS = ('commits', 'deploys', 'incidents', 'archive', 'blobs')
+
+
+async def insert_rows_into_events_raw(events):
+    """
+    Inserts events in one statement, skipping signatures already stored;
+    returns a WriteResult with the number of rows inserted and skipped as
+    duplicates. Database errors are raised, nothing is inserted then.
+    """
+    if not events:
+        return WriteResult(0, 0)
+
+    pool = await get_pool()
+    firsts = {}
+    for event in events:
+        firsts.setdefault(event['signature'], event)
+    if not any(event.get(key) for event in firsts.values() for key in TRANSACTIONAL_KEYS):
+        inserted = await pool.fetch(EVENTS_RAW_INSERT, *events_raw_columns(events), timeout=TIMEOUT)
+        return WriteResult(len(inserted), len(events) - len(inserted))
+
+    async with pool.acquire(timeout=TIMEOUT) as connection:
+        async with connection.transaction():
+            inserted = await connection.fetch(EVENTS_RAW_INSERT, *events_raw_columns(events), timeout=TIMEOUT)
+            # only events stored by this batch are archived, duplicates were archived with the original
+            stored = [firsts[row['signature']] for row in inserted]
+            await write_commits(connection, stored)
+            await write_deploys(connection, stored)
+            await write_incidents(connection, stored)
+            await write_payloads(connection, stored)
+    return WriteResult(len(inserted), len(events) - len(inserted))
+
+
+async def write_commits(connection, events):
+    """
+    Inserts the commits rows attached to events that were just inserted,
+    like shared.write_commits
+    """
+    rows = sorted(set(row for event in events for row in event.get('commits') or ()))
+    if rows:
+        await connection.execute(COMMITS_INSERT, *map(list, zip(*rows)), timeout=TIMEOUT)
+
+
+async def write_deploys(connection, events):
+    """
+    Inserts the deploy_events rows attached to events that were just
+    inserted and links their commits, like shared.write_deploys
+    """
+    rows = [row for event in events for row in event.get('deploys') or ()]
+    if not rows:
+        return
+    await connection.executemany(DEPLOY_EVENTS_INSERT, [
+        (signature, source, deploy_id, str(time_created), main_commit, additional, msg_id)
+        for signature, source, deploy_id, time_created, main_commit, additional, msg_id in rows
+    ], timeout=TIMEOUT)
+    links = sorted(set(
+        (source, deploy_id, commit)
+        for _, source, deploy_id, _, main_commit, additional, _ in rows
+        for commit in [main_commit] + additional
+    ))
+    await connection.execute(DEPLOYMENT_LINKS_INSERT, *map(list, zip(*links)), timeout=TIMEOUT)
+
+
+async def write_incidents(connection, events):
+    """
+    Inserts the incident_events rows attached to events that were just
+    inserted, like shared.write_incidents
+    """
+    rows = [row for event in events for row in event.get('incidents') or ()]
+    if rows:
+        await connection.execute(INCIDENT_EVENTS_INSERT, *map(list, zip(*rows)), timeout=TIMEOUT)
+
+
+async def write_payloads(connection, events):
+    """
+    Stores the complete payloads projection.apply set aside for events that
+    were just inserted, like shared.write_payloads
+    """
+    archived = []
+    blobs = {}
+    for event in events:
+        if event.get('archive'):
+            archived.append((event['signature'], event['source'], event['event_type'],
+                             str(event['time_created']), event['archive']))
+        if event.get('blobs'):
+            blobs.update(event['blobs'])
+
+    if archived:
+        await connection.executemany(EVENTS_RAW_ARCHIVE_INSERT, archived, timeout=TIMEOUT)
+    if blobs:
+        store = blobstore.get_store()
+        if isinstance(store, blobstore.TableBlobStore):
+            await connection.executemany(BLOBS_INSERT, list(blobs.items()), timeout=TIMEOUT)
+        else:
+            # files are written by a thread, the event loop keeps serving other coroutines
+            await asyncio.get_running_loop().run_in_executor(None, store.write, None, blobs)
+
+
+async def insert_row_into_events_raw(event):
+    """
+    Inserts one event, returns True if it was inserted and False if an event
+    with the same signature is already stored or the row was refused (logged)
+    """
+    if not event:
+        raise Exception("No data to insert")
+
+    try:
+        return (await insert_rows_into_events_raw([event])).inserted == 1
+    except (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError) as e:
+        log.warning("Row not inserted.", errors=str(e), row=event)
+        return False
+
+
+async def insert_row_into_events_enriched(event):
+    """
+    Inserts the enrichment of one event, returns True if it was inserted and
+    False if the event was already enriched
+    """
+    if not event:
+        raise Exception("No data to insert")
+
+    pool = await get_pool()
+    signature = await pool.fetchval(
+        EVENTS_ENRICHED_INSERT,
+        event["events_raw_signature"],
+        json.dumps(event["enriched_metadata"]),
+        timeout=TIMEOUT,
+    )
+    return signature is not None
+
+
+def events_raw_columns(events):
+    """
+    Returns one list per events_raw column, as unnest takes them
+    """
+    columns = ([], [], [], [], [], [], [])
+    seen = set()
+    for event in events:
+        # the first of several events with the same signature wins, as in shared.BatchWriter
+        if event['signature'] in seen:
+            continue
+        seen.add(event['signature'])
+
+        metadata = event['metadata']
+        if type(metadata) is not str:
+            metadata = json.dumps(metadata)
+        row = (str(event['id']), event['event_type'], metadata, str(event['time_created']),
+               event['signature'], event['msg_id'], event['source'])
+        for column, value in zip(columns, row):
+            column.append(value)
+    return columns
@@ -0,0 +1,136 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import asyncio
+from datetime import datetime
+from unittest import mock
+
+import pytest
+
+import aioshared
+
+
+def event(signature, event_id=1):
+    return {
+        "id": event_id,
+        "event_type": "push",
+        "metadata": {"ref": "main"},
+        "time_created": "2023-10-08 08:46:01",
+        "signature": signature,
+        "msg_id": 7116780781096697856,
+        "source": "github",
+    }
+
+
+@pytest.fixture
+def pool():
+    pool = mock.AsyncMock()
+    with mock.patch.object(aioshared, "_pool", pool):
+        yield pool
+
+
+def test_batch_sent_as_one_statement(pool):
+    pool.fetch.return_value = [{"signature": "a"}]
+
+    result = asyncio.run(aioshared.insert_rows_into_events_raw([event("a"), event("b"), event("a")]))
+
+    assert result == (1, 2)
+    query, *columns = pool.fetch.call_args.args
+    assert "ON CONFLICT (signature, time_created) DO NOTHING" in query
+    assert columns[0] == ["1", "1"]
+    assert columns[2] == ['{"ref": "main"}', '{"ref": "main"}']
+    assert columns[4] == ["a", "b"]
+
+
+@pytest.fixture
+def connection(pool):
+    """
+    The connection pool.acquire() hands out, whose inserts store every event
+    """
+    connection = mock.MagicMock()
+    connection.fetch = mock.AsyncMock(side_effect=lambda query, *columns, **kwargs: [
+        {"signature": signature} for signature in columns[4]
+    ])
+    connection.execute = mock.AsyncMock()
+    connection.executemany = mock.AsyncMock()
+    pool.acquire = mock.MagicMock()
+    pool.acquire.return_value.__aenter__.return_value = connection
+    return connection
+
+
+def executed(connection, table):
+    """
+    Returns the arguments of the statements inserting into table
+    """
+    return [
+        call.args[1:]
+        for call in connection.execute.call_args_list + connection.executemany.call_args_list
+        if f"INSERT INTO {table} " in call.args[0]
+    ]
+
+
+def test_commits_written_with_inserted_events(pool, connection):
+    commit = ("github", "c1", datetime(2023, 10, 8, 8, 46, 1), "fleetingclarity/fourkeys")
+
+    asyncio.run(aioshared.insert_rows_into_events_raw([dict(event("a"), commits=[commit]), event("b")]))
+
+    pool.fetch.assert_not_called()
+    assert executed(connection, "commits") == [
+        (["github"], ["c1"], [datetime(2023, 10, 8, 8, 46, 1)], ["fleetingclarity/fourkeys"])]
+
+
+def test_deploys_written_and_linked(pool, connection):
+    deploy = dict(event("d", event_id=42), event_type="deployment_status")
+    deploy["deploys"] = [("d", "github", "42", "2023-10-08 08:46:01", "main", ["c1"], 7116780781096697856)]
+
+    asyncio.run(aioshared.insert_rows_into_events_raw([deploy]))
+
+    assert executed(connection, "deploy_events") == [
+        ([("d", "github", "42", "2023-10-08 08:46:01", "main", ["c1"], 7116780781096697856)],),
+    ]
+    links = [call.args[1:] for call in connection.execute.call_args_list
+             if "INSERT INTO pending_deployment_links" in call.args[0]]
+    assert links == [(["github", "github"], ["42", "42"], ["c1", "main"])]
+
+
+def test_incidents_written_with_inserted_events(pool, connection):
+    issue = dict(event("i", event_id="fourkeys/614"), event_type="issues")
+    issue["incidents"] = [("i", "github", "614", datetime(2023, 10, 8, 8, 46, 1), None, "0834a2e", True,
+                           7116780781096697856)]
+
+    asyncio.run(aioshared.insert_rows_into_events_raw([issue]))
+
+    assert executed(connection, "incident_events") == [(
+        ["i"], ["github"], ["614"], [datetime(2023, 10, 8, 8, 46, 1)], [None], ["0834a2e"], [True],
+        [7116780781096697856],
+    )]
+
+
+def test_single_insert_reports_duplicate(pool):
+    pool.fetch.return_value = []
+
+    assert not asyncio.run(aioshared.insert_row_into_events_raw(event("a")))
+
+
+def test_enriched_insert(pool):
+    pool.fetchval.return_value = "a"
+
+    inserted = asyncio.run(aioshared.insert_row_into_events_enriched(
+        {"events_raw_signature": "a", "enriched_metadata": {"team": "platform"}}
+    ))
+
+    assert inserted
+    assert pool.fetchval.call_args.args[1:] == ("a", '{"team": "platform"}')
+
+
+def test_pool_created_once_for_concurrent_callers():
+    created = mock.AsyncMock(return_value=mock.Mock())
+
+    async def first_calls():
+        return await asyncio.gather(aioshared.get_pool(), aioshared.get_pool())
+
+    with mock.patch.object(aioshared, "create_pool", created), mock.patch.object(aioshared, "_pool", None):
+        first, second = asyncio.run(first_calls())
+        aioshared._creating = None
+
+    assert first is second
+    created.assert_awaited_once()
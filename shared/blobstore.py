@@ -0,0 +1,204 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Content-addressed store for complete webhook payloads.
+
+Webhooks resend the same large objects over and over: the repository and
+project descriptions of every push, tag and pipeline event, the commits of a
+push again in the pipeline it triggers. Instead of archiving each payload
+whole, split() breaks it into blobs: every object or list whose canonical
+JSON is at least FK_PAYLOAD_BLOB_MIN_BYTES long is stored once, gzipped,
+under the SHA-256 of that JSON, and replaced in its parent by
+{"$blob": "<digest>"}. Identical sub-objects get the same digest, so the
+store grows with unique content rather than with the number of events.
+load() puts a payload back together from the digest of its root blob.
+
+With projection enabled (see projection.py) the workers keep the root
+digest in events_raw.metadata under REFERENCE_KEY, next to the projected
+fields, and write the blobs in the same transaction as the events_raw row.
+Blobs of events that were not inserted are not written, but nothing ever
+deletes a blob, a reference cannot dangle.
+
+Configured from the environment:
+
+    FK_PAYLOAD_STORE           "table" for the payload_blobs table, or
+                               "file:///path" for a directory (default off)
+    FK_PAYLOAD_BLOB_MIN_BYTES  smaller objects stay inline in their parent (default 4096),
+                               small blobs compress poorly on their own
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from psycopg2 import extras
+
+# key of the root digest in the projected metadata, and of references in blobs
+REFERENCE_KEY = "$payload"
+BLOB_KEY = "$blob"
+
+MIN_BLOB_SIZE = int(os.environ.get("FK_PAYLOAD_BLOB_MIN_BYTES", 4096))
+
+BLOBS_INSERT = """
+INSERT INTO payload_blobs (digest, data)
+VALUES %s
+ON CONFLICT (digest) DO NOTHING
+"""
+
+BLOB_SELECT = "SELECT data FROM payload_blobs WHERE digest = %s"
+
+
+class BlobNotFound(KeyError):
+    pass
+
+
+class TableBlobStore(object):
+    """
+    Blobs in the payload_blobs table of the fourkeys database
+    """
+
+    def write(self, cursor, blobs):
+        """
+        Inserts blobs (digest -> gzipped data) with the cursor of the
+        transaction storing the events that reference them
+        """
+        extras.execute_values(cursor, BLOBS_INSERT, list(blobs.items()), page_size=len(blobs))
+
+    def read(self, cursor, digest):
+        cursor.execute(BLOB_SELECT, (digest,))
+        row = cursor.fetchone()
+        if row is None:
+            raise BlobNotFound(digest)
+        return bytes(row[0])
+
+
+class FileBlobStore(object):
+    """
+    Blobs as files named after their digest below a directory, which may be
+    shared by several workers
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest + ".json.gz")
+
+    def write(self, cursor, blobs):
+        """
+        Writes the blobs that are not stored yet, each atomically so readers
+        and concurrent writers never see a partial file; cursor is unused
+        """
+        for digest, data in blobs.items():
+            path = self.path(digest)
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(temporary, path)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+
+    def read(self, cursor, digest):
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise BlobNotFound(digest) from None
+
+
+def canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def split(payload, min_size=None):
+    """
+    Returns the digest of the root blob of payload and the blobs it is made
+    of (digest -> gzipped canonical JSON), the root blob always among them
+    """
+    min_size = MIN_BLOB_SIZE if min_size is None else min_size
+    blobs = {}
+    root = _split(payload, min_size, blobs)
+    if isinstance(root, dict) and set(root) == {BLOB_KEY}:
+        return root[BLOB_KEY], blobs
+    # a payload smaller than min_size is a single blob
+    return _store(canonical(root), blobs), blobs
+
+
+def _split(value, min_size, blobs):
+    if isinstance(value, dict):
+        value = {key: _split(item, min_size, blobs) for key, item in value.items()}
+    elif isinstance(value, list):
+        value = [_split(item, min_size, blobs) for item in value]
+    else:
+        return value
+
+    text = canonical(value)
+    if len(text) < min_size:
+        return value
+    return {BLOB_KEY: _store(text, blobs)}
+
+
+def _store(text, blobs):
+    digest = hashlib.sha256(text).hexdigest()
+    if digest not in blobs:
+        blobs[digest] = gzip.compress(text, mtime=0)
+    return digest
+
+
+def load(digest, store=None, cursor=None):
+    """
+    Returns the payload whose root blob has the given digest, read from the
+    configured store; the table store reads with cursor, a cursor on the
+    fourkeys database
+    """
+    store = store if store is not None else get_store()
+    return _join(json.loads(gzip.decompress(store.read(cursor, digest))), store, cursor)
+
+
+def _join(value, store, cursor):
+    if isinstance(value, dict):
+        if set(value) == {BLOB_KEY}:
+            return load(value[BLOB_KEY], store, cursor)
+        return {key: _join(item, store, cursor) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_join(item, store, cursor) for item in value]
+    return value
+
+
+def from_environ(environ=os.environ):
+    """
+    Returns the store configured by FK_PAYLOAD_STORE, None when there is none
+    """
+    setting = environ.get("FK_PAYLOAD_STORE", "")
+    if not setting:
+        return None
+    if setting == "table":
+        return TableBlobStore()
+    if setting.startswith("file://"):
+        return FileBlobStore(setting[len("file://"):])
+    raise ValueError(f"FK_PAYLOAD_STORE must be 'table' or 'file:///path', not {setting!r}")
+
+
+_UNSET = object()
+_store_instance = _UNSET
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    Returns the process-wide store, None when FK_PAYLOAD_STORE is not set
+    """
+    global _store_instance
+    if _store_instance is _UNSET:
+        with _store_lock:
+            if _store_instance is _UNSET:
+                _store_instance = from_environ()
+    return _store_instance
@@ -0,0 +1,93 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import gzip
+import json
+from unittest import mock
+
+import pytest
+
+import blobstore
+import projection
+
+
+def push_payload(after, message):
+    return {
+        "ref": "refs/heads/main",
+        "after": after,
+        "repository": {"full_name": "fleetingclarity/fourkeys", "description": "x" * 600},
+        "commits": [{"id": after, "message": message, "modified": ["README.md"]}],
+    }
+
+
+def test_split_and_load_round_trip(tmp_path):
+    store = blobstore.FileBlobStore(str(tmp_path))
+    payload = push_payload("b", "fix")
+
+    digest, blobs = blobstore.split(payload, min_size=512)
+    store.write(None, blobs)
+
+    assert blobstore.load(digest, store) == payload
+    root = json.loads(gzip.decompress(blobs[digest]))
+    # the repository is large enough to be a blob of its own, the commits stay inline
+    assert set(root["repository"]) == {"$blob"}
+    assert root["commits"] == payload["commits"]
+
+
+def test_identical_sub_objects_stored_once():
+    first, first_blobs = blobstore.split(push_payload("a", "fix"), min_size=512)
+    second, second_blobs = blobstore.split(push_payload("b", "fix again"), min_size=512)
+
+    assert first != second
+    shared = set(first_blobs) & set(second_blobs)
+    assert len(shared) == 1
+    repository = json.loads(gzip.decompress(first_blobs[shared.pop()]))
+    assert repository["full_name"] == "fleetingclarity/fourkeys"
+
+
+def test_small_payload_is_a_single_blob():
+    digest, blobs = blobstore.split({"id": 1}, min_size=512)
+
+    assert list(blobs) == [digest]
+    assert json.loads(gzip.decompress(blobs[digest])) == {"id": 1}
+
+
+def test_file_store_skips_existing_blobs(tmp_path):
+    store = blobstore.FileBlobStore(str(tmp_path))
+    store.write(None, {"ab" * 32: b"first"})
+    store.write(None, {"ab" * 32: b"second"})
+
+    assert store.read(None, "ab" * 32) == b"first"
+    with pytest.raises(blobstore.BlobNotFound):
+        store.read(None, "cd" * 32)
+
+
+def test_table_store_inserts_with_the_event_transaction():
+    cursor = mock.MagicMock()
+    with mock.patch.object(blobstore.extras, "execute_values") as execute_values:
+        blobstore.TableBlobStore().write(cursor, {"ab" * 32: b"data"})
+
+    assert execute_values.call_args.args[0] is cursor
+    assert "ON CONFLICT (digest) DO NOTHING" in execute_values.call_args.args[1]
+    assert execute_values.call_args.args[2] == [("ab" * 32, b"data")]
+
+
+def test_from_environ():
+    assert blobstore.from_environ({}) is None
+    assert isinstance(blobstore.from_environ({"FK_PAYLOAD_STORE": "table"}), blobstore.TableBlobStore)
+    assert blobstore.from_environ({"FK_PAYLOAD_STORE": "file:///var/lib/fourkeys"}).root == "/var/lib/fourkeys"
+    with pytest.raises(ValueError):
+        blobstore.from_environ({"FK_PAYLOAD_STORE": "s3://bucket"})
+
+
+def test_projected_metadata_references_the_payload(tmp_path):
+    store = blobstore.FileBlobStore(str(tmp_path))
+    payload = dict(push_payload("b", "fix"), head_commit={"id": "b", "timestamp": "2023-10-08T08:47:01+00:00"})
+    event = {"event_type": "push", "metadata": json.dumps(payload), "source": "github", "signature": "s"}
+
+    event = projection.apply(event, payload, enabled=True, archive=True, store=store)
+    store.write(None, event["blobs"])
+
+    metadata = json.loads(event["metadata"])
+    assert "archive" not in event
+    assert metadata["head_commit"] == {"id": "b", "timestamp": "2023-10-08T08:47:01+00:00"}
+    assert blobstore.load(metadata["$payload"], store) == payload
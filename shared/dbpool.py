@@ -0,0 +1,255 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Thread-safe Postgres connection pool for the workers.
+
+Nothing connects at import time: the pool is created by the first
+get_pool() call and opens connections as they are needed, up to
+FK_DB_POOL_MAX, keeping them open for reuse. Connections are checked before
+being handed out (closed, or idle for longer than FK_DB_VALIDATE_IDLE_SECONDS
+without a round trip) and recycled after FK_DB_MAX_LIFETIME_SECONDS, so
+failovers and server-side limits do not leave stale connections behind.
+
+Configured from the environment:
+
+    FK_DB_HOST, FK_DB_PORT, FK_DB_USER, FK_DB_PW   where to connect
+    FK_DB_POOL_MAX               connections open at most (default 10)
+    FK_DB_POOL_TIMEOUT           seconds to wait for a free connection (default 10)
+    FK_DB_CONNECT_TIMEOUT        seconds to wait for the server to answer (default 5)
+    FK_DB_MAX_LIFETIME_SECONDS   connections older than this are replaced (default 3600)
+    FK_DB_VALIDATE_IDLE_SECONDS  connections idle longer are pinged on checkout (default 30)
+"""
+
+import os
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import pool
+
+DATABASE = 'fourkeys'
+
+
+class PoolTimeout(pool.PoolError):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    Pool of psycopg2 connections shared by every thread of a worker
+    """
+
+    def __init__(self, maxconn=10, timeout=10, max_lifetime=3600, validate_idle=30, **connect_kwargs):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.validate_idle = validate_idle
+        self.connect_kwargs = connect_kwargs
+
+        self.lock = threading.Condition()
+        # idle connections, most recently returned last
+        self.idle = []
+        # connection -> (created, last returned) monotonic times
+        self.times = {}
+        self.size = 0
+        self.closed = False
+
+        self.checkouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+        self.created = 0
+        self.recycled = 0
+        self.invalid = 0
+
+    def getconn(self):
+        """
+        Returns a validated connection, waiting up to the pool timeout for one
+        to be returned when maxconn are in use
+        """
+        start = time.monotonic()
+        while True:
+            connection = self._reserve(start)
+            if connection is None:
+                # a slot was reserved, open the new connection outside the lock
+                try:
+                    connection = self._connect()
+                except Exception:
+                    self._release_slot()
+                    raise
+            elif not self._usable(connection):
+                self._discard(connection)
+                continue
+
+            waited = time.monotonic() - start
+            with self.lock:
+                self.checkouts += 1
+                self.wait_seconds += waited
+                self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            return connection
+
+    def putconn(self, connection, close=False):
+        """
+        Hands a connection back, closing it when close is set or it is broken
+        """
+        if not close and not connection.closed:
+            status = connection.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except psycopg2.Error:
+                    close = True
+
+        with self.lock:
+            if not (close or connection.closed or self.closed) and connection in self.times:
+                created, _ = self.times[connection]
+                self.times[connection] = (created, time.monotonic())
+                self.idle.append(connection)
+                self.lock.notify()
+                return
+        self._discard(connection)
+
+    def closeall(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            self._discard(connection)
+
+    def stats(self):
+        """
+        Counters for monitoring how long callers wait for connections
+        """
+        with self.lock:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'checkouts': self.checkouts,
+                'wait_seconds': round(self.wait_seconds, 6),
+                'max_wait_seconds': round(self.max_wait_seconds, 6),
+                'timeouts': self.timeouts,
+                'created': self.created,
+                'recycled': self.recycled,
+                'invalid': self.invalid,
+            }
+
+    def _reserve(self, start):
+        """
+        Pops an idle connection, or reserves a slot for a new one (returns None)
+        """
+        with self.lock:
+            while True:
+                if self.closed:
+                    raise pool.PoolError('connection pool is closed')
+                if self.idle:
+                    return self.idle.pop()
+                if self.size < self.maxconn:
+                    self.size += 1
+                    return None
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0 or not self.lock.wait(remaining):
+                    if not self.idle and self.size >= self.maxconn:
+                        self.timeouts += 1
+                        raise PoolTimeout(f'no database connection free after {self.timeout}s, '
+                                          f'all {self.maxconn} are in use')
+
+    def _usable(self, connection):
+        """
+        Tells whether an idle connection can be handed out; the ping of a
+        connection idle for long runs outside the lock
+        """
+        with self.lock:
+            created, returned = self.times[connection]
+        now = time.monotonic()
+        recycled = invalid = False
+        if connection.closed:
+            invalid = True
+        elif now - created > self.max_lifetime:
+            recycled = True
+        elif now - returned > self.validate_idle:
+            invalid = not self._ping(connection)
+        if recycled or invalid:
+            with self.lock:
+                self.recycled += recycled
+                self.invalid += invalid
+            return False
+        return True
+
+    def _ping(self, connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _connect(self):
+        connection = psycopg2.connect(**self.connect_kwargs)
+        now = time.monotonic()
+        with self.lock:
+            self.times[connection] = (now, now)
+            self.created += 1
+        return connection
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        self._release_slot(connection)
+
+    def _release_slot(self, connection=None):
+        with self.lock:
+            # connections the pool does not know about never took a slot
+            if connection is not None and self.times.pop(connection, None) is None:
+                return
+            self.size -= 1
+            self.lock.notify()
+
+
+def from_environ(environ=os.environ):
+    return ConnectionPool(
+        maxconn=int(environ.get('FK_DB_POOL_MAX', 10)),
+        timeout=float(environ.get('FK_DB_POOL_TIMEOUT', 10)),
+        max_lifetime=float(environ.get('FK_DB_MAX_LIFETIME_SECONDS', 3600)),
+        validate_idle=float(environ.get('FK_DB_VALIDATE_IDLE_SECONDS', 30)),
+        database=DATABASE,
+        host=environ.get('FK_DB_HOST'),
+        port=environ.get('FK_DB_PORT', 5432),
+        user=environ.get('FK_DB_USER'),
+        password=environ.get('FK_DB_PW'),
+        connect_timeout=int(environ.get('FK_DB_CONNECT_TIMEOUT', 5)),
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the process-wide pool, creating it on first use
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = from_environ()
+    return _pool
+
+
+def close_pool():
+    """
+    Closes the process-wide pool, returns its statistics (None if it was never used)
+    """
+    global _pool
+    with _pool_lock:
+        closing, _pool = _pool, None
+    if closing is None:
+        return None
+    closing.closeall()
+    return closing.stats()
@@ -0,0 +1,99 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import threading
+from unittest import mock
+
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+import dbpool
+
+
+def fake_connection():
+    connection = mock.MagicMock(closed=0)
+    connection.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    return connection
+
+
+@pytest.fixture
+def connect():
+    with mock.patch("dbpool.psycopg2.connect", side_effect=lambda **kwargs: fake_connection()) as connect:
+        yield connect
+
+
+def test_nothing_connects_until_first_checkout(connect):
+    pool = dbpool.from_environ({"FK_DB_HOST": "pg", "FK_DB_POOL_MAX": "3"})
+    connect.assert_not_called()
+
+    connection = pool.getconn()
+    pool.putconn(connection)
+
+    assert pool.getconn() is connection
+    assert connect.call_count == 1
+    assert connect.call_args.kwargs["host"] == "pg"
+    assert pool.maxconn == 3
+
+
+def test_checkout_waits_then_times_out(connect):
+    pool = dbpool.ConnectionPool(maxconn=1, timeout=0.05)
+    connection = pool.getconn()
+
+    with pytest.raises(dbpool.PoolTimeout):
+        pool.getconn()
+
+    threading.Timer(0.01, pool.putconn, args=(connection,)).start()
+    pool.timeout = 5
+    assert pool.getconn() is connection
+    stats = pool.stats()
+    assert stats["timeouts"] == 1
+    assert stats["checkouts"] == 2
+    assert stats["max_wait_seconds"] > 0
+
+
+def test_stale_connections_replaced_on_checkout(connect):
+    pool = dbpool.ConnectionPool(maxconn=2, max_lifetime=60, validate_idle=10)
+    old = pool.getconn()
+    pool.putconn(old)
+
+    with mock.patch("dbpool.time.monotonic", return_value=pool.times[old][0] + 120):
+        replacement = pool.getconn()
+
+    assert replacement is not old
+    old.close.assert_called_once()
+    assert pool.stats()["recycled"] == 1
+
+
+def test_idle_connection_pinged_and_dropped_when_dead(connect):
+    pool = dbpool.ConnectionPool(maxconn=1, validate_idle=10)
+    connection = pool.getconn()
+    pool.putconn(connection)
+    connection.cursor.return_value.__enter__.return_value.execute.side_effect = psycopg2.OperationalError("gone")
+
+    created, returned = pool.times[connection]
+    with mock.patch("dbpool.time.monotonic", return_value=returned + 30):
+        replacement = pool.getconn()
+
+    assert replacement is not connection
+    assert pool.stats()["invalid"] == 1
+    assert pool.size == 1
+
+
+def test_connection_left_in_transaction_rolled_back(connect):
+    pool = dbpool.ConnectionPool(maxconn=1)
+    connection = pool.getconn()
+    connection.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+
+    pool.putconn(connection)
+
+    connection.rollback.assert_called_once()
+    assert pool.idle == [connection]
+
+
+def test_failed_connect_frees_its_slot():
+    pool = dbpool.ConnectionPool(maxconn=1)
+    with mock.patch("dbpool.psycopg2.connect", side_effect=psycopg2.OperationalError("refused")):
+        with pytest.raises(psycopg2.OperationalError):
+            pool.getconn()
+
+    assert pool.size == 0
@@ -0,0 +1,223 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Structured logging shared by the event handler and the workers.
+
+Every entry is written to stdout as one JSON object with a "severity" and a
+"message" plus any extra fields, the format Cloud Logging and most log
+shippers parse without configuration. Logging never blocks the caller: entries
+are handed to a background thread that serializes and writes them, and when
+that thread falls behind entries are dropped (and counted) instead of slowing
+the hot path down.
+
+Configured from the environment:
+
+    FK_LOG_LEVEL              lowest severity written (default INFO)
+    FK_LOG_SAMPLE_<SEVERITY>  fraction of entries of that severity to keep,
+                              e.g. FK_LOG_SAMPLE_INFO=0.01 (default 1)
+    FK_LOG_MAX_FIELD_BYTES    longer field values are truncated (default 1024)
+    FK_LOG_QUEUE_SIZE         entries waiting to be written (default 10000)
+"""
+
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime, timezone
+
+SEVERITIES = {
+    'DEBUG': 100,
+    'INFO': 200,
+    'NOTICE': 300,
+    'WARNING': 400,
+    'ERROR': 500,
+    'CRITICAL': 600,
+}
+
+_STOP = object()
+
+
+class Writer(object):
+    """
+    Background thread serializing entries and writing them to a stream
+    """
+
+    def __init__(self, stream=None, queue_size=10000, max_field_length=1024, batch_size=256):
+        self.stream = stream
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.max_field_length = max_field_length
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+        self.lock = threading.Lock()
+
+    def put(self, entry):
+        # the thread does not survive a fork, e.g. gunicorn --preload, so the child starts its own
+        if self.pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5):
+        """
+        Waits until every queued entry has been written and stops the thread
+        """
+        thread = self.thread
+        if thread is None or self.pid != os.getpid() or not thread.is_alive():
+            return
+        try:
+            self.queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        thread.join(timeout)
+
+    def _start(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            if self.pid is not None:
+                # forked, entries queued by the parent are the parent's to write
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self.thread = threading.Thread(target=self._run, name='jsonlog-writer', daemon=True)
+            self.pid = os.getpid()
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            entries = [self.queue.get()]
+            while entries[-1] is not _STOP and len(entries) < self.batch_size:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = entries[-1] is _STOP
+            if stop:
+                entries.pop()
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                entries.append({'severity': 'WARNING', 'message': f'dropped {dropped} log entries'})
+
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(''.join(self.format(entry) + '\n' for entry in entries))
+                stream.flush()
+            except Exception as e:
+                sys.stderr.write(f'unable to write log entries: {e!r}\n')
+
+            if stop:
+                # let a later put() start a new thread
+                self.pid = None
+                return
+
+    def format(self, entry):
+        return json.dumps(
+            {key: truncate(value, self.max_field_length) for key, value in entry.items()}, default=str
+        )
+
+
+class Logger(object):
+    """
+    Writes entries of at least the given level, keeping only the configured
+    fraction of each severity
+    """
+
+    def __init__(self, name, writer, level='INFO', sample_rates=None):
+        self.name = name
+        self.writer = writer
+        self.level = SEVERITIES[level]
+        self.sample_rates = sample_rates or {}
+
+    def enabled(self, severity):
+        return SEVERITIES[severity] >= self.level
+
+    def log(self, severity, message, **fields):
+        if SEVERITIES[severity] < self.level:
+            return
+        rate = self.sample_rates.get(severity, 1)
+        if rate < 1:
+            if random.random() >= rate:
+                return
+            # lets the reader scale counts back up
+            fields['sample_rate'] = rate
+
+        entry = {
+            'severity': severity,
+            'message': message,
+            'logger': self.name,
+            'time': datetime.now(timezone.utc).isoformat(),
+        }
+        entry.update(fields)
+        self.writer.put(entry)
+
+    def debug(self, message, **fields):
+        self.log('DEBUG', message, **fields)
+
+    def info(self, message, **fields):
+        self.log('INFO', message, **fields)
+
+    def warning(self, message, **fields):
+        self.log('WARNING', message, **fields)
+
+    def error(self, message, **fields):
+        self.log('ERROR', message, **fields)
+
+
+def truncate(value, limit):
+    """
+    Cuts strings, bytes and containers down to limit characters; large
+    payloads are only serialized here, in the writer thread
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        if len(value) <= limit:
+            return bytes(value).decode('utf-8', errors='replace')
+        text = bytes(value[:limit]).decode('utf-8', errors='replace')
+        return text + f'... ({len(value) - limit} more bytes)'
+    if isinstance(value, BaseException):
+        value = repr(value)
+    elif not isinstance(value, str):
+        value = json.dumps(value, default=str)
+    if len(value) > limit:
+        return value[:limit] + f'... ({len(value) - limit} more characters)'
+    return value
+
+
+def read_sample_rates(environ):
+    rates = {}
+    for severity in SEVERITIES:
+        rate = environ.get(f'FK_LOG_SAMPLE_{severity}')
+        if rate is not None:
+            rates[severity] = min(max(float(rate), 0.0), 1.0)
+    return rates
+
+
+_writer = Writer(
+    queue_size=int(os.environ.get('FK_LOG_QUEUE_SIZE', 10000)),
+    max_field_length=int(os.environ.get('FK_LOG_MAX_FIELD_BYTES', 1024)),
+)
+atexit.register(_writer.flush)
+
+
+def get_logger(name, environ=os.environ):
+    """
+    Returns a logger configured from the environment that writes through the
+    process-wide background writer
+    """
+    return Logger(
+        name,
+        _writer,
+        level=environ.get('FK_LOG_LEVEL', 'INFO').upper(),
+        sample_rates=read_sample_rates(environ),
+    )
+
+
+def flush(timeout=5):
+    _writer.flush(timeout)
@@ -0,0 +1,81 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import io
+import json
+from unittest.mock import patch
+
+import jsonlog
+
+
+def written(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_entries_written_as_json():
+    stream = io.StringIO()
+    logger = jsonlog.Logger("github-parser", jsonlog.Writer(stream))
+
+    logger.warning("Data not saved to database", errors="boom", msg_id=7)
+    logger.debug("not written")
+    logger.writer.flush()
+
+    [entry] = written(stream)
+    assert entry["severity"] == "WARNING"
+    assert entry["message"] == "Data not saved to database"
+    assert entry["logger"] == "github-parser"
+    assert entry["errors"] == "boom"
+    assert entry["msg_id"] == 7
+
+
+def test_payloads_truncated():
+    stream = io.StringIO()
+    logger = jsonlog.Logger("test", jsonlog.Writer(stream, max_field_length=10))
+
+    logger.error("bad payload", json_payload={"commits": ["x" * 100]}, body=b"y" * 30)
+    logger.writer.flush()
+
+    [entry] = written(stream)
+    assert entry["json_payload"].startswith('{"commits"')
+    assert entry["json_payload"].endswith("more characters)")
+    assert entry["body"] == "yyyyyyyyyy... (20 more bytes)"
+
+
+def test_entries_sampled_per_severity():
+    stream = io.StringIO()
+    logger = jsonlog.Logger("test", jsonlog.Writer(stream), sample_rates={"INFO": 0.5})
+
+    with patch("jsonlog.random.random", side_effect=[0.7, 0.2]):
+        logger.info("dropped")
+        logger.info("kept")
+    logger.warning("always kept")
+    logger.writer.flush()
+
+    entries = written(stream)
+    assert [entry["message"] for entry in entries] == ["kept", "always kept"]
+    assert entries[0]["sample_rate"] == 0.5
+
+
+def test_full_queue_drops_and_reports():
+    stream = io.StringIO()
+    writer = jsonlog.Writer(stream, queue_size=1)
+    logger = jsonlog.Logger("test", writer)
+
+    # pretend the writer thread is running but behind
+    writer.pid = jsonlog.os.getpid()
+    logger.info("one")
+    logger.info("two")
+    assert writer.dropped == 1
+
+    writer.pid = None
+    writer._start()
+    writer.flush()
+
+    assert [entry["message"] for entry in written(stream)] == ["one", "dropped 1 log entries"]
+
+
+def test_get_logger_configured_from_environment():
+    logger = jsonlog.get_logger("handler", {"FK_LOG_LEVEL": "warning", "FK_LOG_SAMPLE_WARNING": "0.1"})
+
+    assert not logger.enabled("INFO")
+    assert logger.enabled("ERROR")
+    assert logger.sample_rates == {"WARNING": 0.1}
@@ -0,0 +1,210 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Projection of webhook payloads down to the fields the metrics read.
+
+Webhooks carry much more than the metrics need, whose changes, deployments
+and incidents the workers extract at ingest: a GitHub push repeats the whole
+repository, the sender and the file lists of every commit. With projection enabled, workers store
+in events_raw.metadata only the fields listed in SPECS for the source and
+event type, and optionally keep the complete payload, gzipped, in
+events_raw_archive or a payload store so nothing is lost for later
+analysis. Event types without a spec are stored whole.
+
+A spec is a list of paths: "deployment.sha" keeps that field (and all of it
+when it is an object), "commits[].id" keeps the id of every element of the
+commits list. Missing fields are left out rather than stored as null. Before
+reading a path of events_raw.metadata in SQL, add it here too.
+
+Configured from the environment:
+
+    FK_METADATA_PROJECTION  "on" to store projected metadata (default off)
+    FK_METADATA_ARCHIVE     "on" to also archive the complete payload (default off),
+                            only used with projection
+
+With FK_PAYLOAD_STORE set, complete payloads go to the content-addressed
+store described in blobstore.py instead of events_raw_archive.
+"""
+
+import gzip
+import json
+import os
+
+import blobstore
+
+# fields kept in events_raw.metadata, by source and event type ("*" for any other type)
+SPECS = {
+    "github": {
+        "push": [
+            "ref", "before", "after", "repository.full_name",
+            "commits[].id", "commits[].timestamp", "head_commit.id", "head_commit.timestamp",
+        ],
+        "deployment_status": [
+            "deployment_status.id", "deployment_status.state", "deployment_status.updated_at",
+            "deployment.id", "deployment.sha", "deployment.environment", "commits[].id",
+            "repository.full_name",
+        ],
+        "issues": [
+            "action", "issue.number", "issue.title", "issue.body", "issue.labels[].name",
+            "issue.created_at", "issue.updated_at", "issue.closed_at", "repository.full_name",
+        ],
+        "issue_comment": [
+            "action", "issue.number", "issue.title", "issue.body", "issue.labels[].name",
+            "issue.created_at", "issue.updated_at", "issue.closed_at", "repository.full_name",
+            "comment.id", "comment.body", "comment.updated_at",
+        ],
+    },
+    "gitlab": {
+        "push": [
+            "object_kind", "ref", "before", "after", "checkout_sha", "project.path_with_namespace",
+            "commits[].id", "commits[].timestamp",
+        ],
+        "tag_push": [
+            "object_kind", "ref", "before", "after", "checkout_sha", "project.path_with_namespace",
+            "commits[].id", "commits[].timestamp",
+        ],
+        "pipeline": [
+            "object_kind", "object_attributes.id", "object_attributes.status", "object_attributes.ref",
+            "object_attributes.sha", "object_attributes.created_at", "object_attributes.updated_at",
+            "object_attributes.finished_at", "commit.id", "commit.timestamp", "commit.url",
+            "project.path_with_namespace",
+        ],
+        "deployment": [
+            "object_kind", "deployment_id", "status", "status_changed_at", "environment",
+            "short_sha", "commit_url", "project.path_with_namespace",
+        ],
+        "issue": [
+            "object_kind", "object_attributes.id", "object_attributes.iid", "object_attributes.title",
+            "object_attributes.description", "object_attributes.state", "object_attributes.labels[].title",
+            "object_attributes.created_at", "object_attributes.updated_at", "object_attributes.closed_at",
+            "labels[].title", "project.path_with_namespace",
+        ],
+        "note": [
+            "object_kind", "object_attributes.id", "object_attributes.note", "object_attributes.noteable_id",
+            "object_attributes.noteable_type", "object_attributes.labels", "object_attributes.created_at",
+            "object_attributes.updated_at", "object_attributes.closed_at", "issue.id", "issue.labels[].title",
+            "project.path_with_namespace",
+        ],
+    },
+    "cloud_build": {
+        "*": [
+            "id", "projectId", "status", "createTime", "startTime", "finishTime", "substitutions",
+            "source.repoSource",
+        ],
+    },
+    "circleci": {
+        "*": [
+            "id", "type", "happened_at", "workflow", "project.slug", "pipeline.id", "pipeline.number",
+            "pipeline.vcs.revision", "pipeline.vcs.branch",
+        ],
+    },
+    "tekton": {
+        "*": [
+            "id", "source", "type", "time",
+            "data.pipelineRun.metadata.name", "data.pipelineRun.metadata.uid",
+            "data.pipelineRun.spec.params", "data.pipelineRun.status.conditions",
+            "data.pipelinerun.spec.params",
+            "data.taskRun.metadata.name", "data.taskRun.metadata.uid", "data.taskRun.status.conditions",
+        ],
+    },
+}
+
+ENABLED = os.environ.get("FK_METADATA_PROJECTION", "off").lower() in ("on", "true", "1")
+ARCHIVE = os.environ.get("FK_METADATA_ARCHIVE", "off").lower() in ("on", "true", "1")
+
+_MISSING = object()
+
+
+def compile_spec(paths):
+    """
+    Turns a list of paths into a tree of the keys to keep, an empty tree
+    keeps the whole value
+    """
+    tree = {}
+    for path in paths:
+        node = tree
+        for key in path.replace("[]", ".[]").split("."):
+            node = node.setdefault(key, {})
+    return tree
+
+
+_trees = {
+    source: {event_type: compile_spec(paths) for event_type, paths in specs.items()}
+    for source, specs in SPECS.items()
+}
+
+
+def spec_for(source, event_type):
+    """
+    Returns the compiled spec for a source ("githubmock" uses the spec of
+    "github") and event type, None when payloads are stored whole
+    """
+    specs = _trees.get(source)
+    if specs is None and source.endswith("mock"):
+        specs = _trees.get(source[:-len("mock")])
+    if specs is None:
+        return None
+    return specs.get(event_type, specs.get("*"))
+
+
+def project(source, event_type, payload):
+    """
+    Returns payload reduced to the fields in the spec for the source and
+    event type, or payload itself when there is none
+    """
+    tree = spec_for(source, event_type)
+    if tree is None:
+        return payload
+    projected = _project(payload, tree)
+    return {} if projected is _MISSING else projected
+
+
+def _project(value, tree):
+    if not tree:
+        return value
+    if "[]" in tree:
+        if not isinstance(value, list):
+            return _MISSING
+        return [item for item in (_project(element, tree["[]"]) for element in value) if item is not _MISSING]
+    if not isinstance(value, dict):
+        return _MISSING
+    projected = {}
+    for key, subtree in tree.items():
+        if key in value:
+            item = _project(value[key], subtree)
+            if item is not _MISSING:
+                projected[key] = item
+    return projected
+
+
+def apply(event, payload, enabled=None, archive=None, store=None):
+    """
+    Replaces the metadata of an events_raw row built by a worker with the
+    projection of payload (a dict, or its JSON text). The complete payload
+    is kept as the "blobs" of the row when a payload store is configured
+    (the metadata then references them), otherwise as its gzipped "archive"
+    when archiving. Returns the event, untouched when projection is
+    disabled; events without a spec are stored whole and not archived.
+    """
+    enabled = ENABLED if enabled is None else enabled
+    archive = ARCHIVE if archive is None else archive
+    if not enabled:
+        return event
+    store = blobstore.get_store() if store is None else store
+    tree = spec_for(event["source"], event["event_type"])
+    if tree is None:
+        return event
+    if isinstance(payload, str):
+        payload = json.loads(payload)
+
+    projected = _project(payload, tree)
+    if projected is _MISSING:
+        projected = {}
+    if store:
+        projected[blobstore.REFERENCE_KEY], event["blobs"] = blobstore.split(payload)
+    elif archive:
+        # workers already serialized the complete payload as the metadata, no need to do it twice
+        full = event["metadata"] if isinstance(event["metadata"], str) else json.dumps(payload)
+        event["archive"] = gzip.compress(full.encode("utf-8"), mtime=0)
+    event["metadata"] = json.dumps(projected)
+    return event
@@ -0,0 +1,89 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import gzip
+import json
+
+import projection
+
+
+def push_payload():
+    return {
+        "ref": "refs/heads/main",
+        "after": "b",
+        "repository": {"full_name": "fleetingclarity/fourkeys", "owner": {"login": "fleetingclarity"}},
+        "sender": {"login": "bench"},
+        "commits": [
+            {"id": "a", "timestamp": "2023-10-08T08:46:01+00:00", "modified": ["README.md"]},
+            {"id": "b", "timestamp": "2023-10-08T08:47:01+00:00", "modified": ["main.py"]},
+        ],
+        "head_commit": {"id": "b", "timestamp": "2023-10-08T08:47:01+00:00", "modified": ["main.py"]},
+        "attributes": {"headers": {"X-Github-Event": "push"}},
+    }
+
+
+def event(source, event_type, payload):
+    return {
+        "event_type": event_type,
+        "id": "b",
+        "metadata": json.dumps(payload),
+        "time_created": "2023-10-08T08:47:01+00:00",
+        "signature": "sha1=abc",
+        "msg_id": 1,
+        "source": source,
+    }
+
+
+def test_project_keeps_listed_fields():
+    assert projection.project("github", "push", push_payload()) == {
+        "ref": "refs/heads/main",
+        "after": "b",
+        "repository": {"full_name": "fleetingclarity/fourkeys"},
+        "commits": [
+            {"id": "a", "timestamp": "2023-10-08T08:46:01+00:00"},
+            {"id": "b", "timestamp": "2023-10-08T08:47:01+00:00"},
+        ],
+        "head_commit": {"id": "b", "timestamp": "2023-10-08T08:47:01+00:00"},
+    }
+
+
+def test_project_keeps_text_the_incidents_view_searches():
+    payload = {
+        "issue": {"number": 7, "body": "root cause: 2b04b6d3", "labels": [{"name": "Incident", "color": "f00"}],
+                  "user": {"login": "bench"}},
+    }
+
+    projected = projection.project("githubmock", "issues", payload)
+
+    assert projected == {"issue": {"number": 7, "body": "root cause: 2b04b6d3", "labels": [{"name": "Incident"}]}}
+
+
+def test_unlisted_event_types_stored_whole():
+    payload = {"pull_request": {"id": 1}, "repository": {"name": "fourkeys"}}
+    e = event("github", "pull_request", payload)
+
+    assert projection.project("github", "pull_request", payload) is payload
+    assert projection.apply(dict(e), payload, enabled=True, archive=True) == e
+
+
+def test_apply_disabled_leaves_event_untouched():
+    e = event("github", "push", push_payload())
+
+    assert projection.apply(dict(e), push_payload(), enabled=False) == e
+
+
+def test_apply_archives_complete_payload():
+    payload = push_payload()
+    e = projection.apply(event("github", "push", payload), payload, enabled=True, archive=True)
+
+    assert json.loads(e["metadata"]) == projection.project("github", "push", payload)
+    assert json.loads(gzip.decompress(e["archive"])) == payload
+
+
+def test_apply_parses_json_payload():
+    payload = push_payload()
+    e = event("github", "push", payload)
+
+    e = projection.apply(e, e["metadata"], enabled=True, archive=False)
+
+    assert json.loads(e["metadata"]) == projection.project("github", "push", payload)
+    assert "archive" not in e
@@ -1,11 +1,58 @@
 #  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
 
 
+import gzip
+import json
+import traceback
+import zlib
+
 import pika
 import pika.exceptions
 import time
+import jsonlog
 import shared
 
+log = jsonlog.get_logger('rabbit')
+
+# Envelope published by the event handler (see event-handler/messages.py): the
+# webhook body is the message body, delivery details are message properties.
+ENVELOPE_TYPE = 'fk.webhook.v2'
+PUBLISH_TIME_HEADER = 'X-Fk-Publish-Time'
+FINGERPRINT_HEADER = 'X-Fk-Fingerprint'
+GZIP_ENCODING = 'gzip'
+
+
+def decode_message(properties, body):
+    """
+    Parses a message from the fk_events exchange exactly once and returns it in
+    the layout the workers expect: the webhook payload plus the "attributes",
+    "publishTime" and "message_id" keys, and the "fingerprint" the handler
+    computed over the body. Messages published by older handlers already carry
+    those keys (except the fingerprint) inside the body. Compressed bodies (see the
+    content_encoding property) are decompressed first.
+
+    Raises ValueError for bodies that cannot be decoded or are not a JSON object.
+    """
+    if properties is not None and properties.content_encoding == GZIP_ENCODING:
+        try:
+            body = gzip.decompress(body)
+        except (OSError, EOFError, zlib.error) as e:
+            raise ValueError(f'unable to decompress message body: {e}') from e
+    msg = json.loads(body)
+    if not isinstance(msg, dict):
+        raise ValueError(f'message body is a JSON {type(msg).__name__}, not an object')
+
+    if properties is not None and properties.type == ENVELOPE_TYPE:
+        headers = dict(properties.headers or {})
+        msg['publishTime'] = headers.pop(PUBLISH_TIME_HEADER, None)
+        fingerprint = headers.pop(FINGERPRINT_HEADER, None)
+        if fingerprint:
+            msg['fingerprint'] = fingerprint
+        msg['attributes'] = {'headers': headers}
+        msg['message_id'] = int(properties.message_id)
+
+    return msg
+
 
 class RabbitMQConnector:
     def __init__(self, broker_address, exchange_name, queue_name, routing_key, max_retries=5, retry_delay=5):
@@ -30,14 +77,14 @@ class RabbitMQConnector:
             try:
                 return pika.BlockingConnection(parameters)
             except pika.exceptions.AMQPConnectionError:
-                print(f"failed to connect to RabbitMQ, retrying in {self.retry_delay} seconds...")
+                log.warning('failed to connect to RabbitMQ, retrying', retry_delay=self.retry_delay)
                 time.sleep(self.retry_delay)
         raise Exception(f"Failed to connect to RabbitMQ after multiple retries ({self.max_retries})")
 
     def setup(self):
-        print("creating connection to broker...")
+        log.info('creating connection to broker', broker_address=self.broker_address)
         self.connection = self.create_connection()
-        print("connected...")
+        log.info('connected to broker', broker_address=self.broker_address)
 
         self.channel = self.connection.channel()
         self.channel.exchange_declare(exchange=self.exchange_name, exchange_type='direct')
@@ -46,30 +93,98 @@ class RabbitMQConnector:
 
         self.channel.queue_bind(exchange=self.exchange_name, queue=self.queue_name, routing_key=self.routing_key)
 
-    def start_consuming(self, callback):
-        print(f' [*] Waiting for work in the {self.queue_name} queue. Press CTRL+C to exit')
+    def start_consuming_batches(self, parse, writer):
+        """
+        Consumes messages in batches: parse turns each delivery into an
+        events_raw row (or None to drop it), rows are written by writer and the
+        deliveries acked once the batch is committed
+        """
+        self.start_consuming(BatchConsumer(parse, writer, self.retry_delay), prefetch_count=writer.max_rows)
+
+    def start_consuming(self, callback, prefetch_count=None):
+        if prefetch_count:
+            self.channel.basic_qos(prefetch_count=prefetch_count)
+        log.info('waiting for work, press CTRL+C to exit', queue=self.queue_name)
         self.channel.basic_consume(
             queue=self.queue_name, on_message_callback=callback, auto_ack=False
         )
         try:
             self.channel.start_consuming()
         except pika.exceptions.ConnectionClosedByBroker:
-            print("Connection was closed by the broker.")
+            log.warning('connection was closed by the broker', queue=self.queue_name)
             self.channel.stop_consuming()
             self.connection.close()
-        except pika.exceptions.AMQPChannelError:
-            print("Caught a channel error.")
+        except pika.exceptions.AMQPChannelError as e:
+            log.error('caught a channel error', queue=self.queue_name, errors=str(e))
             self.channel.stop_consuming()
             self.connection.close()
         except KeyboardInterrupt:
-            print("CTRL+C detected, stopping...")
+            log.info('CTRL+C detected, stopping', queue=self.queue_name)
             self.channel.stop_consuming()
             self.connection.close()
         except Exception as e:
-            print(f"an unexpected error type={type(e)} occurred: {e}")
-            import traceback
-            traceback.print_exc()
+            log.error('unexpected error while consuming', queue=self.queue_name, error_type=type(e).__name__,
+                      errors=str(e), traceback=traceback.format_exc())
             self.channel.stop_consuming()
             self.connection.close()
         finally:
             shared.shutdown()
+
+
+class BatchConsumer(object):
+    """
+    Message callback adding parsed events to a shared.BatchWriter. The batch is
+    written when it is full or max_delay after its first message, then every
+    delivery up to the last one is acked at once. If the database cannot be
+    reached the deliveries are returned to the queue instead.
+    """
+
+    # seconds between two log entries with the write and signature cache totals
+    STATS_INTERVAL = 60
+
+    def __init__(self, parse, writer, retry_delay=5):
+        self.parse = parse
+        self.writer = writer
+        self.retry_delay = retry_delay
+        self.channel = None
+        self.last_delivery_tag = None
+        self.timer = None
+        self.stats_logged = time.monotonic()
+
+    def __call__(self, ch, method, properties, body):
+        self.channel = ch
+        event = self.parse(properties, body)
+        if event is not None:
+            self.writer.add(event)
+        self.last_delivery_tag = method.delivery_tag
+
+        if self.writer.full():
+            self.flush()
+        elif self.timer is None:
+            self.timer = ch.connection.call_later(self.writer.max_delay, self.flush)
+
+    def flush(self):
+        if self.timer is not None:
+            self.channel.connection.remove_timeout(self.timer)
+            self.timer = None
+        if self.last_delivery_tag is None:
+            return
+        delivery_tag, self.last_delivery_tag = self.last_delivery_tag, None
+
+        try:
+            result = self.writer.flush()
+        except Exception as e:
+            log.error(f'unable to write batch, requeueing it in {self.retry_delay}s', errors=e)
+            self.writer.clear()
+            # wait before handing the messages back so they are not redelivered straight into the same error
+            time.sleep(self.retry_delay)
+            self.channel.basic_nack(delivery_tag=delivery_tag, multiple=True, requeue=True)
+            return
+
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+        log.debug('wrote batch', inserted=result.inserted, duplicates=result.duplicates, last_delivery_tag=delivery_tag)
+        if time.monotonic() - self.stats_logged >= self.STATS_INTERVAL:
+            self.stats_logged = time.monotonic()
+            cache = self.writer.cache.stats()
+            log.info('write statistics', inserted=self.writer.inserted, duplicates=self.writer.duplicates,
+                     cache_hits=cache['hits'], cache_misses=cache['misses'], cache_hit_rate=cache['hit_rate'])
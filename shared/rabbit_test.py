@@ -1,11 +1,14 @@
 #  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
 
-from unittest.mock import patch, Mock
+import gzip
+import json
+from unittest.mock import Mock, patch
 
 import pika
 import pika.exceptions
+import pytest
 
-from rabbit import RabbitMQConnector
+from rabbit import BatchConsumer, decode_message, RabbitMQConnector
 
 
 def raise_exception(*args, **kwargs):
@@ -22,4 +25,115 @@ def test_connection_retries():
         connector = RabbitMQConnector("localhost", "exchange", "queue", "routing_key")
 
         # This should succeed on the 5th attempt
-        connection = connector.create_connection()
+        connector.create_connection()
+
+
+def test_decode_message_envelope():
+    properties = pika.BasicProperties(
+        type="fk.webhook.v2",
+        message_id="7116780781096697856",
+        headers={"X-Gitlab-Event": "Push Hook", "X-Fk-Publish-Time": "2023-10-08 13:46:01.606895"},
+    )
+
+    msg = decode_message(properties, b'{"object_kind": "push"}')
+
+    assert msg == {
+        "object_kind": "push",
+        "attributes": {"headers": {"X-Gitlab-Event": "Push Hook"}},
+        "publishTime": "2023-10-08 13:46:01.606895",
+        "message_id": 7116780781096697856,
+    }
+
+
+@pytest.mark.parametrize("body", [b"[]", b'"x"', b"1", b"null"])
+def test_decode_message_rejects_bodies_that_are_not_objects(body):
+    properties = pika.BasicProperties(type="fk.webhook.v2", message_id="1", headers={})
+
+    with pytest.raises(ValueError):
+        decode_message(properties, body)
+
+
+def test_decode_message_fingerprint():
+    properties = pika.BasicProperties(
+        type="fk.webhook.v2",
+        message_id="7116780781096697856",
+        headers={"X-Fk-Publish-Time": "2023-10-08 13:46:01.606895", "X-Fk-Fingerprint": "abc123"},
+    )
+
+    msg = decode_message(properties, b'{"object_kind": "push"}')
+
+    assert msg["fingerprint"] == "abc123"
+    assert msg["attributes"] == {"headers": {}}
+
+
+def test_decode_message_legacy_body():
+    legacy = {
+        "object_kind": "push",
+        "attributes": {"headers": {"X-Gitlab-Event": "Push Hook"}},
+        "publishTime": "2023-10-08 13:46:01.606895",
+        "message_id": 7116780781096697856,
+    }
+
+    assert decode_message(pika.BasicProperties(), json.dumps(legacy).encode()) == legacy
+    assert decode_message(None, json.dumps(legacy).encode()) == legacy
+
+
+def test_decode_message_gzip_body():
+    properties = pika.BasicProperties(
+        type="fk.webhook.v2", message_id="1", content_encoding="gzip", headers={"X-Github-Event": "push"},
+    )
+
+    msg = decode_message(properties, gzip.compress(b'{"ref": "main"}'))
+
+    assert msg["ref"] == "main"
+    assert msg["attributes"] == {"headers": {"X-Github-Event": "push"}}
+
+
+def test_decode_message_corrupt_gzip_body():
+    properties = pika.BasicProperties(type="fk.webhook.v2", message_id="1", content_encoding="gzip")
+
+    with pytest.raises(ValueError):
+        decode_message(properties, b'{"ref": "main"}')
+
+
+def test_batch_acked_after_write():
+    writer = Mock(max_delay=0.2)
+    writer.full.side_effect = [False, True]
+    channel = Mock()
+    consumer = BatchConsumer(lambda properties, body: {"signature": body}, writer)
+
+    consumer(channel, Mock(delivery_tag=1), None, b"one")
+    channel.connection.call_later.assert_called_once_with(0.2, consumer.flush)
+    consumer(channel, Mock(delivery_tag=2), None, b"two")
+
+    writer.flush.assert_called_once()
+    channel.basic_ack.assert_called_once_with(delivery_tag=2, multiple=True)
+    channel.connection.remove_timeout.assert_called_once()
+
+
+def test_batch_requeued_when_write_fails():
+    writer = Mock(max_delay=0.2)
+    writer.full.return_value = True
+    writer.flush.side_effect = Exception("database unavailable")
+    channel = Mock()
+    consumer = BatchConsumer(lambda properties, body: None, writer, retry_delay=0)
+
+    consumer(channel, Mock(delivery_tag=5), None, b"dropped")
+
+    channel.basic_nack.assert_called_once_with(delivery_tag=5, multiple=True, requeue=True)
+    channel.basic_ack.assert_not_called()
+    writer.add.assert_not_called()
+
+
+def test_unexpected_consumer_error_logged_with_traceback():
+    connector = RabbitMQConnector("localhost", "exchange", "queue", "routing_key")
+    connector.connection, connector.channel = Mock(), Mock()
+    connector.channel.start_consuming.side_effect = RuntimeError("boom")
+
+    with patch("rabbit.log") as log, patch("rabbit.shared.shutdown"):
+        connector.start_consuming(Mock())
+
+    message, fields = log.error.call_args.args[0], log.error.call_args.kwargs
+    assert message == "unexpected error while consuming" and fields["errors"] == "boom"
+    assert "RuntimeError: boom" in fields["traceback"]
+    connector.connection.close.assert_called_once()
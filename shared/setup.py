@@ -22,8 +22,10 @@ setup(
    author='fleetingclarity',
    author_email='fleetingclarity@proton.me',
    license='Apache-2.0',
-   py_modules=['shared', 'rabbit'],
+   py_modules=['shared', 'rabbit', 'jsonlog', 'dbpool', 'aioshared', 'sigcache', 'projection', 'blobstore', 'sketch'],
    install_requires=['psycopg2-binary', 'pika'],
+   # aioshared, the asyncio database layer
+   extras_require={'async': ['asyncpg>=0.28']},
    packages=find_packages(include=["shared*"]),
    zip_safe=False
 )
@@ -12,179 +12,488 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import collections
 import hashlib
 import json
 import os
-import time
-
-import psycopg2
-from psycopg2 import Error, OperationalError, extras, pool
-
-config = {
-    'host': os.environ.get('FK_DB_HOST'),
-    'user': os.environ.get('FK_DB_USER'),
-    'password': os.environ.get('FK_DB_PW'),
-    'port': os.environ.get('FK_DB_PORT', 5432),
-    'database': 'fourkeys'
-}
-
-MAX_RETRIES = 5
-BASE_WAIT_TIME = 2  # in seconds
-MIN_CONNS = 1
-MAX_CONNS = 5
-
-connection_pool = psycopg2.pool.SimpleConnectionPool(
-    MIN_CONNS,
-    MAX_CONNS,
-    database=config['database'],
-    user=config['user'],
-    password=config['password'],
-    host=config['host'],
-    port=config['port']
+import re
+from datetime import datetime
+
+from psycopg2 import Error, extras, InterfaceError, OperationalError
+
+import blobstore
+import dbpool
+import jsonlog
+import sigcache
+
+log = jsonlog.get_logger('shared')
+
+# events_raw rows written per transaction by BatchWriter, and how long a partial batch may wait
+BATCH_MAX_ROWS = int(os.environ.get('FK_BATCH_MAX_ROWS', 500))
+BATCH_MAX_DELAY = int(os.environ.get('FK_BATCH_MAX_DELAY_MS', 200)) / 1000
+
+# a change named as the cause of an incident, e.g. "root cause: 2b04b6d" in the body of an issue
+ROOT_CAUSE = re.compile(r"root cause: ([0-9A-Za-z]*)")
+
+# signatures this worker wrote recently, redelivered events are skipped without a query
+recent_signatures = sigcache.from_environ()
+
+# keys the event handler and Pub/Sub add around a webhook payload, they change with every delivery
+ENVELOPE_FIELDS = frozenset(
+    ["attributes", "publishTime", "publish_time", "message_id", "messageId", "fingerprint"]
 )
 
 
 def get_connection():
-    retries = 0
-    while retries < MAX_RETRIES:
-        try:
-            return connection_pool.getconn()
-        except (OperationalError, pool.PoolError) as e:
-            retries += 1
-            print(f'Failed to connect, attempt {retries} of {MAX_RETRIES}. Error: {e}')
-            time.sleep(BASE_WAIT_TIME * (2 ** retries))  # exponential backoff
-            continue
-    raise Exception("Unable to establish database connection from the pool after multiple retries.")
+    """
+    Checks a connection out of the pool, which is created on first use.
+    Raises OperationalError when the database is unreachable and
+    dbpool.PoolTimeout when every connection stays busy, callers decide
+    whether to retry.
+    """
+    return dbpool.get_pool().getconn()
 
 
-def return_connection(conn):
-    connection_pool.putconn(conn)
+def return_connection(conn, close=False):
+    dbpool.get_pool().putconn(conn, close=close)
 
 
 def shutdown():
-    if connection_pool:
-        connection_pool.closeall()
+    stats = dbpool.close_pool()
+    if stats:
+        log.info('database connection pool closed', **stats)
+    log.info('recent signature cache', **recent_signatures.stats())
 
 
 def insert_row_into_events_raw(event):
+    """
+    Inserts one event, returns True if it was inserted and False if an event
+    with the same signature is already stored
+    """
     if not event:
         raise Exception("No data to insert")
+    if recent_signatures.seen(row_key(event)):
+        return False
 
+    row = events_raw_row(event)
     connection = None
-    cursor = None
-
+    broken = False
     try:
         connection = get_connection()
+        inserted = insert_row(connection, EVENTS_RAW_INSERT, row, event=event)
+        if inserted is not None:
+            recent_signatures.add([row_key(event)])
+        return bool(inserted)
+    except (OperationalError, InterfaceError) as e:
+        broken = True
+        log.error('error inserting a row', errors=str(e), signature=event['signature'])
+    finally:
+        if connection:
+            return_connection(connection, close=broken)
+    return False
+
+
+# Sums of the rows written by a BatchWriter, or by a single flush
+WriteResult = collections.namedtuple('WriteResult', ['inserted', 'duplicates'])
+
+
+class BatchWriter(object):
+    """
+    Accumulates events_raw rows and writes them in a single transaction with
+    one multi-row insert; rows whose signature is already stored are skipped by
+    the database (ON CONFLICT DO NOTHING), so deduplication costs no query.
+
+    flush() raises when the database is unreachable so the caller can hand the
+    messages back to the broker; rows the database refuses are retried one by
+    one and logged, like insert_row_into_events_raw does. Events whose
+    signature and time are in the cache of recently written ones are not sent
+    at all.
+    """
+
+    def __init__(self, max_rows=BATCH_MAX_ROWS, max_delay=BATCH_MAX_DELAY, cache=None):
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.cache = cache if cache is not None else recent_signatures
+        self.events = []
+        self.skipped = 0
+        self.inserted = 0
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event):
+        """
+        Queues an event, returns False if it was recently written and is skipped
+        """
+        if self.cache.seen(row_key(event)):
+            self.skipped += 1
+            return False
+        self.events.append(event)
+        return True
+
+    def full(self):
+        return len(self.events) >= self.max_rows
 
-        if is_unique(connection, 'events_raw', event["signature"]):
-            # first check that we're inserting a string and not a python dict
-            if type(event['metadata']) is not str:
-                event['metadata'] = json.dumps(event['metadata'])
-
-            # Insert row
-            row_to_insert = [
-                (
-                    event["id"],
-                    event["event_type"],
-                    event["metadata"],
-                    event["time_created"],
-                    event["signature"],
-                    event["msg_id"],
-                    event["source"],
+    def clear(self):
+        self.events = []
+        self.skipped = 0
+
+    def flush(self):
+        """
+        Writes the pending events, returns a WriteResult with the number of
+        rows inserted and skipped as duplicates
+        """
+        events, self.events = self.events, []
+        skipped, self.skipped = self.skipped, 0
+        if not events:
+            self.duplicates += skipped
+            return WriteResult(0, skipped)
+
+        # the first of several events with the same signature wins, as with one insert per event
+        firsts = {}
+        for event in events:
+            firsts.setdefault(event['signature'], event)
+        rows = {signature: events_raw_row(event) for signature, event in firsts.items()}
+
+        connection = get_connection()
+        broken = False
+        try:
+            with connection.cursor() as cursor:
+                written = extras.execute_values(
+                    cursor, EVENTS_RAW_INSERT, list(rows.values()), page_size=len(rows), fetch=True
                 )
-            ]
-            cursor = connection.cursor()
-            insert_query = """
-            INSERT INTO events_raw (id, event_type, metadata, time_created, signature, msg_id, source)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """
+                # only events stored by this batch are archived, duplicates were archived with the original
+                stored = [firsts[signature] for signature, in written]
+                write_commits(cursor, stored)
+                write_deploys(cursor, stored)
+                write_incidents(cursor, stored)
+                write_payloads(cursor, stored)
+            connection.commit()
+            inserted = len(written)
+            committed = list(rows)
+        except (OperationalError, InterfaceError):
+            broken = True
+            raise
+        except Error as e:
+            connection.rollback()
+            log.warning("Batch not inserted, retrying rows one at a time", errors=str(e), rows=len(rows))
+            inserted = 0
+            committed = []
             try:
-                cursor.executemany(insert_query, row_to_insert)
-                connection.commit()
-            except Error as e:
-                entry = {
-                    "severity": "WARNING",
-                    "msg": "Row not inserted.",
-                    "errors": str(e),
-                    "row": row_to_insert,
-                }
-                print(json.dumps(entry))
+                for signature, row in rows.items():
+                    outcome = insert_row(connection, EVENTS_RAW_INSERT, row, event=firsts[signature])
+                    if outcome is not None:
+                        committed.append(signature)
+                    inserted += bool(outcome)
+            except (OperationalError, InterfaceError):
+                broken = True
+                raise
+        finally:
+            return_connection(connection, close=broken)
+
+        self.cache.add(row_key(firsts[signature]) for signature in committed)
+        result = WriteResult(inserted, len(events) - inserted - (len(rows) - len(committed)) + skipped)
+        self.inserted += result.inserted
+        self.duplicates += result.duplicates
+        return result
+
+
+def row_key(event):
+    """
+    Returns what identifies the events_raw row of an event, as its primary
+    key (signature, time_created) does
+    """
+    return event['signature'], event['time_created']
+
+
+def events_raw_row(event):
+    metadata = event['metadata']
+    # first check that we're inserting a string and not a python dict
+    if type(metadata) is not str:
+        metadata = json.dumps(metadata)
+    return (
+        event["id"],
+        event["event_type"],
+        metadata,
+        event["time_created"],
+        event["signature"],
+        event["msg_id"],
+        event["source"],
+    )
+
+
+def write_payloads(cursor, events):
+    """
+    Stores the complete payloads projection.apply set aside for events that
+    were just inserted, in the transaction of the cursor: the gzipped archive
+    rows, or the blobs of the payload store
+    """
+    archived = []
+    blobs = {}
+    for event in events:
+        if event.get("archive"):
+            archived.append((
+                event["signature"],
+                event["source"],
+                event["event_type"],
+                event["time_created"],
+                event["archive"],
+            ))
+        if event.get("blobs"):
+            blobs.update(event["blobs"])
+
+    if archived:
+        extras.execute_values(cursor, EVENTS_RAW_ARCHIVE_INSERT, archived, page_size=len(archived))
+    if blobs:
+        blobstore.get_store().write(cursor, blobs)
+
+
+def parse_time(timestamp):
+    """
+    Returns a timestamp of a payload as a naive datetime, None when it
+    cannot be parsed. Like a Postgres cast to TIMESTAMP, the UTC offset is
+    dropped rather than applied.
+    """
+    if not isinstance(timestamp, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except ValueError:
+        try:
+            # GitLab sometimes sends "2021-04-28 21:50:00 +0200"
+            parsed = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S %z')
+        except ValueError:
+            return None
+    return parsed.replace(tzinfo=None)
+
+
+def parse_commit_time(timestamp):
+    """
+    Returns the time of a commit as a naive datetime truncated to the
+    second, None when it cannot be parsed
+    """
+    parsed = parse_time(timestamp)
+    return parsed.replace(microsecond=0) if parsed is not None else None
+
+
+def commit_rows(source, commits, repo):
+    """
+    Returns the commits rows of a push: (source, change_id, time_created,
+    repo) for every commit with an id and a time
+    """
+    rows = []
+    for commit in commits or ():
+        change_id = commit.get('id') if isinstance(commit, dict) else None
+        time_created = parse_commit_time(commit.get('timestamp')) if change_id else None
+        if time_created is not None:
+            rows.append((source, change_id, time_created, repo))
+    return rows
+
+
+def write_commits(cursor, events):
+    """
+    Inserts the commits rows workers attached to events that were just
+    inserted, in the transaction of the cursor
+    """
+    # sorted, so concurrent batches with commits in common lock them in the same order
+    rows = sorted(set(row for event in events for row in event.get("commits") or ()))
+    if rows:
+        extras.execute_values(cursor, COMMITS_INSERT, rows, page_size=len(rows))
+
+
+def deploy_rows(event, main_commits, additional_commits=()):
+    """
+    Returns the deploy_events rows of a successful deploy event, one for
+    each commit it deployed, all with the additional commits it shipped
+    """
+    additional = [str(commit) for commit in additional_commits if commit]
+    return [
+        (event["signature"], event["source"], str(event["id"]), event["time_created"], str(commit), additional,
+         event["msg_id"])
+        for commit in main_commits if commit
+    ]
+
+
+def write_deploys(cursor, events):
+    """
+    Inserts the deploy_events rows workers attached to events that were
+    just inserted, in the transaction of the cursor, and links every commit
+    of the deploys to the event with its id: in deployment_changes when that
+    event is stored, in pending_deployment_links for the metrics refresher
+    to resolve when it arrives
+    """
+    rows = [row for event in events for row in event.get("deploys") or ()]
+    if not rows:
+        return
+    extras.execute_values(cursor, DEPLOY_EVENTS_INSERT, rows, page_size=len(rows))
+    links = sorted(set(
+        (source, deploy_id, commit)
+        for _, source, deploy_id, _, main_commit, additional, _ in rows
+        for commit in [main_commit] + additional
+    ))
+    extras.execute_values(cursor, DEPLOYMENT_LINKS_INSERT, links, page_size=len(links))
+
+
+def root_cause(payload):
+    """
+    Returns the change a payload names as the cause of an incident with
+    "root cause: <sha>" in any of its strings, None when there is none
+    """
+    if isinstance(payload, str):
+        match = ROOT_CAUSE.search(payload)
+        return match.group(1) if match and match.group(1) else None
+    values = payload.values() if isinstance(payload, dict) else payload if isinstance(payload, list) else ()
+    for value in values:
+        found = root_cause(value)
+        if found:
+            return found
+    return None
+
+
+def incident_rows(event, incident_id, time_created, time_resolved, cause, bug):
+    """
+    Returns the incident_events row of an issue or incident event, none
+    when it names no incident
+    """
+    if incident_id is None:
+        return []
+    return [(event["signature"], event["source"], str(incident_id), parse_time(time_created),
+             parse_time(time_resolved), cause, bug, event["msg_id"])]
+
+
+def write_incidents(cursor, events):
+    """
+    Inserts the incident_events rows workers attached to events that were
+    just inserted, in the transaction of the cursor
+    """
+    rows = [row for event in events for row in event.get("incidents") or ()]
+    if rows:
+        extras.execute_values(cursor, INCIDENT_EVENTS_INSERT, rows, page_size=len(rows))
+
+
+def insert_row(connection, query, row, event=None):
+    """
+    Inserts and commits one row, with the payloads of its event when it was
+    inserted. Returns True if it was inserted, False for a duplicate and None
+    for rows the database refuses (logged); connection errors are raised
+    """
+    try:
+        with connection.cursor() as cursor:
+            inserted = bool(extras.execute_values(cursor, query, [row], fetch=True))
+            if inserted and event is not None:
+                write_commits(cursor, [event])
+                write_deploys(cursor, [event])
+                write_incidents(cursor, [event])
+                write_payloads(cursor, [event])
+        connection.commit()
+        return inserted
+    except (OperationalError, InterfaceError):
+        raise
     except Error as e:
-        print(f'error inserting a row: {e}')
         connection.rollback()
-    finally:
-        if cursor:
-            cursor.close()
-        if connection:
-            return_connection(connection)
+        log.warning("Row not inserted.", errors=str(e), row=row)
+        return None
+
+
+# signature is unique (with time_created, which partitions events_raw), a redelivered or
+# replayed event is skipped by the insert itself
+EVENTS_RAW_INSERT = """
+INSERT INTO events_raw (id, event_type, metadata, time_created, signature, msg_id, source)
+VALUES %s
+ON CONFLICT (signature, time_created) DO NOTHING
+RETURNING signature
+"""
+
+# complete payloads of events whose metadata was projected, gzipped (see projection.py)
+EVENTS_RAW_ARCHIVE_INSERT = """
+INSERT INTO events_raw_archive (signature, source, event_type, time_created, payload)
+VALUES %s
+ON CONFLICT (signature) DO NOTHING
+"""
+
+# the same commit is pushed again with every branch it is merged to
+COMMITS_INSERT = """
+INSERT INTO commits (source, change_id, time_created, repo)
+VALUES %s
+ON CONFLICT DO NOTHING
+"""
+
+DEPLOY_EVENTS_INSERT = """
+INSERT INTO deploy_events (signature, source, deploy_id, time_created, main_commit, additional_commits, msg_id)
+VALUES %s
+ON CONFLICT DO NOTHING
+"""
+
+# a deploy is linked to the changes of the event whose id is its commit (see
+# commit_changes in init-db.sql), or queued until that event arrives
+DEPLOYMENT_LINKS_INSERT = """
+WITH links (source, deploy_id, commit_id) AS (
+    VALUES %s
+),
+linked AS (
+    INSERT INTO deployment_changes (source, deploy_id, commit_id, changes)
+    SELECT source, deploy_id, commit_id, commit_changes(commit_id)
+    FROM links
+    WHERE EXISTS (SELECT 1 FROM events_raw e WHERE e.id = links.commit_id)
+    ON CONFLICT DO NOTHING
+)
+INSERT INTO pending_deployment_links (commit_id, source, deploy_id)
+SELECT commit_id, source, deploy_id
+FROM links
+WHERE NOT EXISTS (SELECT 1 FROM events_raw e WHERE e.id = links.commit_id)
+ON CONFLICT DO NOTHING
+"""
+
+INCIDENT_EVENTS_INSERT = """
+INSERT INTO incident_events (signature, source, incident_id, time_created, time_resolved, root_cause, bug, msg_id)
+VALUES %s
+ON CONFLICT DO NOTHING
+"""
+
+EVENTS_ENRICHED_INSERT = """
+INSERT INTO events_enriched (events_raw_signature, enriched_metadata)
+VALUES %s
+ON CONFLICT (events_raw_signature) DO NOTHING
+RETURNING events_raw_signature
+"""
 
 
 def insert_row_into_events_enriched(event):
+    """
+    Inserts the enrichment of one event, returns True if it was inserted and
+    False if the event was already enriched
+    """
     if not event:
         raise Exception("No data to insert")
 
+    row = (event["events_raw_signature"], json.dumps(event["enriched_metadata"]))
     connection = None
-    cursor = None
+    broken = False
     try:
         connection = get_connection()
-
-        if is_unique(connection, 'events_enriched', event["events_raw_signature"]):
-            # Insert row
-            row_to_insert = [
-                (
-                    event["events_raw_signature"],
-                    json.dumps(event["enriched_metadata"])
-                )
-            ]
-            insert_query = """
-            INSERT INTO events_enriched (events_raw_signature, enriched_metadata)
-            VALUES (%s, %s)
-            """
-            try:
-                cursor = connection.cursor()
-                cursor.executemany(insert_query, row_to_insert)
-                connection.commit()
-            except Error as e:
-                entry = {
-                    "severity": "WARNING",
-                    "msg": "Row not inserted.",
-                    "errors": e,
-                    "row": row_to_insert,
-                }
-                print(json.dumps(entry))
-
-    except Error as e:
-        print(f'error inserting enriched: {e}')
-        connection.rollback()
+        return bool(insert_row(connection, EVENTS_ENRICHED_INSERT, row))
+    except (OperationalError, InterfaceError) as e:
+        broken = True
+        log.error('error inserting enriched', errors=str(e), signature=event['events_raw_signature'])
     finally:
-        if cursor:
-            cursor.close()
         if connection:
-            return_connection(connection)
-
-
-def is_unique(connection, table, signature):
-    cursor = connection.cursor()
-    sql = f"SELECT {SIGNATURE_FIELDS[table]} FROM {table} WHERE {SIGNATURE_FIELDS[table]} = '{signature}';"
-    result = None
-    try:
-        cursor.execute(sql)
-        result = cursor.fetchall()
-    except Error as e:
-        print(f'stuff about the failure: {e}')
-        connection.rollback()
-    finally:
-        if cursor:
-            cursor.close()
-    return not result
+            return_connection(connection, close=broken)
+    return False
 
 
 def create_unique_id(msg):
-    hashed = hashlib.sha1(bytes(json.dumps(msg), "utf-8"))
-    return hashed.hexdigest()
-
+    """
+    Returns the signature of the event in msg, the same for every delivery of
+    the same webhook. That is the fingerprint the event handler computed over
+    the webhook body when the message carries one, otherwise a SHA-256 of the
+    payload serialized canonically, leaving out the envelope fields that
+    differ between deliveries (ENVELOPE_FIELDS).
+    """
+    fingerprint = msg.get("fingerprint")
+    if fingerprint:
+        return fingerprint
 
-SIGNATURE_FIELDS = {
-    "events_raw": "signature",
-    "events_enriched": "events_raw_signature"
-}
+    payload = {key: value for key, value in msg.items() if key not in ENVELOPE_FIELDS}
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
@@ -0,0 +1,242 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+from datetime import datetime
+from unittest import mock
+
+import psycopg2
+import pytest
+
+# this directory is collected as the shared package, the module under test is shared.shared
+from shared import shared
+import sigcache
+
+
+def event(signature, event_id="1"):
+    return {
+        "id": event_id,
+        "event_type": "push",
+        "metadata": {"ref": "main"},
+        "time_created": "2023-10-08 08:46:01",
+        "signature": signature,
+        "msg_id": 7116780781096697856,
+        "source": "github",
+    }
+
+
+@pytest.fixture
+def connection():
+    connection = mock.MagicMock()
+    with mock.patch.object(shared, "get_connection", return_value=connection), \
+            mock.patch.object(shared, "return_connection") as return_connection, \
+            mock.patch.object(shared, "recent_signatures", sigcache.SignatureCache()):
+        connection.return_connection = return_connection
+        yield connection
+
+
+def test_batch_written_in_one_statement(connection):
+    writer = shared.BatchWriter(max_rows=3)
+    for signature in ("a", "stored", "b", "a"):
+        writer.add(event(signature))
+
+    # the database only returns the rows it inserted, "stored" conflicts with an existing row
+    with mock.patch.object(shared.extras, "execute_values", return_value=[("a",), ("b",)]) as execute_values:
+        assert writer.full()
+        assert writer.flush() == (2, 2)
+
+    query, rows = execute_values.call_args.args[1:3]
+    assert "ON CONFLICT (signature, time_created) DO NOTHING" in query
+    assert [row[4] for row in rows] == ["a", "stored", "b"]
+    assert rows[0][2] == '{"ref": "main"}'
+    connection.commit.assert_called_once()
+    assert len(writer) == 0
+    assert (writer.inserted, writer.duplicates) == (2, 2)
+
+
+def test_archive_written_for_inserted_events_only(connection):
+    writer = shared.BatchWriter()
+    writer.add(dict(event("a"), archive=b"gzipped a"))
+    writer.add(dict(event("stored"), archive=b"gzipped stored"))
+    writer.add(event("b"))
+
+    with mock.patch.object(shared.extras, "execute_values", side_effect=[[("a",), ("b",)], None]) as execute_values:
+        assert writer.flush() == (2, 1)
+
+    query, rows = execute_values.call_args_list[1].args[1:3]
+    assert "INSERT INTO events_raw_archive" in query
+    assert rows == [("a", "github", "push", "2023-10-08 08:46:01", b"gzipped a")]
+    connection.commit.assert_called_once()
+
+
+def test_blobs_written_for_inserted_event(connection):
+    store = mock.MagicMock()
+    with mock.patch.object(shared.extras, "execute_values", return_value=[("a",)]), \
+            mock.patch.object(shared.blobstore, "get_store", return_value=store):
+        assert shared.insert_row_into_events_raw(dict(event("a"), blobs={"ab" * 32: b"data"}))
+
+    cursor = connection.cursor.return_value.__enter__.return_value
+    store.write.assert_called_once_with(cursor, {"ab" * 32: b"data"})
+    connection.commit.assert_called_once()
+
+
+def test_commits_written_with_inserted_events_only(connection):
+    commit = ("github", "c1", datetime(2023, 10, 8, 8, 46, 1), "fleetingclarity/fourkeys")
+    other = ("github", "c2", datetime(2023, 10, 8, 8, 47, 1), "fleetingclarity/fourkeys")
+    writer = shared.BatchWriter()
+    writer.add(dict(event("a"), commits=[commit, other]))
+    writer.add(dict(event("stored"), commits=[("github", "c0", datetime(2023, 10, 7), None)]))
+    writer.add(dict(event("b"), commits=[commit]))
+
+    with mock.patch.object(shared.extras, "execute_values", side_effect=[[("a",), ("b",)], None]) as execute_values:
+        assert writer.flush() == (2, 1)
+
+    query, rows = execute_values.call_args_list[1].args[1:3]
+    assert "INSERT INTO commits" in query
+    assert rows == [commit, other]
+    connection.commit.assert_called_once()
+
+
+def test_deploys_written_and_linked(connection):
+    deploy = dict(event("d", event_id=42), event_type="deployment_status")
+    deploy["deploys"] = shared.deploy_rows(deploy, ["main"], ["c1", "main", None])
+
+    with mock.patch.object(shared.extras, "execute_values", side_effect=[[("d",)], None, None]) as execute_values:
+        assert shared.insert_row_into_events_raw(deploy)
+
+    query, rows = execute_values.call_args_list[1].args[1:3]
+    assert "INSERT INTO deploy_events" in query
+    assert rows == [("d", "github", "42", "2023-10-08 08:46:01", "main", ["c1", "main"], 7116780781096697856)]
+    query, links = execute_values.call_args_list[2].args[1:3]
+    assert "INSERT INTO pending_deployment_links" in query
+    assert links == [("github", "42", "c1"), ("github", "42", "main")]
+    connection.commit.assert_called_once()
+
+
+def test_incidents_written_with_inserted_event(connection):
+    issue = dict(event("i", event_id="fourkeys/614"), event_type="issues")
+    issue["incidents"] = shared.incident_rows(issue, 614, "2023-10-08T08:46:01Z", None, "0834a2e", True)
+
+    with mock.patch.object(shared.extras, "execute_values", side_effect=[[("i",)], None]) as execute_values:
+        assert shared.insert_row_into_events_raw(issue)
+
+    query, rows = execute_values.call_args_list[1].args[1:3]
+    assert "INSERT INTO incident_events" in query
+    assert rows == [("i", "github", "614", datetime(2023, 10, 8, 8, 46, 1), None, "0834a2e", True, 7116780781096697856)]
+    assert shared.incident_rows(issue, None, None, None, None, None) == []
+
+
+def test_root_cause():
+    assert shared.root_cause({"issue": {"title": "down", "body": "root cause: 0834a2e, reverted"}}) == "0834a2e"
+    assert shared.root_cause({"comments": [{"body": "root cause: "}, {"body": "root cause: b4e0e6c"}]}) == "b4e0e6c"
+    assert shared.root_cause({"issue": {"number": 614, "body": None}}) is None
+
+
+def test_commit_rows():
+    commits = [
+        {"id": "c1", "timestamp": "2023-10-08T10:46:01.123+02:00"},
+        {"id": "c2", "timestamp": "2021-04-28 21:50:00 +0200"},
+        {"id": "c3", "timestamp": "2023-10-08T08:46:01Z"},
+        {"id": "c4", "timestamp": "yesterday"},
+        {"timestamp": "2023-10-08T08:46:01Z"},
+    ]
+
+    assert shared.commit_rows("gitlab", commits, "group/project") == [
+        ("gitlab", "c1", datetime(2023, 10, 8, 10, 46, 1), "group/project"),
+        ("gitlab", "c2", datetime(2021, 4, 28, 21, 50, 0), "group/project"),
+        ("gitlab", "c3", datetime(2023, 10, 8, 8, 46, 1), "group/project"),
+    ]
+    assert shared.commit_rows("github", None, "r") == []
+
+
+def test_refused_batch_retried_row_by_row(connection):
+    writer = shared.BatchWriter()
+    writer.add(event("a"))
+    writer.add(event("b"))
+
+    refused = [psycopg2.DataError("bad timestamp"), psycopg2.DataError("bad timestamp"), [("b",)]]
+    with mock.patch.object(shared.extras, "execute_values", side_effect=refused):
+        # the refused row is neither inserted nor a duplicate, and is not cached
+        assert writer.flush() == (1, 0)
+
+    assert connection.rollback.call_count == 2
+    assert not shared.recent_signatures.seen(shared.row_key(event("a")))
+
+
+def test_single_insert_reports_duplicates(connection):
+    with mock.patch.object(shared.extras, "execute_values", side_effect=[[("a",)], []]):
+        assert shared.insert_row_into_events_raw(event("a"))
+        assert not shared.insert_row_into_events_raw(event("b"))
+
+    assert connection.commit.call_count == 2
+
+
+def test_recently_written_events_skip_the_database(connection):
+    writer = shared.BatchWriter()
+    writer.add(event("a"))
+    with mock.patch.object(shared.extras, "execute_values", return_value=[("a",)]):
+        writer.flush()
+
+    with mock.patch.object(shared.extras, "execute_values") as execute_values:
+        assert not writer.add(event("a"))
+        assert writer.flush() == (0, 1)
+        assert not shared.insert_row_into_events_raw(event("a"))
+
+    execute_values.assert_not_called()
+    assert shared.recent_signatures.stats()["hits"] == 2
+
+
+def test_recently_written_signature_at_another_time_is_written(connection):
+    writer = shared.BatchWriter()
+    writer.add(event("a"))
+    with mock.patch.object(shared.extras, "execute_values", return_value=[("a",)]):
+        writer.flush()
+
+    # events_raw is keyed on (signature, time_created), the database stores this one
+    assert writer.add(dict(event("a"), time_created="2023-10-09 08:46:01"))
+
+
+def test_failed_batch_not_cached(connection):
+    connection.commit.side_effect = psycopg2.OperationalError("server closed the connection")
+    writer = shared.BatchWriter()
+    writer.add(event("a"))
+
+    with mock.patch.object(shared.extras, "execute_values", return_value=[("a",)]):
+        with pytest.raises(psycopg2.OperationalError):
+            writer.flush()
+
+    assert not shared.recent_signatures.seen(shared.row_key(event("a")))
+
+
+def test_enriched_insert_skips_existing(connection):
+    with mock.patch.object(shared.extras, "execute_values", return_value=[]) as execute_values:
+        inserted = shared.insert_row_into_events_enriched(
+            {"events_raw_signature": "a", "enriched_metadata": {"team": "platform"}}
+        )
+
+    assert not inserted
+    assert "ON CONFLICT (events_raw_signature) DO NOTHING" in execute_values.call_args.args[1]
+    assert execute_values.call_args.args[2] == [("a", '{"team": "platform"}')]
+
+
+def test_unreachable_database_raises(connection):
+    connection.cursor.side_effect = psycopg2.OperationalError("server closed the connection")
+    writer = shared.BatchWriter()
+    writer.add(event("a"))
+
+    with pytest.raises(psycopg2.OperationalError):
+        writer.flush()
+
+    connection.return_connection.assert_called_once_with(connection, close=True)
+
+
+def test_unique_id_ignores_envelope():
+    first = {"object_kind": "push", "ref": "main", "attributes": {"headers": {}},
+             "publishTime": "2023-10-08 13:46:01", "message_id": 1}
+    redelivered = {"message_id": 2, "publishTime": "2023-10-08 13:47:30", "attributes": {"headers": {"X": "y"}},
+                   "ref": "main", "object_kind": "push"}
+
+    assert shared.create_unique_id(first) == shared.create_unique_id(redelivered)
+    assert shared.create_unique_id(first) != shared.create_unique_id(dict(first, ref="release"))
+
+
+def test_unique_id_prefers_handler_fingerprint():
+    assert shared.create_unique_id({"object_kind": "push", "fingerprint": "abc123"}) == "abc123"
@@ -0,0 +1,89 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Bounded in-memory record of the events a worker has recently written.
+
+Redelivered messages and webhook retries carry the signature of an event that
+is already stored; checking it here skips the database round trip entirely.
+Events are remembered by the primary key of their events_raw row, signature
+and time_created (see shared.row_key), so an event the database would store
+is never skipped. Only rows known to be committed are added, so a hit is
+always a true duplicate, while a miss simply falls through to the database,
+which still deduplicates with ON CONFLICT.
+
+Configured from the environment:
+
+    FK_SIGNATURE_CACHE_SIZE         signatures remembered, 0 disables the cache (default 100000)
+    FK_SIGNATURE_CACHE_TTL_SECONDS  how long a signature is remembered (default 3600)
+"""
+
+import collections
+import os
+import threading
+import time
+
+
+class SignatureCache(object):
+    """
+    LRU of signatures with a time to live, safe to share between threads
+    """
+
+    def __init__(self, max_size=100000, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # signature -> time it was added, least recently used first
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def seen(self, signature):
+        """
+        Returns True if the signature was stored within the time to live
+        """
+        if not self.max_size:
+            return False
+        with self.lock:
+            added = self.entries.get(signature)
+            if added is not None and time.monotonic() - added <= self.ttl:
+                self.entries.move_to_end(signature)
+                self.hits += 1
+                return True
+            if added is not None:
+                del self.entries[signature]
+            self.misses += 1
+            return False
+
+    def add(self, signatures):
+        """
+        Remembers signatures whose rows are committed
+        """
+        if not self.max_size:
+            return
+        now = time.monotonic()
+        with self.lock:
+            for signature in signatures:
+                self.entries[signature] = now
+                self.entries.move_to_end(signature)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+def from_environ(environ=os.environ):
+    return SignatureCache(
+        max_size=int(environ.get('FK_SIGNATURE_CACHE_SIZE', 100000)),
+        ttl=float(environ.get('FK_SIGNATURE_CACHE_TTL_SECONDS', 3600)),
+    )
@@ -0,0 +1,43 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+from unittest import mock
+
+import sigcache
+
+
+def test_seen_after_add():
+    cache = sigcache.SignatureCache()
+
+    assert not cache.seen("a")
+    cache.add(["a"])
+
+    assert cache.seen("a")
+    assert cache.stats() == {"size": 1, "hits": 1, "misses": 1, "hit_rate": 0.5}
+
+
+def test_least_recently_used_evicted():
+    cache = sigcache.SignatureCache(max_size=2)
+    cache.add(["a", "b"])
+    cache.seen("a")
+    cache.add(["c"])
+
+    assert cache.seen("a")
+    assert not cache.seen("b")
+    assert cache.seen("c")
+
+
+def test_expired_signatures_forgotten():
+    cache = sigcache.SignatureCache(ttl=60)
+    with mock.patch("sigcache.time.monotonic", return_value=1000):
+        cache.add(["a"])
+    with mock.patch("sigcache.time.monotonic", return_value=1061):
+        assert not cache.seen("a")
+
+    assert len(cache) == 0
+
+
+def test_disabled_cache_never_hits():
+    cache = sigcache.from_environ({"FK_SIGNATURE_CACHE_SIZE": "0"})
+    cache.add(["a"])
+
+    assert not cache.seen("a")
@@ -0,0 +1,102 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Mergeable quantile sketches of the lead and restore times of daily_metrics.
+
+The exact percentiles of a range of days need every time of the range
+sorted again. A sketch instead counts the times of a day, source and
+repository in logarithmic bins, as in DDSketch (Masson et al., VLDB 2019): with
+gamma = (1 + alpha) / (1 - alpha), bin i counts the values in
+(gamma^(i-1), gamma^i] and stands for 2 gamma^i / (gamma + 1), which is
+within a relative error of alpha of every value in the bin. Merging
+sketches adds up the counts of their bins and loses nothing, so for any
+number of merged sketches
+
+    |quantile(sketch, q) - x| <= alpha * x
+
+where x is the value of rank floor(q * (n - 1)) among the n values the
+sketches were built from (the lower median for q = 0.5). With the default
+alpha of 1% a year of durations fits in fewer than 700 bins, a day of them
+in a few dozen. Values of MIN_VALUE or less are counted apart and come
+back as 0.
+
+Sketches are JSON objects, stored as JSONB by the metrics refresher:
+
+    {"alpha": 0.01, "zeros": 0, "bins": {"<i>": <count>, ...}}
+
+sketch_merge and sketch_quantile in init-db.sql do what merge and quantile
+do here in SQL, for the dashboard, over any days, sources and repositories.
+Only sketches of the same alpha merge.
+"""
+
+import math
+
+ALPHA = 0.01
+
+# durations below a millisecond in the units they are kept in are no durations
+MIN_VALUE = 1e-9
+
+
+def gamma(alpha):
+    return (1 + alpha) / (1 - alpha)
+
+
+def build(values, alpha=ALPHA):
+    """
+    Returns the sketch of the given values, None values are skipped
+    """
+    log_gamma = math.log(gamma(alpha))
+    zeros = 0
+    bins = {}
+    for value in values or ():
+        if value is None:
+            continue
+        if value <= MIN_VALUE:
+            zeros += 1
+            continue
+        key = str(math.ceil(math.log(value) / log_gamma))
+        bins[key] = bins.get(key, 0) + 1
+    return {"alpha": alpha, "zeros": zeros, "bins": bins}
+
+
+def merge(sketches):
+    """
+    Returns the sketch of all the values of the given sketches, None for
+    none; raises ValueError for sketches of different alphas
+    """
+    merged = None
+    for sketch in sketches:
+        if sketch is None:
+            continue
+        if merged is None:
+            merged = {"alpha": sketch["alpha"], "zeros": 0, "bins": {}}
+        elif sketch["alpha"] != merged["alpha"]:
+            raise ValueError(f"cannot merge sketches of alpha {merged['alpha']} and {sketch['alpha']}")
+        merged["zeros"] += sketch["zeros"]
+        for key, count in sketch["bins"].items():
+            merged["bins"][key] = merged["bins"].get(key, 0) + count
+    return merged
+
+
+def count(sketch):
+    return sketch["zeros"] + sum(sketch["bins"].values())
+
+
+def quantile(sketch, q):
+    """
+    Returns the estimate of the q-quantile (0 <= q <= 1) of the values of
+    the sketch, None when it is empty
+    """
+    total = count(sketch) if sketch else 0
+    if not total:
+        return None
+    rank = math.floor(min(max(q, 0.0), 1.0) * (total - 1))
+    if rank < sketch["zeros"]:
+        return 0.0
+    seen = sketch["zeros"]
+    g = gamma(sketch["alpha"])
+    for index in sorted(int(key) for key in sketch["bins"]):
+        seen += sketch["bins"][str(index)]
+        if seen > rank:
+            return 2 * g ** index / (g + 1)
+    raise AssertionError("rank beyond the count of the sketch")
@@ -0,0 +1,86 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+import json
+import math
+import random
+
+import pytest
+
+import sketch
+
+
+def lead_times(rng, days):
+    """
+    Lead times in minutes of days of deployments: mostly hours, some weeks
+    """
+    return [[rng.lognormvariate(5, 2) for _ in range(rng.randint(0, 40))] for _ in range(days)]
+
+
+def exact(values, q):
+    return sorted(values)[math.floor(q * (len(values) - 1))]
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("alpha", [0.01, 0.05])
+def test_merged_quantiles_within_relative_error(seed, alpha):
+    rng = random.Random(seed)
+    days = lead_times(rng, 365)
+    values = [value for day in days for value in day]
+
+    merged = sketch.merge(sketch.build(day, alpha) for day in days)
+
+    assert sketch.count(merged) == len(values)
+    for q in (0, 0.5, 0.9, 0.99, 1):
+        x = exact(values, q)
+        assert abs(sketch.quantile(merged, q) - x) <= alpha * x
+
+
+def test_merging_loses_nothing():
+    rng = random.Random(7)
+    days = lead_times(rng, 30)
+
+    merged = sketch.merge(sketch.build(day) for day in days)
+
+    assert merged == sketch.build([value for day in days for value in day])
+
+
+def test_a_year_of_durations_fits_in_few_bins():
+    minutes_in_a_year = 365 * 24 * 60
+    every_minute = sketch.build(range(1, minutes_in_a_year + 1, 7))
+
+    assert len(every_minute["bins"]) < 700
+
+
+def test_zeros_and_missing_values():
+    built = sketch.build([0, 0.0, -3, None, 10])
+
+    assert built["zeros"] == 3 and sketch.count(built) == 4
+    assert sketch.quantile(built, 0.5) == 0.0
+    assert sketch.quantile(built, 1) == pytest.approx(10, rel=sketch.ALPHA)
+
+
+def test_empty_sketches():
+    assert sketch.quantile(sketch.build([]), 0.5) is None
+    assert sketch.merge([None, None]) is None
+    assert sketch.quantile(None, 0.5) is None
+
+
+def test_sketches_of_different_alphas_do_not_merge():
+    with pytest.raises(ValueError):
+        sketch.merge([sketch.build([1], 0.01), sketch.build([1], 0.02)])
+
+
+def test_sketch_survives_json():
+    built = sketch.build([1.5, 90, 3000])
+
+    assert sketch.quantile(json.loads(json.dumps(built)), 0.5) == sketch.quantile(built, 0.5)
+
+
+def test_repository_sketches_merge_into_any_subset():
+    rng = random.Random(11)
+    repos = {repo: lead_times(rng, 30) for repo in ("api", "web", "infra")}
+    sketches = {repo: [sketch.build(day) for day in days] for repo, days in repos.items()}
+
+    team = sketch.merge(built for repo in ("api", "web") for built in sketches[repo])
+
+    assert team == sketch.build([value for repo in ("api", "web") for day in repos[repo] for value in day])
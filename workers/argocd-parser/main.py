@@ -16,11 +16,13 @@ import base64
 import os
 import json
 
+import jsonlog
 import shared
 
 from flask import Flask, request
 
 app = Flask(__name__)
+log = jsonlog.get_logger('argocd-parser')
 
 
 @app.route("/", methods=["POST"])
@@ -33,7 +35,6 @@ def index():
     if not request.is_json:
         raise Exception("Expecting JSON payload")
     envelope = request.get_json()
-    print(f"envelope recieved: {envelope}")
 
     # Check that data has been posted
     if not envelope:
@@ -53,13 +54,7 @@ def index():
         shared.insert_row_into_events_raw(event)
 
     except Exception as e:
-        entry = {
-                "severity": "WARNING",
-                "msg": "Data not saved to BigQuery",
-                "errors": str(e),
-                "json_payload": envelope
-            }
-        print(json.dumps(entry))
+        log.warning("Data not saved to database", errors=str(e), json_payload=envelope)
 
     return "", 204
 
@@ -79,8 +74,10 @@ def process_argocd_event(msg):
         "msg_id": msg["message_id"],  # The pubsub message id
         "source": "argocd",  # The name of the source, eg "github"
     }
+    if metadata.get("status") == "success":
+        argocd_event["deploys"] = shared.deploy_rows(argocd_event, [metadata.get("commit_sha")])
 
-    print(argocd_event)
+    log.debug("parsed Argo CD event", id=metadata["id"], msg_id=msg["message_id"])
     return argocd_event
 
 
@@ -72,7 +72,7 @@ def test_argocd_event_processed(client):
         "id": "foo",
         "metadata": '{"foo": "bar", "id": "foo", "time": 0}',
         "time_created": 0,
-        "signature": "a424b5326ac45bde4c42c9b74dc878e56623d84f",
+        "signature": "8f4d17d5761af5e4023ffd8433915aceb1694cdcf479ed410bce8dd874f23c0e",
         "msg_id": "foobar",
         "source": "argocd",
     }
@@ -87,3 +87,12 @@ def test_argocd_event_processed(client):
 
     shared.insert_row_into_events_raw.assert_called_with(event)
     assert r.status_code == 204
+
+
+def test_successful_sync_is_a_deploy():
+    data = {"id": "sync-1", "time": "2023-10-08 08:46:01", "status": "success", "commit_sha": "abc123"}
+    msg = {"data": base64.b64encode(json.dumps(data).encode("utf-8")).decode("utf-8"), "message_id": 1}
+
+    event = main.process_argocd_event(msg)
+
+    assert event["deploys"] == [(event["signature"], "argocd", "sync-1", "2023-10-08 08:46:01", "abc123", [], 1)]
@@ -16,6 +16,7 @@ import base64
 import os
 import json
 
+import projection
 import shared
 
 from flask import Flask, request
@@ -86,8 +87,13 @@ def process_circleci_event(headers, msg):
         "msg_id": msg["message_id"],
         "source": "circleci",
     }
+    workflow = metadata.get("workflow") or {}
+    if (event_type == "workflow-completed" and "deploy" in (workflow.get("name") or "") and
+            workflow.get("status") == "success"):
+        revision = ((metadata.get("pipeline") or {}).get("vcs") or {}).get("revision")
+        circleci_event["deploys"] = shared.deploy_rows(circleci_event, [revision])
 
-    return circleci_event
+    return projection.apply(circleci_event, metadata)
 
 
 if __name__ == "__main__":
@@ -16,6 +16,7 @@ import base64
 import os
 import json
 
+import projection
 import shared
 
 from flask import Flask, request
@@ -85,8 +86,11 @@ def process_cloud_build_event(attr, msg):
         "msg_id": msg["message_id"],
         "source": "cloud_build",
     }
+    if metadata.get("status") == "success":
+        build_event["deploys"] = shared.deploy_rows(
+            build_event, [(metadata.get("substitutions") or {}).get("commit_sha")])
 
-    return build_event
+    return projection.apply(build_event, metadata)
 
 
 if __name__ == "__main__":
@@ -19,11 +19,15 @@ from pika.adapters.blocking_connection import BlockingChannel
 from pika.amqp_object import Properties
 from pika.spec import Basic
 
+import jsonlog
+import projection
 import shared
 import rabbit
 
 BROKER_ADDRESS = os.environ.get('FK_BROKER_ADDRESS')
 
+log = jsonlog.get_logger('github-parser')
+
 
 def index():
     connector = rabbit.RabbitMQConnector(broker_address=BROKER_ADDRESS,
@@ -31,16 +35,39 @@ def index():
                                          queue_name='fk_work_github',
                                          routing_key='github')
     connector.setup()
-    connector.start_consuming(callback=consume)
+    connector.start_consuming_batches(parse, shared.BatchWriter())
 
 
 def consume(ch: BlockingChannel, method: Basic.Deliver, properties: Properties, body: bytes):
-    event = None
-    msg = json.loads(body)
+    """
+    Processes a single message, writing its event before acking it
+    """
+    event = parse(properties, body)
+    if event is not None:
+        try:
+            shared.insert_row_into_events_raw(event)
+        except Exception as e:
+            log.warning("Data not saved to database", errors=str(e), msg_id=event["msg_id"])
+
+    ch.basic_ack(delivery_tag=method.delivery_tag, multiple=False)
+
+
+def parse(properties: Properties, body: bytes):
+    """
+    Turns a message into an events_raw row, returns None (after logging why)
+    for messages that are dropped
+    """
+    # Check request for JSON
+    try:
+        msg = rabbit.decode_message(properties, body)
+    except ValueError as e:
+        log.warning("Message body is not valid JSON", errors=str(e))
+        return None
 
     if "attributes" not in msg:
         raise Exception("Missing additional attributes")
 
+    event = None
     try:
         attr = msg["attributes"]
 
@@ -52,19 +79,12 @@ def consume(ch: BlockingChannel, method: Basic.Deliver, properties: Properties,
             if "X-Github-Event" in headers:
                 event = process_github_event(headers, msg)
 
-        shared.insert_row_into_events_raw(event)
-
     except Exception as e:
-        entry = {
-                "severity": "WARNING",
-                "msg": "Data not saved to database",
-                "errors": str(e),
-                "json_payload": msg
-            }
-        print(json.dumps(entry))
+        log.warning("Event not parsed", errors=str(e), json_payload=msg)
+        return None
 
-    ch.basic_ack(delivery_tag=method.delivery_tag, multiple=False)
-    print(f'finished processing message with id={msg["message_id"]}')
+    log.debug('parsed message', message_id=msg.get("message_id"))
+    return event
 
 
 def process_github_event(headers, msg):
@@ -141,8 +161,21 @@ def process_github_event(headers, msg):
         "msg_id": msg["message_id"],
         "source": source,
     }
-
-    return github_event
+    if event_type == "push":
+        github_event["commits"] = shared.commit_rows(
+            source, metadata.get("commits"), metadata.get("repository", {}).get("full_name"))
+    if event_type == "deployment_status" and metadata["deployment_status"].get("state") == "success":
+        github_event["deploys"] = shared.deploy_rows(
+            github_event, [(metadata.get("deployment") or {}).get("sha")],
+            [commit.get("id") for commit in metadata.get("commits") or ()])
+    if event_type in ("issues", "issue_comment"):
+        issue = metadata["issue"]
+        github_event["incidents"] = shared.incident_rows(
+            github_event, issue.get("number"), issue.get("created_at"), issue.get("closed_at"),
+            shared.root_cause(metadata),
+            any(label.get("name") == "Incident" for label in issue.get("labels") or ()))
+
+    return projection.apply(github_event, metadata)
 
 
 if __name__ == "__main__":
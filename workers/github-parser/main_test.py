@@ -2,10 +2,10 @@
 
 import pytest
 import json
+from datetime import datetime
 from unittest import mock
 import main
 import pika
-from pika.exceptions import AMQPConnectionError
 
 
 def test_missing_msg_attributes():
@@ -46,19 +46,145 @@ def test_github_event_processed():
         "time_created": "2023-10-08 08:46:01.603352",
         "signature": "sha1=b4e0e6c8a926415afa2a752406e0a862d0044b66",
         "msg_id": 7116780781096697856,
-        "source": "githubmock"  # based on the provided headers
+        "source": "githubmock",  # based on the provided headers
+        "incidents": [(
+            "sha1=b4e0e6c8a926415afa2a752406e0a862d0044b66", "githubmock", "614",
+            datetime(2023, 10, 3, 18, 37, 11, 224716), datetime(2023, 10, 8, 8, 46, 1, 603355),
+            "0834a2e88bf0049dfb75cce942cb843147b3cd2a", True, 7116780781096697856,
+        )],
     }
 
+    ch = mock.MagicMock()
+
     # Mocking the function that writes to the database
     with mock.patch('shared.insert_row_into_events_raw') as mock_insert_function:
-        main.consume(None, None, None, json.dumps(event_payload).encode('utf-8'))
+        main.consume(ch, mock.Mock(delivery_tag=1), None, json.dumps(event_payload).encode('utf-8'))
 
     mock_insert_function.assert_called_with(github_event_expected)
+    ch.basic_ack.assert_called_once_with(delivery_tag=1, multiple=False)
+
+
+def test_github_envelope_processed():
+    payload = {
+        "issue": {"updated_at": "2023-10-08 08:46:01.603352", "number": 614},
+        "repository": {"name": "foobar"},
+    }
+    properties = pika.BasicProperties(
+        type="fk.webhook.v2",
+        message_id="7116780781096697856",
+        headers={
+            "X-Github-Event": "issues",
+            "X-Hub-Signature": "sha1=b4e0e6c8a926415afa2a752406e0a862d0044b66",
+            "X-Fk-Publish-Time": "2023-10-08 13:46:01.606895",
+        },
+    )
+    ch = mock.Mock()
+
+    with mock.patch('shared.insert_row_into_events_raw') as mock_insert_function:
+        main.consume(ch, mock.Mock(delivery_tag=3), properties, json.dumps(payload).encode('utf-8'))
+
+    event = mock_insert_function.call_args.args[0]
+    assert event["id"] == "foobar/614"
+    assert event["msg_id"] == 7116780781096697856
+    assert event["signature"] == "sha1=b4e0e6c8a926415afa2a752406e0a862d0044b66"
+    assert json.loads(event["metadata"])["attributes"]["headers"] == {
+        "X-Github-Event": "issues",
+        "X-Hub-Signature": "sha1=b4e0e6c8a926415afa2a752406e0a862d0044b66",
+    }
+    ch.basic_ack.assert_called_once_with(delivery_tag=3, multiple=False)
+
+
+def test_invalid_json_is_acked_and_dropped():
+    ch = mock.Mock()
+
+    with mock.patch('shared.insert_row_into_events_raw') as mock_insert_function:
+        main.consume(ch, mock.Mock(delivery_tag=4), pika.BasicProperties(type="fk.webhook.v2"), b"not json")
+
+    mock_insert_function.assert_not_called()
+    ch.basic_ack.assert_called_once_with(delivery_tag=4, multiple=False)
+
+
+def test_body_that_is_not_an_object_is_dropped():
+    properties = pika.BasicProperties(type="fk.webhook.v2", message_id="1", headers={})
+
+    assert main.parse(properties, b"[]") is None
+
+
+def test_parse_returns_event_for_batch():
+    payload = {"issue": {"updated_at": "2023-10-08 08:46:01.603352", "number": 614}, "repository": {"name": "foobar"}}
+    properties = pika.BasicProperties(
+        type="fk.webhook.v2",
+        message_id="7116780781096697856",
+        headers={"X-Github-Event": "issues", "X-Hub-Signature": "sha1=b4e0e6c8a926415afa2a752406e0a862d0044b66"},
+    )
+
+    event = main.parse(properties, json.dumps(payload).encode('utf-8'))
+
+    assert event["id"] == "foobar/614"
+    assert main.parse(properties, b"not json") is None
+
+
+def test_push_event_carries_its_commits():
+    headers = {"X-Github-Event": "push", "X-Hub-Signature": "foo"}
+    event_payload = {
+        "head_commit": {"id": "b", "timestamp": "2023-10-08T10:47:01+02:00"},
+        "commits": [
+            {"id": "a", "timestamp": "2023-10-08T10:46:01+02:00"},
+            {"id": "b", "timestamp": "2023-10-08T10:47:01+02:00"},
+        ],
+        "repository": {"name": "fourkeys", "full_name": "fleetingclarity/fourkeys"},
+        "attributes": {"headers": headers},
+        "message_id": 7116780781096697856,
+    }
+
+    event = main.process_github_event(headers=headers, msg=event_payload)
+
+    assert event["commits"] == [
+        ("github", "a", datetime(2023, 10, 8, 10, 46, 1), "fleetingclarity/fourkeys"),
+        ("github", "b", datetime(2023, 10, 8, 10, 47, 1), "fleetingclarity/fourkeys"),
+    ]
+
+
+def test_successful_deployment_status_is_a_deploy():
+    headers = {"X-Github-Event": "deployment_status", "X-Hub-Signature": "foo"}
+    event_payload = {
+        "deployment_status": {"id": 9, "state": "success", "updated_at": "2023-10-08T08:50:00Z"},
+        "deployment": {"id": 8, "sha": "b"},
+        "commits": [{"id": "a"}],
+        "attributes": {"headers": headers},
+        "message_id": 7116780781096697856,
+    }
+
+    event = main.process_github_event(headers=headers, msg=event_payload)
+
+    assert event["deploys"] == [("foo", "github", "9", "2023-10-08T08:50:00Z", "b", ["a"], 7116780781096697856)]
+
+    event_payload["deployment_status"]["state"] = "failure"
+    assert "deploys" not in main.process_github_event(headers=headers, msg=event_payload)
+
+
+def test_issue_comment_carries_its_incident():
+    headers = {"X-Github-Event": "issue_comment", "X-Hub-Signature": "foo"}
+    event_payload = {
+        "issue": {"number": 614, "created_at": "2023-10-03T18:37:11Z", "closed_at": None,
+                  "labels": [{"name": "bug"}]},
+        "comment": {"id": 5, "updated_at": "2023-10-08T08:46:01Z", "body": "root cause: 0834a2e, reverted"},
+        "repository": {"name": "foobar"},
+        "attributes": {"headers": headers},
+        "message_id": 7116780781096697856,
+    }
+
+    event = main.process_github_event(headers=headers, msg=event_payload)
+
+    assert event["incidents"] == [
+        ("foo", "github", "614", datetime(2023, 10, 3, 18, 37, 11), None, "0834a2e", False, 7116780781096697856),
+    ]
 
 
 def test_github_event_avoid_id_conflicts_pull_requests():
     headers = {"X-Github-Event": "pull_request", "X-Hub-Signature": "foo", "Mock": "True"}
     event_payload = {
+        "number": 477,
         "pull_request": {
             "updated_at": "2023-06-15T13:12:14Z",
             "number": 477
@@ -66,7 +192,8 @@ def test_github_event_avoid_id_conflicts_pull_requests():
         "repository": {
             "name": "reponame"
         },
-        "attributes": {"headers": headers}
+        "attributes": {"headers": headers},
+        "message_id": 7116780781096697856
     }
 
     github_event_calculated = main.process_github_event(headers=headers, msg=event_payload)
@@ -87,7 +214,8 @@ def test_github_event_avoid_id_conflicts_issues():
         "repository": {
             "name": "reponame"
         },
-        "attributes": {"headers": headers}
+        "attributes": {"headers": headers},
+        "message_id": 7116780781096697856
     }
 
     github_event_calculated = main.process_github_event(headers=headers, msg=event_payload)
@@ -108,9 +236,13 @@ def test_unsupported_github_event_raises_exception():
     assert "Unsupported GitHub event" in str(e.value)
 
 
+def connector():
+    return main.rabbit.RabbitMQConnector("localhost", "fk_events", "fk_work_github", "github", retry_delay=0)
+
+
 def test_create_connection_with_successful_connection():
     with mock.patch("pika.BlockingConnection") as MockedConnection:
-        main.create_connection()
+        connector().create_connection()
 
     assert MockedConnection.call_count == 1
 
@@ -118,28 +250,29 @@ def test_create_connection_with_successful_connection():
 def test_create_connection_with_retries():
     with mock.patch("pika.BlockingConnection", side_effect=pika.exceptions.AMQPConnectionError):
         with pytest.raises(Exception) as e:
-            main.create_connection()
+            connector().create_connection()
 
-    assert f"Failed to connect to RabbitMQ after multiple retries ({main.MAX_RETRIES})" in str(e.value)
+    assert "Failed to connect to RabbitMQ after multiple retries (5)" in str(e.value)
 
 
-def test_index_with_keyboard_interrupt():
-    with mock.patch("main.create_connection") as MockedCreateConnection, \
-            mock.patch.object(main, 'channel', autospec=True) as mock_channel:
-
-        mock_channel.start_consuming.side_effect = KeyboardInterrupt
+def test_index_consumes_github_batches():
+    with mock.patch("main.rabbit.RabbitMQConnector") as MockedConnector:
         main.index()
 
-    mock_channel.stop_consuming.assert_called_once()
-
+    assert MockedConnector.call_args.kwargs["queue_name"] == "fk_work_github"
+    MockedConnector.return_value.setup.assert_called_once()
+    parse, writer = MockedConnector.return_value.start_consuming_batches.call_args.args
+    assert parse is main.parse and isinstance(writer, main.shared.BatchWriter)
 
-def test_index_with_connection_closed_by_broker(capsys):
-    with mock.patch("main.create_connection") as MockedCreateConnection, \
-            mock.patch.object(main, 'channel', autospec=True) as mock_channel:
 
-        mock_channel.start_consuming.side_effect = pika.exceptions.ConnectionClosedByBroker
-        main.index()
+@pytest.mark.parametrize("error", [KeyboardInterrupt, pika.exceptions.ConnectionClosedByBroker(320, "shutdown")])
+def test_consuming_stops_on_interrupt_or_closed_connection(error):
+    consumer = connector()
+    consumer.connection, consumer.channel = mock.MagicMock(), mock.MagicMock()
+    consumer.channel.start_consuming.side_effect = error
 
-    mock_channel.stop_consuming.assert_called_once()
-    assert "Connection was closed by the broker." in capsys.readouterr().out
+    with mock.patch("shared.shutdown"):
+        consumer.start_consuming(mock.Mock())
 
+    consumer.channel.stop_consuming.assert_called_once()
+    consumer.connection.close.assert_called_once()
@@ -14,11 +14,13 @@
 
 from datetime import datetime
 import os
-import json
+import re
 import time
 
 from pika.adapters.blocking_connection import BlockingChannel
 
+import jsonlog
+import projection
 import shared
 import rabbit
 from pika.amqp_object import Properties
@@ -28,6 +30,8 @@ import pika
 
 BROKER_ADDRESS = os.environ.get('FK_BROKER_ADDRESS')
 
+log = jsonlog.get_logger('gitlab-parser')
+
 
 def index():
     connector = rabbit.RabbitMQConnector(broker_address=BROKER_ADDRESS,
@@ -35,17 +39,39 @@ def index():
                                          queue_name='fk_work_gitlab',
                                          routing_key='gitlab')
     connector.setup()
-    connector.start_consuming(callback=consume)
+    connector.start_consuming_batches(parse, shared.BatchWriter())
 
 
 def consume(ch: BlockingChannel, method: Basic.Deliver, properties: Properties, body: bytes):
-    event = None
+    """
+    Processes a single message, writing its event before acking it
+    """
+    event = parse(properties, body)
+    if event is not None:
+        try:
+            shared.insert_row_into_events_raw(event)
+        except Exception as e:
+            log.warning("Data not saved to database", errors=str(e), msg_id=event["msg_id"])
+
+    ch.basic_ack(delivery_tag=method.delivery_tag, multiple=False)
+
+
+def parse(properties: Properties, body: bytes):
+    """
+    Turns a message into an events_raw row, returns None (after logging why)
+    for messages that are dropped
+    """
     # Check request for JSON
-    msg = json.loads(body)
+    try:
+        msg = rabbit.decode_message(properties, body)
+    except ValueError as e:
+        log.warning("Message body is not valid JSON", errors=str(e))
+        return None
 
     if "attributes" not in msg:
         raise Exception("Missing additional attributes")
 
+    event = None
     try:
         attr = msg["attributes"]
 
@@ -57,19 +83,64 @@ def consume(ch: BlockingChannel, method: Basic.Deliver, properties: Properties,
             if "X-Gitlab-Event" in headers:
                 event = process_gitlab_event(headers, msg)
 
-        shared.insert_row_into_events_raw(event)
-
     except Exception as e:
-        entry = {
-                "severity": "WARNING",
-                "msg": "Data not saved to database",
-                "errors": str(e),
-                "json_payload": msg
-            }
-        print(json.dumps(entry))
-
-    ch.basic_ack(delivery_tag=method.delivery_tag, multiple=False)
-    print(f'finished processing message with id={msg["message_id"]}')
+        log.warning("Event not parsed", errors=str(e), json_payload=msg)
+        return None
+
+    log.debug('parsed message', message_id=msg.get("message_id"))
+    return event
+
+
+def deployed_commit(metadata):
+    """
+    Returns the commit a pipeline or deployment event deployed, deployment
+    events only link to it
+    """
+    commit_id = (metadata.get("commit") or {}).get("id")
+    if commit_id:
+        return commit_id
+    match = re.match(r".*commit/(.*)", metadata.get("commit_url") or "")
+    return match.group(1) if match else None
+
+
+def push_time(metadata):
+    """
+    Returns the time of the commit a push checked out, or of its latest
+    commit, None for pushes without commits (new branches and tags)
+    """
+    commits = [commit for commit in metadata.get("commits") or () if commit.get("timestamp")]
+    for commit in commits:
+        if commit.get("id") == metadata.get("checkout_sha"):
+            return commit["timestamp"]
+    if commits:
+        return max(commits, key=lambda commit: shared.parse_time(commit["timestamp"]) or datetime.min)["timestamp"]
+    return None
+
+
+def ingest_time(msg):
+    """
+    Returns the time the event handler received a webhook whose payload has
+    no time of its own. The handler sets it once (X-Fk-Publish-Time), every
+    redelivery and spool replay of the message carries the same time, so
+    time_created and with it the deduplication on (signature, time_created)
+    do not depend on when the message is delivered.
+    """
+    if not msg.get("publishTime"):
+        raise Exception("Event has no time of its own and no X-Fk-Publish-Time")
+    return msg["publishTime"]
+
+
+def incident_rows(event, metadata):
+    """
+    Returns the incident_events row of an issue or of a note on an issue,
+    notes name the issue by its id
+    """
+    attributes = metadata["object_attributes"]
+    incident_id = attributes.get("noteable_id") if event["event_type"] == "note" else attributes.get("id")
+    labels = attributes.get("labels")
+    bug = any(label.get("title") == "Incident" for label in labels) if isinstance(labels, list) else None
+    return shared.incident_rows(event, incident_id, attributes.get("created_at"), attributes.get("closed_at"),
+                                shared.root_cause(metadata), bug)
 
 
 def process_gitlab_event(headers, msg):
@@ -94,9 +165,7 @@ def process_gitlab_event(headers, msg):
 
     if event_type in ("push", "tag_push"):
         e_id = metadata["checkout_sha"]
-        for commit in metadata["commits"]:
-            if commit["id"] == e_id:
-                time_created = commit["timestamp"]
+        time_created = push_time(metadata)
 
     if event_type in ("merge_request", "note", "issue", "pipeline"):
         event_object = metadata["object_attributes"]
@@ -106,17 +175,11 @@ def process_gitlab_event(headers, msg):
             event_object.get("finished_at") or
             event_object.get("created_at"))
 
-    if event_type in ("job"):
-        e_id = metadata["build_id"]
-        time_created = (
-            event_object.get("finished_at") or
-            event_object.get("started_at"))
-
     if event_type in ("deployment"):
         e_id = metadata["deployment_id"]
         time_created = metadata["status_changed_at"]
 
-    if event_type in ("build"):
+    if event_type in ("job", "build"):
         e_id = metadata["build_id"]
         time_created = (
             metadata.get("build_finished_at") or
@@ -139,14 +202,22 @@ def process_gitlab_event(headers, msg):
         "event_type": event_type,
         "id": e_id,
         "metadata": metadata,
-        # If time_created not supplied by event, default to event_handler publishTime
-        "time_created": time_created or msg["publishTime"],
+        "time_created": time_created or ingest_time(msg),
         "signature": signature,
         "msg_id": msg["message_id"],
         "source": source,
     }
-
-    return gitlab_event
+    if event_type == "push":
+        gitlab_event["commits"] = shared.commit_rows(
+            source, metadata.get("commits"), metadata.get("project", {}).get("path_with_namespace"))
+    if ((event_type == "pipeline" and metadata["object_attributes"].get("status") == "success") or
+            (event_type == "deployment" and metadata.get("status") == "success")):
+        gitlab_event["deploys"] = shared.deploy_rows(gitlab_event, [deployed_commit(metadata)])
+    if event_type == "issue" or (event_type == "note" and
+                                 metadata["object_attributes"].get("noteable_type") == "Issue"):
+        gitlab_event["incidents"] = incident_rows(gitlab_event, metadata)
+
+    return projection.apply(gitlab_event, metadata)
 
 
 if __name__ == "__main__":
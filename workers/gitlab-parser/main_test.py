@@ -14,6 +14,7 @@
 
 import base64
 import json
+from datetime import datetime
 
 import main
 import shared
@@ -81,6 +82,7 @@ def test_gitlab_event_processed(client):
         "signature": shared.create_unique_id(pubsub_msg["message"]),
         "msg_id": "foobar",
         "source": "gitlab",
+        "commits": [],
     }
 
     shared.insert_row_into_events_raw = mock.MagicMock()
@@ -120,6 +122,7 @@ def test_timestamp_timezone_event_processed(client):
         "signature": shared.create_unique_id(pubsub_msg["message"]),
         "msg_id": "foobar",
         "source": "gitlab",
+        "commits": [],
     }
 
     shared.insert_row_into_events_raw = mock.MagicMock()
@@ -132,3 +135,57 @@ def test_timestamp_timezone_event_processed(client):
 
     shared.insert_row_into_events_raw.assert_called_with(event)
     assert r.status_code == 204
+
+
+def test_issue_events_carry_their_incident():
+    headers = {"X-Gitlab-Event": "Issue Hook"}
+    issue = {
+        "object_kind": "issue",
+        "object_attributes": {
+            "id": 301, "created_at": "2021-04-28 21:50:00 +0200", "closed_at": "2021-04-29 08:00:00 +0200",
+            "description": "root cause: 279484c0", "labels": [{"title": "Incident"}],
+        },
+        "message_id": 42,
+    }
+    note = {
+        "object_kind": "note",
+        "object_attributes": {"id": 7, "noteable_type": "Issue", "noteable_id": 301,
+                              "created_at": "2021-04-29 09:00:00 +0200", "note": "fixed"},
+        "message_id": 43,
+    }
+
+    event = main.process_gitlab_event(headers, issue)
+    assert event["incidents"] == [(event["signature"], "gitlab", "301", datetime(2021, 4, 28, 21, 50),
+                                   datetime(2021, 4, 29, 8, 0), "279484c0", True, 42)]
+    event = main.process_gitlab_event(headers, note)
+    assert event["incidents"] == [(event["signature"], "gitlab", "301", datetime(2021, 4, 29, 9, 0), None, None,
+                                   None, 43)]
+
+
+def test_time_created_comes_from_the_payload():
+    headers = {"X-Gitlab-Event": "Push Hook"}
+    push = {
+        "object_kind": "push",
+        "checkout_sha": "c",
+        "commits": [
+            {"id": "a", "timestamp": "2021-04-28T21:50:00+02:00"},
+            {"id": "b", "timestamp": "2021-04-28T21:55:00+02:00"},
+        ],
+        "message_id": 42,
+    }
+
+    # redeliveries and republished copies of the same webhook get the same time_created
+    first = main.process_gitlab_event(headers, dict(push, publishTime="2021-04-28 20:00:00"))
+    again = main.process_gitlab_event(headers, dict(push, publishTime="2021-04-29 08:00:00"))
+    assert first["time_created"] == again["time_created"] == "2021-04-28T21:55:00+02:00"
+
+
+def test_push_without_commits_keeps_its_ingest_time():
+    headers = {"X-Gitlab-Event": "Tag Push Hook"}
+    tag = {"object_kind": "tag_push", "checkout_sha": "c", "commits": [], "message_id": 42}
+
+    event = main.process_gitlab_event(headers, dict(tag, publishTime="2021-04-28 20:00:00.123"))
+
+    assert event["time_created"] == "2021-04-28 20:00:00.123"
+    with pytest.raises(Exception):
+        main.process_gitlab_event(headers, tag)
@@ -0,0 +1,437 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+"""
+Keeps the deployments, incidents and daily_metrics tables up to date (see
+init-db.sql, changes are written by the workers).
+
+Every run reads the events that arrived since the previous one, going by
+events_raw.msg_id: the snowflake id the event handler gives each webhook
+starts with the millisecond it was received. Deploy links still pending are
+resolved when the event of their commit has arrived, and the deployments and
+incidents affected by new deploys, links and incident events, which the
+workers extract at ingest, are aggregated again, and so are the
+daily_metrics of the days they fall on, with the quantile sketches of
+their lead and restore times (see sketch.py in shared). A run is a single
+transaction, the dashboard never sees half of one.
+
+Workers commit in batches, so an event may be committed after one with a
+higher msg_id: every run reads again the events of the last
+FK_REFRESH_OVERLAP_SECONDS before the watermark. Events that waited longer
+in RabbitMQ, e.g. while their worker was down, are picked up by the rebuild
+every FK_REFRESH_REBUILD_HOURS, which aggregates all deploy and incident
+events again.
+
+Configured from the environment, next to the FK_DB_* settings of shared:
+
+    FK_REFRESH_INTERVAL_SECONDS   pause between runs (default 60)
+    FK_REFRESH_OVERLAP_SECONDS    seconds before the watermark read again (default 300)
+    FK_REFRESH_REBUILD_HOURS      rebuild the tables from every event this often, 0 never (default 24)
+    FK_REFRESH_PENDING_LINK_DAYS  deploy commits whose event never arrives are dropped after (default 30)
+"""
+
+import argparse
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timedelta
+
+from psycopg2 import extras, InterfaceError, OperationalError
+
+import jsonlog
+import shared
+import sketch
+
+INTERVAL = float(os.environ.get('FK_REFRESH_INTERVAL_SECONDS', 60))
+OVERLAP = float(os.environ.get('FK_REFRESH_OVERLAP_SECONDS', 300))
+REBUILD_HOURS = float(os.environ.get('FK_REFRESH_REBUILD_HOURS', 24))
+PENDING_LINK_DAYS = float(os.environ.get('FK_REFRESH_PENDING_LINK_DAYS', 30))
+
+WATERMARK = 'metrics'
+
+# the bits of a snowflake id below its millisecond timestamp (instance and sequence)
+SNOWFLAKE_TIMESTAMP_SHIFT = 22
+
+log = jsonlog.get_logger('metrics-refresher')
+
+# a run reads a single snapshot, so the watermark matches what it read
+REPEATABLE_READ = "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"
+
+# held until the end of the run, a second refresher skips its run instead of repeating the work
+LOCK = "SELECT pg_try_advisory_xact_lock(hashtext('fourkeys metrics refresh'))"
+
+WATERMARK_SELECT = "SELECT msg_id, rebuilt_at FROM refresh_watermarks WHERE name = %(name)s"
+
+LATEST_MSG_ID = "SELECT max(msg_id) FROM events_raw"
+
+# DELETE rather than TRUNCATE, which would block the dashboard until the rebuild commits;
+# the deploy and incident events and the deploy links are written by the workers and kept
+REBUILT_TABLES = ('deployments', 'incidents', 'daily_metrics')
+
+# %(since)s is NULL on a rebuild, which reads every event
+NEW = "(%(since)s::BIGINT IS NULL OR msg_id > %(since)s)"
+
+AFFECTED_DEPLOYS = f"""
+CREATE TEMPORARY TABLE affected_deploys ON COMMIT DROP AS
+SELECT DISTINCT source, deploy_id FROM deploy_events WHERE {NEW}
+"""
+
+# deploy commits whose event has arrived since they were queued, their deploys are affected
+LINKS_RESOLVE = """
+WITH resolved AS (
+    DELETE FROM pending_deployment_links p
+    WHERE EXISTS (SELECT 1 FROM events_raw e WHERE e.id = p.commit_id)
+    RETURNING p.source, p.deploy_id, p.commit_id
+),
+linked AS (
+    INSERT INTO deployment_changes (source, deploy_id, commit_id, changes)
+    SELECT source, deploy_id, commit_id, commit_changes(commit_id)
+    FROM resolved
+    ON CONFLICT DO NOTHING
+    RETURNING source, deploy_id
+)
+INSERT INTO affected_deploys (source, deploy_id)
+SELECT DISTINCT source, deploy_id FROM linked
+"""
+
+LINKS_EXPIRE = "DELETE FROM pending_deployment_links WHERE queued_at < %(expired)s"
+
+# days whose daily_metrics are rolled up again at the end of the run
+AFFECTED_DAYS = """
+CREATE TEMPORARY TABLE affected_days (source VARCHAR(50) NOT NULL, day DATE NOT NULL) ON COMMIT DROP
+"""
+
+# days of the affected deployments, recorded before and after they are aggregated again
+DEPLOY_DAYS = """
+INSERT INTO affected_days (source, day)
+SELECT DISTINCT d.source, d.time_created::DATE
+FROM deployments d
+JOIN affected_deploys a ON a.source = d.source AND a.deploy_id = d.deploy_id
+"""
+
+DEPLOYMENTS_DELETE = """
+DELETE FROM deployments d
+USING affected_deploys a
+WHERE d.source = a.source AND d.deploy_id = a.deploy_id
+"""
+
+# a deploy is a deployment once one of its commits is linked, and ships the changes of its links;
+# it is of the repository of its main commit, else of one of its changes, '' when no push recorded one
+DEPLOYMENTS_INSERT = """
+WITH shipped AS (
+    SELECT
+        d.source,
+        d.deploy_id,
+        d.time_created,
+        d.main_commit,
+        ARRAY_AGG(DISTINCT change_id) FILTER (WHERE change_id IS NOT NULL) AS changes
+    FROM deploy_events d
+    JOIN affected_deploys a ON a.source = d.source AND a.deploy_id = d.deploy_id
+    JOIN deployment_changes l ON l.source = d.source AND l.deploy_id = d.deploy_id
+        AND l.commit_id = ANY(array_prepend(d.main_commit, d.additional_commits))
+    LEFT JOIN LATERAL unnest(l.changes) AS change_id ON TRUE
+    GROUP BY 1, 2, 3, 4
+)
+INSERT INTO deployments (source, deploy_id, time_created, main_commit, repo, changes)
+SELECT
+    s.source,
+    s.deploy_id,
+    s.time_created,
+    s.main_commit,
+    COALESCE(
+        (SELECT MIN(c.repo) FROM commits c WHERE c.change_id = s.main_commit),
+        (SELECT MIN(c.repo) FROM commits c WHERE c.change_id = ANY(s.changes)),
+        ''
+    ),
+    s.changes
+FROM shipped s
+"""
+
+# new incident events, and incidents caused by a change of a deployment aggregated again
+AFFECTED_INCIDENTS = f"""
+CREATE TEMPORARY TABLE affected_incidents ON COMMIT DROP AS
+SELECT source, incident_id FROM incident_events WHERE {NEW}
+UNION
+SELECT i.source, i.incident_id
+FROM incident_events i
+JOIN (
+    SELECT unnest(d.changes) AS change_id
+    FROM deployments d
+    JOIN affected_deploys a ON a.source = d.source AND a.deploy_id = d.deploy_id
+) c ON c.change_id = i.root_cause
+"""
+
+# days of the affected incidents and of the deployments that caused them, recorded before and
+# after they are aggregated again
+INCIDENT_DAYS = """
+INSERT INTO affected_days (source, day)
+SELECT i.source, i.time_created::DATE
+FROM incidents i
+JOIN affected_incidents a ON a.source = i.source AND a.incident_id = i.incident_id
+WHERE i.time_created IS NOT NULL
+UNION
+SELECT d.source, d.time_created::DATE
+FROM incidents i
+JOIN affected_incidents a ON a.source = i.source AND a.incident_id = i.incident_id
+JOIN deployments d ON d.changes && i.changes
+"""
+
+INCIDENTS_DELETE = """
+DELETE FROM incidents i
+USING affected_incidents a
+WHERE i.source = a.source AND i.incident_id = a.incident_id
+"""
+
+# an incident is of the repository of the deployment of its root cause, '' without one
+INCIDENTS_INSERT = """
+INSERT INTO incidents (source, incident_id, time_created, time_resolved, repo, changes)
+SELECT
+    i.source,
+    i.incident_id,
+    MIN(LEAST(i.time_created, COALESCE(root.time_created, i.time_created))),
+    MAX(i.time_resolved),
+    COALESCE(MIN(root.repo), ''),
+    ARRAY_AGG(DISTINCT i.root_cause) FILTER (WHERE i.root_cause IS NOT NULL)
+FROM incident_events i
+JOIN affected_incidents a ON a.source = i.source AND a.incident_id = i.incident_id
+LEFT JOIN deployments root ON root.changes @> ARRAY[i.root_cause]
+GROUP BY 1, 2
+HAVING BOOL_OR(i.bug) IS TRUE
+"""
+
+DAILY_METRICS_DELETE = """
+DELETE FROM daily_metrics m
+USING affected_days a
+WHERE m.day = a.day AND m.source = a.source
+"""
+
+# one row per repository of the deployments and incidents of the day; a deployment failed when
+# one of its changes is the root cause of an incident; lead times are those of the changes a
+# deployment shipped, on the day of the deployment, restore times those of the incidents opened
+# that day
+DAILY_METRICS_INSERT = """
+INSERT INTO daily_metrics (day, source, repo, deployments, failed_deployments, lead_time_minutes, restore_time_hours)
+SELECT a.day, a.source, r.repo, deploys.deployments, deploys.failed_deployments,
+    COALESCE(lead.minutes, '{}'), COALESCE(restore.hours, '{}')
+FROM (SELECT DISTINCT source, day FROM affected_days) a
+CROSS JOIN LATERAL (
+    SELECT d.repo FROM deployments d
+    WHERE d.source = a.source AND d.time_created >= a.day AND d.time_created < a.day + 1
+    UNION
+    SELECT i.repo FROM incidents i
+    WHERE i.source = a.source AND i.time_created >= a.day AND i.time_created < a.day + 1
+) r
+CROSS JOIN LATERAL (
+    SELECT
+        COUNT(DISTINCT d.deploy_id) AS deployments,
+        COUNT(DISTINCT d.deploy_id) FILTER (
+            WHERE EXISTS (SELECT 1 FROM incidents i WHERE i.changes && d.changes)
+        ) AS failed_deployments
+    FROM deployments d
+    WHERE d.source = a.source AND d.repo = r.repo AND d.time_created >= a.day AND d.time_created < a.day + 1
+) deploys
+CROSS JOIN LATERAL (
+    SELECT ARRAY_AGG(minutes ORDER BY minutes) AS minutes
+    FROM (
+        SELECT (EXTRACT(EPOCH FROM d.time_created - MIN(c.time_created)) / 60)::DOUBLE PRECISION AS minutes
+        FROM deployments d
+        CROSS JOIN LATERAL unnest(d.changes) AS change (change_id)
+        JOIN commits c ON c.change_id = change.change_id
+        WHERE d.source = a.source AND d.repo = r.repo AND d.time_created >= a.day AND d.time_created < a.day + 1
+        GROUP BY d.deploy_id, d.time_created, change.change_id
+    ) shipped
+    WHERE minutes > 0
+) lead
+CROSS JOIN LATERAL (
+    SELECT ARRAY_AGG(hours ORDER BY hours) AS hours
+    FROM (
+        SELECT (EXTRACT(EPOCH FROM i.time_resolved - i.time_created) / 3600)::DOUBLE PRECISION AS hours
+        FROM incidents i
+        WHERE i.source = a.source AND i.repo = r.repo AND i.time_created >= a.day AND i.time_created < a.day + 1
+        AND i.time_resolved IS NOT NULL
+    ) restored
+) restore
+WHERE deploys.deployments > 0 OR restore.hours IS NOT NULL
+RETURNING day, source, repo, lead_time_minutes, restore_time_hours
+"""
+
+SKETCHES_UPDATE = """
+UPDATE daily_metrics m
+SET lead_time_sketch = s.lead_time_sketch::JSONB, restore_time_sketch = s.restore_time_sketch::JSONB
+FROM (VALUES %s) AS s (day, source, repo, lead_time_sketch, restore_time_sketch)
+WHERE m.day = s.day::DATE AND m.source = s.source AND m.repo = s.repo
+"""
+
+WATERMARK_UPSERT = """
+INSERT INTO refresh_watermarks (name, msg_id, refreshed_at, rebuilt_at)
+VALUES (%(name)s, %(msg_id)s, %(refreshed_at)s, %(rebuilt_at)s)
+ON CONFLICT (name) DO UPDATE SET
+    msg_id = EXCLUDED.msg_id,
+    refreshed_at = EXCLUDED.refreshed_at,
+    rebuilt_at = COALESCE(EXCLUDED.rebuilt_at, refresh_watermarks.rebuilt_at)
+"""
+
+
+def overlap_ids(seconds):
+    """
+    Returns the difference between the msg_ids of webhooks received the given
+    number of seconds apart
+    """
+    return int(seconds * 1000) << SNOWFLAKE_TIMESTAMP_SHIFT
+
+
+def due_for_rebuild(watermark, now, rebuild_hours):
+    """
+    Tells whether the tables must be rebuilt given the refresh_watermarks row
+    (None before the first run)
+    """
+    if watermark is None:
+        return True
+    rebuilt_at = watermark[1]
+    if not rebuild_hours:
+        return False
+    return rebuilt_at is None or now - rebuilt_at >= timedelta(hours=rebuild_hours)
+
+
+def write_sketches(cursor, rows):
+    """
+    Stores the quantile sketches of the lead and restore times of the
+    daily_metrics rows just rolled up
+    """
+    sketches = [
+        (day, source, repo, extras.Json(sketch.build(lead_times)), extras.Json(sketch.build(restore_times)))
+        for day, source, repo, lead_times, restore_times in rows
+    ]
+    if sketches:
+        extras.execute_values(cursor, SKETCHES_UPDATE, sketches, page_size=len(sketches))
+
+
+def refresh(connection, rebuild=False, overlap=OVERLAP, rebuild_hours=REBUILD_HOURS,
+            pending_link_days=PENDING_LINK_DAYS, now=None):
+    """
+    Brings the metrics tables up to date and commits. They are rebuilt from
+    every event when rebuild is true, on the first run and when the last
+    rebuild is rebuild_hours old. Returns the numbers of rows written, None
+    when another refresher is running.
+    """
+    now = now or datetime.utcnow()
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(REPEATABLE_READ)
+            cursor.execute(LOCK)
+            if not cursor.fetchone()[0]:
+                connection.rollback()
+                return None
+
+            cursor.execute(WATERMARK_SELECT, {'name': WATERMARK})
+            watermark = cursor.fetchone()
+            rebuild = rebuild or due_for_rebuild(watermark, now, rebuild_hours)
+            cursor.execute(LATEST_MSG_ID)
+            latest = cursor.fetchone()[0]
+
+            if rebuild:
+                for table in REBUILT_TABLES:
+                    cursor.execute(f"DELETE FROM {table}")
+                since = None
+            elif watermark[0] is None:
+                since = None
+            else:
+                since = watermark[0] - overlap_ids(overlap)
+
+            params = {'since': since}
+            counts = {}
+            cursor.execute(AFFECTED_DEPLOYS, params)
+            cursor.execute(LINKS_RESOLVE)
+            counts['links_resolved'] = cursor.rowcount
+            cursor.execute(LINKS_EXPIRE, {'expired': now - timedelta(days=pending_link_days)})
+            counts['links_expired'] = cursor.rowcount
+            cursor.execute(AFFECTED_DAYS)
+            cursor.execute(DEPLOY_DAYS)
+            cursor.execute(DEPLOYMENTS_DELETE)
+            cursor.execute(DEPLOYMENTS_INSERT)
+            counts['deployments'] = cursor.rowcount
+            cursor.execute(DEPLOY_DAYS)
+            cursor.execute(AFFECTED_INCIDENTS, params)
+            cursor.execute(INCIDENT_DAYS)
+            cursor.execute(INCIDENTS_DELETE)
+            cursor.execute(INCIDENTS_INSERT)
+            counts['incidents'] = cursor.rowcount
+            cursor.execute(INCIDENT_DAYS)
+            cursor.execute(DAILY_METRICS_DELETE)
+            cursor.execute(DAILY_METRICS_INSERT)
+            counts['daily_metrics'] = cursor.rowcount
+            write_sketches(cursor, cursor.fetchall())
+
+            # the watermark never goes back, even if the latest events were deleted
+            if watermark is not None and watermark[0] is not None and (latest is None or latest < watermark[0]):
+                latest = watermark[0]
+            cursor.execute(WATERMARK_UPSERT, {
+                'name': WATERMARK,
+                'msg_id': latest,
+                'refreshed_at': now,
+                'rebuilt_at': now if rebuild else None,
+            })
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+    return dict(counts, rebuild=rebuild, msg_id=latest)
+
+
+def refresh_once(rebuild=False):
+    """
+    Runs refresh on a pooled connection and logs the outcome
+    """
+    started = time.monotonic()
+    connection = shared.get_connection()
+    broken = False
+    try:
+        result = refresh(connection, rebuild=rebuild)
+    except (OperationalError, InterfaceError):
+        broken = True
+        raise
+    finally:
+        shared.return_connection(connection, close=broken)
+
+    if result is None:
+        log.info('another refresher is running, skipped')
+    else:
+        log.info('metrics refreshed', seconds=round(time.monotonic() - started, 3), **result)
+    return result
+
+
+def run(stop, interval=INTERVAL):
+    """
+    Refreshes every interval seconds until stop is set, errors are logged
+    and the next run tries again
+    """
+    while not stop.is_set():
+        started = time.monotonic()
+        try:
+            refresh_once()
+        except Exception as e:
+            log.error('refresh failed', errors=str(e))
+        stop.wait(max(0.0, interval - (time.monotonic() - started)))
+
+
+def index():
+    parser = argparse.ArgumentParser(description='Keeps the metrics tables of the dashboard up to date')
+    parser.add_argument('--once', action='store_true', help='refresh once and exit')
+    parser.add_argument('--rebuild', action='store_true', help='rebuild the tables from every event first')
+    args = parser.parse_args()
+
+    try:
+        if args.once or args.rebuild:
+            refresh_once(rebuild=args.rebuild)
+        if args.once:
+            return
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+        run(stop)
+    finally:
+        shared.shutdown()
+
+
+if __name__ == "__main__":
+    index()
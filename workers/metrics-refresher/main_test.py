@@ -0,0 +1,135 @@
+#  Copyright (c) 2023. fleetingclarity <fleetingclarity@proton.me>
+
+from datetime import datetime, timedelta
+from unittest import mock
+
+import pytest
+
+import main
+
+NOW = datetime(2023, 10, 8, 12, 0, 0)
+
+
+def connection_returning(*rows):
+    """
+    Returns a mocked connection whose cursor fetches the given rows in
+    order: the advisory lock, the watermark and the latest msg_id
+    """
+    connection = mock.MagicMock()
+    cursor = connection.cursor.return_value.__enter__.return_value
+    cursor.fetchone.side_effect = list(rows)
+    cursor.rowcount = 1
+    return connection, cursor
+
+
+def executed(cursor):
+    return [call.args[0] for call in cursor.execute.call_args_list]
+
+
+def test_overlap_ids_match_snowflake_timestamps():
+    # ids of the event handler's generator (instance 7) for webhooks received a second apart
+    first = (1696766821000 << 22) | (7 << 12) | 3
+    second = (1696766822000 << 22) | (7 << 12)
+
+    assert first < second - main.overlap_ids(1) + (1 << 12)
+    assert first > second - main.overlap_ids(1.001)
+
+
+def test_due_for_rebuild():
+    assert main.due_for_rebuild(None, NOW, 24)
+    assert main.due_for_rebuild((1, None), NOW, 24)
+    assert main.due_for_rebuild((1, NOW - timedelta(hours=25)), NOW, 24)
+    assert not main.due_for_rebuild((1, NOW - timedelta(hours=1)), NOW, 24)
+    assert not main.due_for_rebuild((1, None), NOW, 0)
+
+
+def test_refresh_reads_events_since_watermark_minus_overlap():
+    watermark = 1696766821000 << 22
+    connection, cursor = connection_returning((True,), (watermark, NOW - timedelta(hours=1)), (watermark + 99,))
+
+    result = main.refresh(connection, overlap=60, rebuild_hours=24, pending_link_days=30, now=NOW)
+
+    queries = executed(cursor)
+    assert not any(f"DELETE FROM {table}" in queries for table in main.REBUILT_TABLES)
+    affected = cursor.execute.call_args_list[queries.index(main.AFFECTED_INCIDENTS)]
+    assert affected.args[1] == {'since': watermark - main.overlap_ids(60)}
+    expire = cursor.execute.call_args_list[queries.index(main.LINKS_EXPIRE)]
+    assert expire.args[1] == {'expired': NOW - timedelta(days=30)}
+    # deployments and incidents are aggregated again after the facts they are made of
+    assert queries.index(main.LINKS_RESOLVE) < queries.index(main.DEPLOYMENTS_INSERT)
+    assert queries.index(main.DEPLOYMENTS_INSERT) < queries.index(main.AFFECTED_INCIDENTS)
+    assert queries.index(main.AFFECTED_INCIDENTS) < queries.index(main.INCIDENTS_INSERT)
+    assert queries.index(main.INCIDENTS_INSERT) < queries.index(main.DAILY_METRICS_INSERT)
+    # the days of deployments and incidents are recorded before and after they are aggregated again
+    assert queries.count(main.DEPLOY_DAYS) == 2
+    assert queries.index(main.DEPLOY_DAYS) < queries.index(main.DEPLOYMENTS_DELETE)
+    assert queries.count(main.INCIDENT_DAYS) == 2
+    assert queries.index(main.INCIDENT_DAYS) < queries.index(main.INCIDENTS_DELETE)
+    upsert = cursor.execute.call_args_list[queries.index(main.WATERMARK_UPSERT)]
+    assert upsert.args[1] == {'name': 'metrics', 'msg_id': watermark + 99, 'refreshed_at': NOW, 'rebuilt_at': None}
+    connection.commit.assert_called_once()
+    assert result == {
+        'links_resolved': 1, 'links_expired': 1, 'deployments': 1, 'incidents': 1, 'daily_metrics': 1,
+        'rebuild': False, 'msg_id': watermark + 99,
+    }
+
+
+def test_first_refresh_rebuilds_from_every_event():
+    connection, cursor = connection_returning((True,), None, (42,))
+
+    result = main.refresh(connection, now=NOW)
+
+    queries = executed(cursor)
+    for table in main.REBUILT_TABLES:
+        assert queries.index(f"DELETE FROM {table}") < queries.index(main.AFFECTED_DEPLOYS)
+    affected = cursor.execute.call_args_list[queries.index(main.AFFECTED_DEPLOYS)]
+    assert affected.args[1] == {'since': None}
+    # deploy and incident events and the deploy links are written by the workers, a rebuild aggregates them again
+    assert "DELETE FROM deploy_events" not in queries
+    assert "DELETE FROM incident_events" not in queries
+    upsert = cursor.execute.call_args_list[queries.index(main.WATERMARK_UPSERT)]
+    assert upsert.args[1]['rebuilt_at'] == NOW
+    assert result['rebuild'] and result['msg_id'] == 42
+
+
+def test_watermark_does_not_go_back():
+    connection, cursor = connection_returning((True,), (100, NOW), (None,))
+
+    result = main.refresh(connection, now=NOW)
+
+    assert result['msg_id'] == 100
+
+
+def test_refresh_skipped_while_another_refresher_runs():
+    connection, cursor = connection_returning((False,))
+
+    assert main.refresh(connection, now=NOW) is None
+    assert executed(cursor) == [main.REPEATABLE_READ, main.LOCK]
+    connection.rollback.assert_called_once()
+    connection.commit.assert_not_called()
+
+
+def test_failed_refresh_is_rolled_back():
+    connection, cursor = connection_returning((True,), (100, NOW), (200,))
+    cursor.execute.side_effect = [None, None, None, None, Exception("boom")]
+
+    with pytest.raises(Exception):
+        main.refresh(connection, now=NOW)
+
+    connection.rollback.assert_called_once()
+    connection.commit.assert_not_called()
+
+
+def test_sketches_written_for_rolled_up_days():
+    day = NOW.date()
+    rows = [(day, 'github', 'fleetingclarity/fourkeys', [12.0, 90.0], []), (day, 'pagerduty', '', [], [1.5])]
+
+    with mock.patch.object(main.extras, 'execute_values') as execute_values:
+        main.write_sketches(mock.Mock(), rows)
+
+    query, values = execute_values.call_args.args[1:3]
+    assert query == main.SKETCHES_UPDATE
+    assert [row[:3] for row in values] == [(day, 'github', 'fleetingclarity/fourkeys'), (day, 'pagerduty', '')]
+    lead, restore = values[0][3].adapted, values[0][4].adapted
+    assert main.sketch.count(lead) == 2 and main.sketch.count(restore) == 0
+    assert main.sketch.quantile(values[1][4].adapted, 0.5) == pytest.approx(1.5, rel=main.sketch.ALPHA)
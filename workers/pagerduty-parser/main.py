@@ -16,11 +16,13 @@ import base64
 import os
 import json
 
+import jsonlog
 import shared
 
 from flask import Flask, request
 
 app = Flask(__name__)
+log = jsonlog.get_logger('pagerduty-parser')
 
 
 @app.route("/", methods=["POST"])
@@ -45,27 +47,18 @@ def index():
 
     try:
         event = process_pagerduty_event(msg)
-        print(f" Event which is to be inserted into Big query {event}")
         if event:
             # [Do not edit below]
             shared.insert_row_into_events_raw(event)
 
     except Exception as e:
-        entry = {
-                "severity": "WARNING",
-                "msg": "Data not saved to BigQuery",
-                "errors": str(e),
-                "json_payload": envelope
-            }
-        print(f"EXCEPTION raised  {json.dumps(entry)}")
+        log.warning("Data not saved to database", errors=str(e), json_payload=envelope)
     return "", 204
 
 
 def process_pagerduty_event(msg):
     metadata = json.loads(base64.b64decode(msg["data"]).decode("utf-8").strip())
 
-    print(f"Metadata after decoding {metadata}")
-
     # Unique hash for the event
     signature = shared.create_unique_id(msg)
     event = metadata['event']
@@ -83,8 +76,12 @@ def process_pagerduty_event(msg):
         "time_created" : event['occurred_at'],  # The timestamp of with the event resolved
         "source": "pagerduty",  # The name of the source, eg "pagerduty"
         }
+    # every PagerDuty incident counts, it is open from when it triggered until it resolved
+    pagerduty_event["incidents"] = shared.incident_rows(
+        pagerduty_event, (event.get("data") or {}).get("id"), event['occurred_at'], event['occurred_at'],
+        shared.root_cause(metadata), True)
 
-    print(f"Pager Duty event to metrics--------> {pagerduty_event}")
+    log.debug("parsed PagerDuty event", event_type=event_type, id=event['id'], msg_id=msg["message_id"])
     return pagerduty_event
 
 
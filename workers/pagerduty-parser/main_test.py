@@ -14,6 +14,7 @@
 
 import base64
 import json
+from datetime import datetime
 
 import main
 import shared
@@ -72,9 +73,10 @@ def test_pagerduty_event_processed(client):
         "id": "foo",
         "metadata": '{"foo": "bar", "event": {"id": "foo", "occurred_at": 0, "event_type": "incident.triggered"}}',
         "time_created": 0,
-        "signature": "570ece386f1c03b9c91133b186c2c4a57857e255",
+        "signature": "06024d9a99a48f594bc0b2a8f0117f85d9ff7f603c7320c615a26fac77f3d56f",
         "msg_id": "foobar",
         "source": "pagerduty",
+        "incidents": [],
     }
 
     shared.insert_row_into_events_raw = mock.MagicMock()
@@ -87,3 +89,17 @@ def test_pagerduty_event_processed(client):
 
     shared.insert_row_into_events_raw.assert_called_with(event)
     assert r.status_code == 204
+
+
+def test_pagerduty_incident_extracted():
+    data = {"event": {
+        "id": "foo", "occurred_at": "2023-10-08T08:46:01.123Z", "event_type": "incident.resolved",
+        "data": {"id": "PGR0VU2", "title": "checkout down, root cause: 0834a2e"},
+    }}
+    msg = {"data": base64.b64encode(json.dumps(data).encode("utf-8")).decode("utf-8"), "attributes": {}, "message_id": 42}
+
+    event = main.process_pagerduty_event(msg)
+
+    occurred_at = datetime(2023, 10, 8, 8, 46, 1, 123000)
+    assert event["incidents"] == [(event["signature"], "pagerduty", "PGR0VU2", occurred_at, occurred_at, "0834a2e",
+                                   True, 42)]
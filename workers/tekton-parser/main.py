@@ -16,6 +16,7 @@ import base64
 import os
 import json
 
+import projection
 import shared
 
 from cloudevents.http import from_http, to_json
@@ -84,8 +85,12 @@ def process_tekton_event(headers, msg):
         "msg_id": msg["message_id"],  # The pubsub message id
         "source": "tekton",
     }
+    if cloud_event["type"] == "dev.tekton.event.pipelinerun.successful.v1":
+        spec = (cloud_event.data.get("pipelinerun") or {}).get("spec") or {}
+        event["deploys"] = shared.deploy_rows(
+            event, [param.get("value") for param in spec.get("params") or () if param.get("name") == "gitrevision"])
 
-    return event
+    return projection.apply(event, event["metadata"])
 
 
 if __name__ == "__main__":